@@ -0,0 +1,230 @@
+"""Offline replay benchmarks.
+
+Generates synthetic events and measures the replay throughput (rows/s) and the peak memory of a set of scenarios. Each
+scenario runs in its own process, so the peak memory of one doesn't leak into the next, and the results are written to a
+JSON file to compare them across commits:
+
+    $ python _test/bench.py --rows 1e4,1e5,1e6 --output bench.json
+    $ python _test/bench.py --scenarios replay,counters --rows 1e7 --entities 100000 --zipf 1.3
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+
+import raptor
+from raptor.stub import *
+
+try:
+    import resource
+except ImportError:  # windows
+    resource = None
+
+
+def generate_events(rows: int, entities: int = 1000, zipf: float = 1.1, width: int = 4, rate: float = 1.0,
+                    seed: int = 42) -> pd.DataFrame:
+    """Generate a dataframe of synthetic events, sorted by time.
+
+    :param int rows: the number of events.
+    :param int entities: the number of distinct entity ids.
+    :param float zipf: the skew of the entities' popularity, the k-th most popular entity gets 1/k^zipf of the events.
+        0 means all the entities are equally popular.
+    :param int width: the number of extra numeric columns in the payload.
+    :param float rate: the average number of events per second (the events arrive as a Poisson process).
+    """
+    rng = np.random.default_rng(seed)
+
+    weights = 1.0 / np.arange(1, entities + 1) ** zipf
+    entity_ids = rng.choice(entities, size=rows, p=weights / weights.sum())
+
+    gaps = rng.exponential(1e9 / rate, size=rows).astype("int64")
+    timestamps = pd.to_datetime(np.cumsum(gaps) + pd.Timestamp("2022-01-01").value, utc=True)
+
+    df = pd.DataFrame({
+        "event_at": timestamps,
+        "account_id": pd.Series(entity_ids).map("acc-{}".format),
+        "amount": rng.gamma(2.0, 50.0, size=rows).round(2),
+        "subject": rng.choice(["wrote_code", "fixed_bug", "deployed", "reviewed", "built_model"], size=rows),
+    })
+    for i in range(width):
+        df[f"f{i}"] = rng.random(rows)
+    return df
+
+
+# features
+
+@raptor.register(float, freshness='1m', staleness='-1', options={})
+def amount(**req):
+    return req['payload']['amount']
+
+
+@raptor.register(float, freshness='1m', staleness='1h', options={})
+@raptor.aggr([raptor.AggrFn.Sum, raptor.AggrFn.Count, raptor.AggrFn.Min, raptor.AggrFn.Max, raptor.AggrFn.Avg])
+def amount_1h(**req):
+    return req['payload']['amount']
+
+
+@raptor.register(float, freshness='1m', staleness='1h', options={})
+def amount_1h_share(**req):
+    total, _ = f("amount_1h.default[sum]", req['entity_id'])
+    if total == None or total == 0:
+        return None
+    return req['payload']['amount'] / total
+
+
+@raptor.register(int, freshness='1m', staleness='1h', options={})
+def amount_1h_share_high(**req):
+    share, _ = f("amount_1h_share.default", req['entity_id'])
+    if share == None:
+        return None
+    return 1 if share > 0.5 else 0
+
+
+@raptor.register(int, '-1', '-1')
+def events_count(**req):
+    incr_feature("events_count.default", req["entity_id"], 1)
+
+
+@raptor.feature_set(register=True)
+def amounts():
+    return "amount_1h.default[sum]", "amount_1h.default[avg]", amount_1h_share
+
+
+# scenarios: each one prepares whatever it depends on, and returns the timed part
+
+def scenario_replay(df):
+    return lambda: amount.replay(df, entity_id_field="account_id", store_locally=False)
+
+
+def scenario_aggregations(df):
+    return lambda: amount_1h.replay(df, entity_id_field="account_id", store_locally=False)
+
+
+def scenario_dependencies(df):
+    amount_1h.replay(df, entity_id_field="account_id")
+
+    def run():
+        amount_1h_share.replay(df, entity_id_field="account_id")
+        amount_1h_share_high.replay(df, entity_id_field="account_id", store_locally=False)
+
+    return run
+
+
+def scenario_counters(df):
+    return lambda: events_count.replay(df, entity_id_field="account_id")
+
+
+def scenario_historical_get(df):
+    amount_1h.replay(df, entity_id_field="account_id")
+    amount_1h_share.replay(df, entity_id_field="account_id")
+    since, until = df["event_at"].min(), df["event_at"].max()
+    return lambda: amounts.historical_get(since=since, until=until)
+
+
+SCENARIOS = {
+    "replay": scenario_replay,
+    "aggregations": scenario_aggregations,
+    "dependencies": scenario_dependencies,
+    "counters": scenario_counters,
+    "historical_get": scenario_historical_get,
+}
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024 ** 2 if sys.platform == "darwin" else rss / 1024  # bytes on macOS, KB elsewhere
+
+
+def run_scenario(args):
+    """Run a single scenario in this process, and print its result as JSON"""
+    df = generate_events(args.rows, args.entities, args.zipf, args.width, args.rate, args.seed)
+    run = SCENARIOS[args.run](df)
+    setup_rss = peak_rss_mb()
+    raptor.reset_stats()
+
+    start = time.perf_counter()
+    run()
+    seconds = time.perf_counter() - start
+
+    stages = raptor.stats().groupby("stage")["total_ms"].sum()
+    print(json.dumps({
+        "scenario": args.run,
+        "rows": args.rows,
+        "seconds": seconds,
+        "rows_per_sec": args.rows / seconds,
+        "setup_peak_rss_mb": setup_rss,
+        "peak_rss_mb": peak_rss_mb(),
+        "stages_ms": stages.round(3).to_dict(),
+    }))
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="comma separated scenarios to run")
+    parser.add_argument("--rows", default="1e4,1e5,1e6", help="comma separated numbers of rows, i.e. 1e4,1e7")
+    parser.add_argument("--entities", type=int, default=1000, help="the number of distinct entities")
+    parser.add_argument("--zipf", type=float, default=1.1, help="the skew of the entities' popularity")
+    parser.add_argument("--width", type=int, default=4, help="the number of extra payload columns")
+    parser.add_argument("--rate", type=float, default=1.0, help="the average number of events per second")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", default="bench.json", help="the JSON file to write the results to")
+    parser.add_argument("--run", choices=SCENARIOS, help=argparse.SUPPRESS)  # run a single scenario in this process
+    args = parser.parse_args()
+
+    if args.run is not None:
+        args.rows = int(float(args.rows))
+        run_scenario(args)
+        return
+
+    params = ["--entities", str(args.entities), "--zipf", str(args.zipf), "--width", str(args.width),
+              "--rate", str(args.rate), "--seed", str(args.seed)]
+    results = []
+    for scenario in args.scenarios.split(","):
+        if scenario not in SCENARIOS:
+            parser.error(f"unknown scenario `{scenario}`. Use one of: {', '.join(SCENARIOS)}")
+        for rows in args.rows.split(","):
+            rows = int(float(rows))
+            proc = subprocess.run([sys.executable, os.path.abspath(__file__), "--run", scenario, "--rows", str(rows)]
+                                  + params, stdout=subprocess.PIPE, universal_newlines=True)
+            if proc.returncode != 0:
+                result = {"scenario": scenario, "rows": rows, "error": f"exited with code {proc.returncode}"}
+            else:
+                result = json.loads(proc.stdout.strip().splitlines()[-1])
+            results.append(result)
+            print(f"{scenario:>15} {rows:>10,} rows: " + (
+                result["error"] if "error" in result else
+                f"{result['rows_per_sec']:>12,.0f} rows/s, peak RSS {result['peak_rss_mb']} MB"))
+
+    with open(args.output, "w") as f:
+        json.dump({
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "pandas": pd.__version__,
+            "platform": platform.platform(),
+            "params": {"entities": args.entities, "zipf": args.zipf, "width": args.width, "rate": args.rate,
+                       "seed": args.seed},
+            "results": results,
+        }, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
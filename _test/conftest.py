@@ -0,0 +1,19 @@
+"""Makes the tests runnable from any directory, and without building the PyExp extension: when it's not built, it's
+replaced by a stand-in (see `fake_pyexp`)."""
+
+import os
+import sys
+
+_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if _root not in sys.path:
+    sys.path.insert(0, _root)
+
+if not os.path.exists(os.path.join(_root, "raptor", "pyexp")):
+    _fake = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_pyexp")
+    sys.path.insert(0, _fake)
+    # the worker processes of parallel replays install it as well, by its `sitecustomize`
+    os.environ["PYTHONPATH"] = os.pathsep.join([_fake, _root] + [p for p in [os.environ.get("PYTHONPATH")] if p])
+
+    import fake_pyexp
+
+    fake_pyexp.install()
@@ -0,0 +1,144 @@
+"""A stand-in for the PyExp extension (`raptor.pyexp`), for running the tests without building it.
+
+It executes the feature programs as Python, rather than as PyExp, with the same request and the same functions
+(`f()`, `set_feature`, `incr_feature`, etc.), and exposes the parts of the extension's API that Raptor uses. The
+programs of the tests are written in the common subset of both, so they run the same with the real extension.
+"""
+
+import datetime
+import inspect
+import json
+import re
+import sys
+import traceback
+import types
+
+InstructionOpSet = "set"
+InstructionOpUpdate = "update"
+InstructionOpAppend = "append"
+InstructionOpIncr = "incr"
+
+
+def install():
+    """Register this module as `raptor.pyexp`, unless the extension is already imported"""
+    if "raptor.pyexp" in sys.modules:
+        return
+    mod = sys.modules[__name__]
+    package = types.ModuleType("raptor.pyexp")
+    package.__path__ = []
+    package.pyexp = mod
+    package.go = types.SimpleNamespace(nil=None)
+    sys.modules["raptor.pyexp"] = package
+    sys.modules["raptor.pyexp.pyexp"] = mod
+    sys.modules["raptor.pyexp.go"] = package.go
+
+
+def _parse(s) -> datetime.datetime:
+    if isinstance(s, datetime.datetime):
+        return s
+    t = datetime.datetime.fromisoformat(s.replace("Z", "+00:00"))
+    if t.tzinfo is None:
+        t = t.replace(tzinfo=datetime.timezone.utc)
+    return t
+
+
+def PyTime(s: str, layout: str):
+    return _parse(re.sub(r"(\.\d{6})\d+", r"\1", s))  # `fromisoformat` takes up to microseconds
+
+
+def PyTimeRFC3339(t) -> str:
+    return t.isoformat().replace("+00:00", "Z")
+
+
+def JsonAny(obj, field: str) -> str:
+    v = getattr(obj, field)
+    if isinstance(v, datetime.datetime):
+        return json.dumps(PyTimeRFC3339(v))
+    return json.dumps(v)
+
+
+class PyExecReq:
+    def __init__(self, payload: str, getter):
+        self.payload = payload
+        self.getter = getter
+        self.Timestamp = None
+        self.EntityID = ""
+        self.Headers = None
+
+
+class PyVal:
+    def __init__(self, handle=None):
+        self.Value = None
+        self.Timestamp = None
+        self.Fresh = False
+        if handle is not None:
+            self.__dict__ = handle.__dict__
+
+
+class Instruction:
+    def __new__(cls, handle=None):
+        return handle
+
+
+class _Instruction:
+    def __init__(self, op, fqn, entity_id, value, timestamp):
+        self.Operation = op
+        self.FQN = fqn
+        self.EntityID = entity_id
+        self.Value = value
+        self.Timestamp = timestamp
+
+
+class _Result:
+    def __init__(self, value, timestamp, entity_id, instructions):
+        self.Value = value
+        self.Timestamp = timestamp
+        self.EntityID = entity_id
+        self.Instructions = instructions
+
+
+class Runtime:
+    def __init__(self, code: str, fqn: str):
+        self.fqn = fqn
+        scope = {}
+        exec(compile(code, "<pyexp>", "exec"), scope)
+        self.handler = [v for v in scope.values() if inspect.isfunction(v)][0]
+
+    def Exec(self, req: PyExecReq) -> _Result:
+        instructions = []
+        ts = req.Timestamp
+
+        def get_feature(fqn, entity_id):
+            val = PyVal()
+            err = req.getter(fqn, entity_id, ts, val)
+            if err:
+                raise RuntimeError(err.decode())
+            if val.Value is None:
+                return None, None
+            return json.loads(val.Value), val.Timestamp
+
+        def instruction(op):
+            def add(fqn, entity_id, value, timestamp=None):
+                timestamp = ts if timestamp is None else _parse(timestamp)
+                instructions.append(_Instruction(op, fqn, entity_id, value, timestamp))
+
+            return add
+
+        self.handler.__globals__.update(f=get_feature, get_feature=get_feature,
+                                        set_feature=instruction(InstructionOpSet),
+                                        update_feature=instruction(InstructionOpUpdate),
+                                        append_feature=instruction(InstructionOpAppend),
+                                        incr_feature=instruction(InstructionOpIncr))
+        try:
+            value = self.handler(entity_id=req.EntityID, timestamp=ts, payload=json.loads(req.payload),
+                                 headers=req.Headers)
+        except Exception as e:
+            line = traceback.extract_tb(e.__traceback__)[-1].lineno
+            raise RuntimeError(f"<pyexp>:{line}:1: in handler Error in {self.handler.__name__}: {e}")
+        if isinstance(value, tuple):
+            value = value[0]
+        return _Result(value, ts, req.EntityID, instructions)
+
+
+def New(code: str, fqn: str) -> Runtime:
+    return Runtime(code, fqn)
@@ -0,0 +1,4 @@
+# Installs the PyExp stand-in at the startup of the worker processes of parallel replays (see `conftest.py`)
+import fake_pyexp
+
+fake_pyexp.install()
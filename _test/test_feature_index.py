@@ -0,0 +1,70 @@
+"""Tests of the point-in-time lookups of `FeatureIndex`, against a brute-force search of the values that were added."""
+
+import numpy as np
+import pytest
+
+from raptor import feature_index
+
+
+def _expected(added, entity_id, timestamp, staleness=0):
+    """The most recent value as of the timestamp: the latest timestamp, and of those the last one added"""
+    found = None
+    for eid, ts, value in added:
+        if eid == entity_id and ts <= timestamp and (found is None or ts >= found[1]):
+            found = (value, ts)
+    if found is None or (staleness > 0 and found[1] < timestamp - staleness):
+        return None
+    return found
+
+
+def _batches(rng, count: int):
+    """Batches of values of various sizes, out of time order, with repeating entities and timestamps"""
+    seq = 0
+    for _ in range(count):
+        size = int(rng.choice([1, 1, 3, 20, 70]))
+        entity_ids = rng.integers(0, 6, size)
+        timestamps = rng.integers(0, 200, size) * 10
+        yield entity_ids, timestamps, list(range(seq, seq + size))
+        seq += size
+
+
+@pytest.fixture(autouse=True)
+def small_runs(monkeypatch):
+    monkeypatch.setattr(feature_index, "MERGE_MIN_ROWS", 16)  # so a few batches are merged into runs
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_lookup(seed):
+    rng = np.random.default_rng(seed)
+    idx = feature_index.FeatureIndex()
+    added = []
+    for entity_ids, timestamps, values in _batches(rng, 60):
+        idx.add(entity_ids, timestamps, values)
+        added.extend(zip(entity_ids.tolist(), timestamps.tolist(), values))
+
+        for entity_id in range(7):
+            for timestamp in rng.integers(-10, 2100, 5).tolist():
+                assert idx.lookup(entity_id, timestamp) == _expected(added, entity_id, timestamp)
+                assert idx.lookup(entity_id, timestamp, 50) == _expected(added, entity_id, timestamp, 50)
+            timestamps = [ts for eid, ts, _ in added if eid == entity_id]
+            assert idx.last_timestamp(entity_id) == (max(timestamps) if timestamps else None)
+
+    assert len(idx) == len(added)
+    assert len(idx._runs) < 10  # merged rather than a run per batch
+
+
+def test_copy_is_independent():
+    rng = np.random.default_rng(0)
+    idx = feature_index.FeatureIndex()
+    batches = list(_batches(rng, 30))
+    for batch in batches[:20]:
+        idx.add(*batch)
+
+    copy = idx.copy()
+    copy.add([0, 1], [5000, 5000], ["new", "new"])
+    idx.add([0], [6000], ["other"])
+
+    assert copy.lookup(0, 10000) == ("new", 5000)
+    assert copy.lookup(1, 10000) == ("new", 5000)
+    assert idx.lookup(0, 10000) == ("other", 6000)
+    assert idx.lookup(1, 10000) != ("new", 5000)
@@ -0,0 +1,170 @@
+"""Tests of the locally stored values: replaying a feature again replaces the values (and the effects) of its previous
+replay, rather than adding to them, and sessions isolate them from each other and from concurrent threads."""
+
+import threading
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import raptor
+from raptor import local_state, replay
+
+
+@raptor.register(int, "-1", "-1")
+def ups_total(**req):
+    return None
+
+
+@raptor.register(int, "1m", "1h")
+@raptor.aggr([raptor.AggrFn.Sum, raptor.AggrFn.Count])
+def ups_amount(**req):
+    set_feature("ups_total.default", req["entity_id"], req["payload"]["amount"])
+    return 100 // req["payload"]["amount"]
+
+
+def _events(n=60, start="2022-01-01") -> pd.DataFrame:
+    return pd.DataFrame({
+        "event_at": pd.date_range(start, periods=n, freq="5min", tz="UTC"),
+        "account_id": [f"e{i % 4}" for i in range(n)],
+        "amount": np.arange(n) + 1,
+    })
+
+
+def _stored() -> pd.DataFrame:
+    df = local_state.feature_values()
+    df = df.assign(timestamp=pd.to_datetime(df["timestamp"], utc=True))
+    return df.sort_values(["fqn", "entity_id", "timestamp"], kind="stable").reset_index(drop=True)
+
+
+def test_replaying_again_replaces_the_previous_values():
+    df = _events()
+    with raptor.Session():
+        first = ups_amount.replay(df, entity_id_field="account_id")
+        stored = _stored()
+        assert not stored.duplicated(["fqn", "entity_id", "timestamp"]).any()
+
+        again = ups_amount.replay(df, entity_id_field="account_id")
+        pd.testing.assert_frame_equal(again, first)
+        pd.testing.assert_frame_equal(_stored(), stored)
+
+        # a replay of other data replaces the feature's values, while the effects of the previous one remain
+        later = _events(start="2022-02-01")
+        ups_amount.replay(later, entity_id_field="account_id")
+        fv = _stored()
+        own = fv[fv["fqn"].str.startswith("ups_amount")]
+        assert pd.to_datetime(own["timestamp"]).min() == later["event_at"].min()
+        assert (fv["fqn"] == "ups_total.default").sum() == len(df) + len(later)
+
+
+def test_a_failed_replay_keeps_the_previous_values():
+    df = _events()
+    with raptor.Session():
+        ups_amount.replay(df, entity_id_field="account_id")
+        stored = _stored()
+        with pytest.raises(Exception):
+            ups_amount.replay(df.assign(amount=df["amount"] - 30), entity_id_field="account_id")  # a division by 0
+        pd.testing.assert_frame_equal(_stored(), stored)
+
+
+def test_incremental_replays_add_only_the_new_values():
+    df = _events()
+    with raptor.Session():
+        ups_amount.replay(df.iloc[:30], entity_id_field="account_id")
+        ups_amount.replay(df, entity_id_field="account_id", incremental=True)
+        incremental = _stored()
+    with raptor.Session():
+        ups_amount.replay(df, entity_id_field="account_id")
+        pd.testing.assert_frame_equal(incremental, _stored())
+
+
+def test_the_last_stored_value_of_a_key_is_the_one_read():
+    ts = pd.Timestamp("2022-01-01", tz="UTC")
+    with raptor.Session():
+        for value in [1, 2, 3]:
+            local_state.store_feature_values(pd.DataFrame({"fqn": ["ups_total.default"], "entity_id": ["a"],
+                                                           "value": [value], "timestamp": [ts]}))
+        assert local_state.lookup("ups_total.default", "a", ts)[0] == 3
+
+
+def _value(fqn, entity_id, value):
+    return pd.DataFrame({"fqn": [fqn], "entity_id": [entity_id], "value": [value],
+                         "timestamp": [pd.Timestamp("2022-01-01", tz="UTC")]})
+
+
+def _in_thread(session, fn):
+    def run():
+        with session:
+            fn()
+
+    t = threading.Thread(target=run)
+    t.start()
+    return t
+
+
+def test_concurrent_readers_and_writers(monkeypatch):
+    started, resume = threading.Event(), threading.Event()
+    exec_batch = getattr(replay, "__exec_batch")
+
+    def paused(*args):
+        values = exec_batch(*args)
+        started.set()
+        assert resume.wait(10)
+        return values
+
+    monkeypatch.setattr(replay, "__exec_batch", paused)
+    df = _events()
+    with raptor.Session() as session:
+        local_state.store_feature_values(_value("ups_total.default", "x", 1))
+        replaying = _in_thread(session, lambda: ups_amount.replay(df, entity_id_field="account_id", chunk_size=10))
+        assert started.wait(10)
+
+        # readers get the values as they were before the replay, without waiting for it
+        seen = []
+        reader = _in_thread(session, lambda: seen.append((len(local_state.feature_values()), session.snapshot())))
+        reader.join(5)
+        assert not reader.is_alive()
+        assert seen[0][0] == 1
+
+        # writers wait for the replay, and their values are kept along with the replay's
+        writer = _in_thread(session, lambda: local_state.store_feature_values(_value("ups_total.default", "y", 2)))
+        writer.join(.2)
+        assert writer.is_alive()
+
+        resume.set()
+        replaying.join(10)
+        writer.join(10)
+        fv = local_state.feature_values()
+        assert set(fv.loc[fv["entity_id"].isin(["x", "y"]), "value"]) == {1, 2}
+        assert (fv["fqn"] == "ups_amount.default[sum]").sum() == len(df)
+
+    # a snapshot taken during the replay has the values as they were before it
+    with seen[0][1]:
+        assert len(local_state.feature_values()) == 1
+
+
+def test_fork_and_snapshot_are_isolated():
+    df = _events()
+    with raptor.Session() as session:
+        ups_amount.replay(df, entity_id_field="account_id")
+        stored = _stored()
+        snapshot = session.snapshot()
+        fork = session.fork()
+
+    with fork:
+        local_state.store_feature_values(_value("ups_total.default", "x", 1))
+        ups_amount.replay(df.iloc[:10], entity_id_field="account_id")
+        assert len(local_state.feature_values()) < len(stored)
+    with snapshot:
+        pd.testing.assert_frame_equal(_stored(), stored)
+        with pytest.raises(Exception, match="read-only"):
+            local_state.store_feature_values(_value("ups_total.default", "x", 1))
+    with session:
+        pd.testing.assert_frame_equal(_stored(), stored)
+
+
+def test_sqlite_sessions_are_not_forked(tmp_path):
+    with raptor.Session("sqlite", str(tmp_path / "values.db")) as session:
+        ups_amount.replay(_events(), entity_id_field="account_id")
+        with pytest.raises(Exception, match="not supported"):
+            session.fork()
@@ -0,0 +1,128 @@
+"""Tests of the on-disk replay cache (`replay(cache=True)`): a replay of the same data, arguments, feature definition
+and dependencies is restored from the cache rather than executed, and anything else is executed again."""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import raptor
+from raptor import local_state, replay, replay_cache
+
+
+@raptor.register(int, "-1", "-1")
+def cache_amount(**req):
+    return req["payload"]["amount"]
+
+
+@raptor.register(int, "-1", "-1")
+def cache_limit(**req):
+    return None
+
+
+@raptor.register(int, "-1", "-1")
+def cache_over_limit(**req):
+    limit, _ = f("cache_limit.default", req["entity_id"])
+    if limit == None:
+        return 0
+    return req["payload"]["amount"] - limit
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path):
+    previous = replay_cache._cache_dir
+    raptor.configure_replay_cache(str(tmp_path))
+    yield tmp_path
+    raptor.configure_replay_cache(previous)
+
+
+@pytest.fixture
+def executions(monkeypatch):
+    """The number of dataframes that replays executed, rather than restored from the cache"""
+    calls = []
+    exec_rows = getattr(replay, "__exec_rows")
+
+    def counted(*args, **kwargs):
+        calls.append(1)
+        return exec_rows(*args, **kwargs)
+
+    monkeypatch.setattr(replay, "__exec_rows", counted)
+    return calls
+
+
+def _events(n=50) -> pd.DataFrame:
+    return pd.DataFrame({
+        "event_at": pd.date_range("2022-01-01", periods=n, freq="min", tz="UTC"),
+        "account_id": [f"e{i % 5}" for i in range(n)],
+        "amount": np.arange(n),
+        "headers": [{"source": "web", "tags": [i % 3]} for i in range(n)],  # objects that pandas can't hash
+    })
+
+
+def _replay(feature, df, stored: pd.DataFrame = None):
+    """Replay in a new session, and return the values along with all the values stored locally"""
+    with raptor.Session():
+        if stored is not None:
+            local_state.store_feature_values(stored)
+        values = feature.replay(df, entity_id_field="account_id", headers_field="headers", cache=True)
+        return values.reset_index(drop=True), local_state.feature_values().reset_index(drop=True)
+
+
+def _assert_same(got, expected):
+    pd.testing.assert_frame_equal(got[0], expected[0], check_dtype=False)
+    pd.testing.assert_frame_equal(got[1], expected[1], check_dtype=False)
+
+
+def test_hit(executions):
+    df = _events()
+    expected = _replay(cache_amount, df)
+    assert len(executions) == 1
+    _assert_same(_replay(cache_amount, df.copy()), expected)
+    assert len(executions) == 1
+
+
+def test_changed_data_misses(executions):
+    df = _events()
+    _replay(cache_amount, df)
+    changed = df.copy()
+    changed.at[3, "amount"] = 100
+    assert _replay(cache_amount, changed)[0]["value"][3] == 100
+    changed.at[3, "headers"] = {"source": "app", "tags": [0]}
+    _replay(cache_amount, changed)
+    assert len(executions) == 3
+
+
+def test_changed_dependencies_miss(executions):
+    df = _events()
+    limits = pd.DataFrame({"fqn": "cache_limit.default", "entity_id": [f"e{i}" for i in range(5)], "value": 10,
+                           "timestamp": pd.Timestamp("2021-12-31", tz="UTC")})
+    expected = _replay(cache_over_limit, df, limits)
+    _assert_same(_replay(cache_over_limit, df, limits), expected)
+    assert len(executions) == 1
+
+    got = _replay(cache_over_limit, df, limits.assign(value=20))
+    assert len(executions) == 2
+    assert (got[0]["value"] == expected[0]["value"] - 10).all()
+
+
+def test_invalidated(executions):
+    df = _events()
+    _replay(cache_amount, df)
+    raptor.invalidate_replay_cache("cache_over_limit.default")
+    _replay(cache_amount, df)
+    assert len(executions) == 1
+    raptor.invalidate_replay_cache("cache_amount.default")
+    _replay(cache_amount, df)
+    assert len(executions) == 2
+    raptor.invalidate_replay_cache()
+    _replay(cache_amount, df)
+    assert len(executions) == 3
+
+
+def test_digest_of_objects():
+    df = _events()
+    digest = replay_cache.dataframe_digest(df)
+    assert digest is not None
+    assert replay_cache.dataframe_digest(df.copy()) == digest
+    reordered = df.assign(headers=[{"tags": h["tags"], "source": h["source"]} for h in df["headers"]])
+    assert replay_cache.dataframe_digest(reordered) == digest
+    assert replay_cache.dataframe_digest(df.assign(headers=[{"source": "web"}] * len(df))) != digest
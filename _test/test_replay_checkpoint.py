@@ -0,0 +1,92 @@
+"""Tests of checkpointed replays (`checkpoint_dir`): a replay that failed is resumed from its last checkpoint, with the
+same values and effects as a replay that never failed."""
+
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import raptor
+from raptor import local_state, replay
+
+
+@raptor.register(int, "-1", "-1")
+def ckpt_visits(**req):
+    return None
+
+
+@raptor.register(int, "-1", "-1")
+def ckpt_amount_per_visit(**req):
+    incr_feature("ckpt_visits.default", req["entity_id"], 1)
+    visits, _ = f("ckpt_visits.default", req["entity_id"])
+    if visits == None:
+        return req["payload"]["amount"]
+    return req["payload"]["amount"] // (visits + 1)
+
+
+def _events(n=100) -> pd.DataFrame:
+    return pd.DataFrame({
+        "event_at": pd.date_range("2022-01-01", periods=n, freq="min", tz="UTC"),
+        "account_id": [f"e{i % 3}" for i in range(n)],
+        "amount": np.arange(n) * 10,
+    })
+
+
+@pytest.fixture
+def executed_rows(monkeypatch):
+    """The positions of the first rows of the batches that replays executed. A batch raises when it starts at or after
+    `fail_at`."""
+    exec_batch = getattr(replay, "__exec_batch")
+    starts = []
+
+    def tracked(spec, rt, chunk, *args):
+        start = args[-1]
+        if tracked.fail_at is not None and start >= tracked.fail_at:
+            raise Exception("the kernel died")
+        starts.append(start)
+        return exec_batch(spec, rt, chunk, *args)
+
+    tracked.fail_at = None
+    monkeypatch.setattr(replay, "__exec_batch", tracked)
+    return tracked, starts
+
+
+def test_resume_after_a_failure(tmp_path, executed_rows):
+    tracked, starts = executed_rows
+    df = _events()
+    kwargs = dict(entity_id_field="account_id", chunk_size=10, checkpoint_every=20)
+    with raptor.Session():
+        expected = ckpt_amount_per_visit.replay(df, entity_id_field="account_id")
+        expected_stored = local_state.feature_values()
+
+    with raptor.Session():
+        tracked.fail_at = 50
+        with pytest.raises(Exception, match="the kernel died"):
+            ckpt_amount_per_visit.replay(df, checkpoint_dir=str(tmp_path), **kwargs)
+        assert local_state.stored_count() == 0  # rolled back, the checkpoints have its effects
+
+        tracked.fail_at = None
+        del starts[:]
+        got = ckpt_amount_per_visit.replay(df, checkpoint_dir=str(tmp_path), **kwargs)
+        assert starts == [40, 50, 60, 70, 80, 90]  # resumed from the checkpoint at 40
+        pd.testing.assert_frame_equal(got.reset_index(drop=True), expected.reset_index(drop=True), check_dtype=False)
+        pd.testing.assert_frame_equal(local_state.feature_values().reset_index(drop=True),
+                                      expected_stored.reset_index(drop=True), check_dtype=False)
+
+    assert os.listdir(str(tmp_path)) == []  # dropped once the replay completed
+
+
+def test_checkpoints_of_other_data_are_not_resumed(tmp_path, executed_rows):
+    tracked, starts = executed_rows
+    df = _events()
+    kwargs = dict(entity_id_field="account_id", chunk_size=10, checkpoint_every=20, checkpoint_dir=str(tmp_path))
+    with raptor.Session():
+        tracked.fail_at = 50
+        with pytest.raises(Exception):
+            ckpt_amount_per_visit.replay(df, **kwargs)
+
+        tracked.fail_at = None
+        del starts[:]
+        ckpt_amount_per_visit.replay(df.assign(amount=df["amount"] + 1), **kwargs)
+        assert starts == list(range(0, 100, 10))
@@ -0,0 +1,55 @@
+"""Tests of collecting the rows that failed a replay (`on_error="collect"`) into a dead-letter dataframe, rather than
+failing the whole replay."""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import raptor
+from raptor import local_state
+
+
+@raptor.register(int, "-1", "-1")
+def err_ratio(**req):
+    return 100 // req["payload"]["amount"]
+
+
+def _events(n=40) -> pd.DataFrame:
+    return pd.DataFrame({
+        "event_at": pd.date_range("2022-01-01", periods=n, freq="min", tz="UTC"),
+        "account_id": [f"e{i % 4}" for i in range(n)],
+        "amount": np.arange(n) % 7,  # a zero every 7 rows
+    })
+
+
+def test_raise_by_default():
+    with raptor.Session():
+        with pytest.raises(Exception, match="err_ratio"):
+            err_ratio.replay(_events(), entity_id_field="account_id")
+        assert local_state.stored_count() == 0
+
+
+@pytest.mark.parametrize("kwargs", [{}, {"chunk_size": 3}, {"workers": 2}])
+def test_collect(kwargs):
+    df = _events()
+    with raptor.Session():
+        values, dead_letters = err_ratio.replay(df, entity_id_field="account_id", on_error="collect", **kwargs)
+        stored = local_state.feature_values()
+
+    failed = df["amount"] == 0
+    assert list(values.index) == list(df.index[~failed])
+    assert values["value"].tolist() == (100 // df["amount"][~failed]).tolist()
+    assert len(stored) == len(values)
+
+    pd.testing.assert_frame_equal(dead_letters[df.columns], df[failed])
+    assert dead_letters["__raptor.error__"].str.contains("err_ratio").all()
+    assert dead_letters["__raptor.lineno__"].notna().all()
+
+
+def test_collect_up_to_max_errors():
+    df = _events()
+    with raptor.Session():
+        _, dead_letters = err_ratio.replay(df, entity_id_field="account_id", on_error="collect", max_errors=6)
+        assert len(dead_letters) == 6
+        with pytest.raises(Exception, match="Too many errors"):
+            err_ratio.replay(df, entity_id_field="account_id", on_error="collect", max_errors=5)
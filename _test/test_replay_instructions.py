@@ -0,0 +1,152 @@
+"""Tests of the buffered instructions of a replay (`set_feature`, `incr_feature`, `append_feature`, etc.).
+
+The instructions are applied in bulk (see `replay_instructions.flush`), and the values they store must be the same as
+applying them one at a time, in the order they were executed:
+
+    $ python -m pytest -q _test
+"""
+
+import types
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import raptor
+from raptor import local_state, ragged, replay_instructions
+
+
+class _Instruction:
+    def __init__(self, op, fqn, entity_id, timestamp, value):
+        self.Operation = op
+        self.FQN = fqn
+        self.EntityID = entity_id
+        self.Timestamp = timestamp
+        self.Value = value
+
+    def __repr__(self):
+        return f"{self.Operation}({self.FQN}, {self.EntityID}, {self.Timestamp}, {self.Value})"
+
+
+START = pd.Timestamp("2022-01-01", tz="UTC")
+
+# fqn, primitive, staleness, max_length
+FEATURES = [
+    ("clicks.default", "int", "1h", None),
+    ("amount.default", "float", "-1", None),
+    ("last_page.default", "string", "1h", None),
+    ("recent_pages.default", "[]int", "1h", 3),
+    ("seen_at.default", "timestamp", "1h", None),
+]
+
+
+def _register():
+    for fqn, primitive, staleness, max_length in FEATURES:
+        options = {"primitive": primitive, "staleness": staleness, "freshness": "-1"}
+        if max_length is not None:
+            options["max_length"] = max_length
+        local_state.register_spec({"kind": "feature", "fqn": fqn, "src_name": fqn.split(".")[0], "options": options,
+                                   "src": types.SimpleNamespace(code="")})
+
+
+def _apply(instructions, one_by_one: bool, stored: pd.DataFrame = None) -> list:
+    """Execute the instructions in a new session, and return the values they stored as (fqn, entity, ts, value)"""
+    with raptor.Session():
+        _register()
+        if stored is not None:
+            local_state.store_feature_values(stored)
+        offset = local_state.stored_count()
+        for inst in instructions:
+            replay_instructions.__exec_instruction(inst)
+            if one_by_one:
+                replay_instructions.flush()
+        replay_instructions.flush()
+
+        df = local_state.stored_since(offset)
+        values = [v.tolist() if isinstance(v, ragged.ListValue) else v for v in df["value"]]
+        return sorted(zip(df["fqn"], df["entity_id"], pd.to_datetime(df["timestamp"], utc=True), values),
+                      key=lambda r: r[:3])
+
+
+def _assert_sequential(instructions, stored: pd.DataFrame = None):
+    expected = _apply(instructions, one_by_one=True, stored=stored)
+    got = _apply(instructions, one_by_one=False, stored=stored)
+    assert got == expected
+    assert [type(v) for *_, v in got] == [type(v) for *_, v in expected]  # i.e. not an int where a float is expected
+    return expected
+
+
+def _at(minutes):
+    return START + pd.Timedelta(minutes=minutes)
+
+
+def test_incr_in_time_order_is_a_cumulative_sum():
+    stored = pd.DataFrame({"fqn": ["clicks.default"], "entity_id": ["a"], "value": [10], "timestamp": [_at(0)]})
+    instructions = [_Instruction("incr", "clicks.default", "a", _at(m), by) for m, by in [(1, 1), (2, 2), (3, 3)]]
+    values = _assert_sequential(instructions, stored)
+    assert [v for *_, v in values] == [11, 13, 16]
+
+
+def test_incr_after_a_staleness_gap_starts_over():
+    instructions = [_Instruction("incr", "clicks.default", "a", _at(m), 1) for m in [0, 30, 200, 210]]
+    values = _assert_sequential(instructions)
+    assert [v for *_, v in values] == [1, 2, 1, 2]
+
+
+def test_set_of_strings_and_floats():
+    instructions = [_Instruction("set", "last_page.default", "a", _at(m), f"p{m}") for m in [2, 0, 1]]
+    instructions += [_Instruction("set", "amount.default", "a", _at(m), m + 0.5) for m in [2, 0, 1]]
+    values = _assert_sequential(instructions)
+    assert [v for *_, v in values] == [0.5, 1.5, 2.5, "p0", "p1", "p2"]
+
+
+def test_values_are_of_the_features_type():
+    instructions = [_Instruction("incr", "amount.default", "a", _at(m), 1) for m in range(3)]
+    instructions += [_Instruction("set", "amount.default", "b", _at(0), 2)]
+    instructions += [_Instruction("set", "seen_at.default", "a", _at(0), "2022-01-02T00:00:00Z")]
+    values = _assert_sequential(instructions)
+    assert [v for *_, v in values] == [1.0, 2.0, 3.0, 2.0, pd.Timestamp("2022-01-02", tz="UTC")]
+    assert all(type(v) is float for *_, v in values[:4])
+
+
+def test_incr_of_an_int_by_a_fraction_is_truncated_on_every_step():
+    instructions = [_Instruction("incr", "clicks.default", "a", _at(m), 0.5) for m in range(4)]
+    _assert_sequential(instructions)
+
+
+def test_out_of_order_instructions():
+    instructions = [_Instruction("incr", "amount.default", "a", _at(m), 1.5) for m in [5, 1, 3, 2, 4]]
+    instructions += [_Instruction("set", "last_page.default", "a", _at(m), f"p{m}") for m in [3, 1, 2]]
+    instructions += [_Instruction("append", "recent_pages.default", "a", _at(m), m) for m in [4, 1, 3, 2, 5]]
+    _assert_sequential(instructions)
+
+
+def test_values_stored_after_the_instructions():
+    stored = pd.DataFrame({"fqn": ["clicks.default", "recent_pages.default"], "entity_id": ["a", "a"],
+                           "value": [100, [7, 8]], "timestamp": [_at(10), _at(10)]})
+    instructions = [_Instruction("incr", "clicks.default", "a", _at(m), 1) for m in [0, 5, 15]]
+    instructions += [_Instruction("append", "recent_pages.default", "a", _at(m), m) for m in [0, 5, 15]]
+    _assert_sequential(instructions, stored)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_random_instructions(seed):
+    rng = np.random.default_rng(seed)
+    n = 300
+    minutes = rng.choice(24 * 60, n, replace=False)  # out of time order, with gaps longer than the staleness
+    instructions = []
+    for i, m in enumerate(minutes):
+        entity_id = f"e{rng.integers(3)}"
+        kind = rng.integers(4)
+        if kind == 0:
+            op = rng.choice(["set", "incr", "incr", "incr"])
+            instructions.append(_Instruction(op, "clicks.default", entity_id, _at(m), int(rng.integers(-5, 10))))
+        elif kind == 1:
+            op = rng.choice(["set", "incr"])
+            instructions.append(_Instruction(op, "amount.default", entity_id, _at(m), float(rng.normal())))
+        elif kind == 2:
+            instructions.append(_Instruction("set", "last_page.default", entity_id, _at(m), f"p{i}"))
+        else:
+            op = rng.choice(["append", "update"])
+            instructions.append(_Instruction(op, "recent_pages.default", entity_id, _at(m), int(rng.integers(100))))
+    _assert_sequential(instructions)
@@ -0,0 +1,97 @@
+"""Tests of parallel replays (`workers`): the values, and the values stored locally, must be the same as replaying the
+rows sequentially."""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import raptor
+from raptor import local_state
+
+
+@raptor.register(int, "-1", "-1")
+def par_visits(**req):
+    return None
+
+
+@raptor.register(int, "-1", "-1")
+def par_previous_visits(**req):
+    """the number of earlier visits of the entity, counted with instructions"""
+    v, _ = f("par_visits.default", req["entity_id"])
+    incr_feature("par_visits.default", req["entity_id"], 1)
+    if v == None:
+        return 0
+    return v
+
+
+@raptor.register(int, "1m", "1h")
+@raptor.aggr([raptor.AggrFn.Sum, raptor.AggrFn.Count, raptor.AggrFn.Max])
+def par_amount(**req):
+    return req["payload"]["amount"]
+
+
+@raptor.register(int, "-1", "6h")
+def par_last_amount(**req):
+    return None
+
+
+@raptor.register(int, "1m", "6h")
+def par_previous_amount(**req):
+    """the previous amount of the entity within 6 hours, kept with instructions"""
+    v, _ = f("par_last_amount.default", req["entity_id"])
+    set_feature("par_last_amount.default", req["entity_id"], req["payload"]["amount"])
+    return v
+
+
+def _events(n=400, entities=7, seed=0) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        "event_at": pd.Timestamp("2022-01-01", tz="UTC") + pd.to_timedelta(np.sort(rng.integers(0, 2 * 24 * 3600, n)),
+                                                                           unit="s"),
+        "account_id": [f"e{i}" for i in rng.integers(entities, size=n)],
+        "amount": rng.integers(1, 100, n),
+    })
+
+
+def _replay(feature, df, **kwargs):
+    """Replay in a new session, and return the values along with all the values stored locally"""
+    with raptor.Session():
+        values = feature.replay(df, entity_id_field="account_id", **kwargs)
+        stored = local_state.feature_values()
+    return values.reset_index(drop=True), _sorted(stored)
+
+
+def _sorted(df: pd.DataFrame) -> pd.DataFrame:
+    df = df.assign(timestamp=pd.to_datetime(df["timestamp"], utc=True))
+    return df.sort_values(["fqn", "entity_id", "timestamp"], kind="stable").reset_index(drop=True)
+
+
+def _assert_same(got, expected):
+    pd.testing.assert_frame_equal(got[0], expected[0], check_dtype=False)
+    pd.testing.assert_frame_equal(got[1], expected[1], check_dtype=False)
+
+
+def test_sharded_by_entity_with_instructions():
+    df = _events()
+    expected = _replay(par_previous_visits, df)
+    _assert_same(_replay(par_previous_visits, df, workers=2), expected)
+    _assert_same(_replay(par_previous_visits, df, workers=2, shards=5), expected)
+    assert expected[0]["value"].sum() == sum(k * (k - 1) // 2 for k in df["account_id"].value_counts())
+
+
+def test_sharded_by_entity_with_aggregations():
+    df = _events(seed=1)
+    _assert_same(_replay(par_amount, df, workers=2), _replay(par_amount, df))
+
+
+@pytest.mark.parametrize("split", ["rows", "time"])
+def test_sharded_by_time(split):
+    df = _events(entities=50, seed=2)
+    expected = _replay(par_previous_amount, df)
+    _assert_same(_replay(par_previous_amount, df, workers=2, shard_by="time", shards=4, split=split), expected)
+    assert len(expected[0]) < len(df) - df["account_id"].nunique()  # some of the previous amounts are stale
+
+
+def test_programs_with_incr_are_not_sharded_by_time():
+    with pytest.raises(Exception, match="can't be sharded by time"):
+        _replay(par_previous_visits, _events(), workers=2, shard_by="time")
@@ -0,0 +1,108 @@
+"""Tests of the retention of the locally stored values (`configure_retention`): evicting values must not change the
+values of the replays, as long as they replay in time order."""
+
+import numpy as np
+import pandas as pd
+
+import raptor
+from raptor import local_state
+
+
+@raptor.register(int, "-1", "-1")
+def ret_count(**req):
+    return None
+
+
+@raptor.register(int, "-1", "10m")
+def ret_last(**req):
+    return None
+
+
+@raptor.register(int, "-1", "-1")
+def ret_driver(**req):
+    c, _ = f("ret_count.default", req["entity_id"])
+    last, _ = f("ret_last.default", req["entity_id"])
+    incr_feature("ret_count.default", req["entity_id"], 1)
+    set_feature("ret_last.default", req["entity_id"], req["payload"]["n"])
+    if last == None:
+        last = -1
+    if c == None:
+        c = 0
+    return c * 100 + last
+
+
+@raptor.register(int, "-1", "10m")
+def ret_root(**req):
+    return req["payload"]["n"]
+
+
+@raptor.register(int, "-1", "-1")
+def ret_derived(**req):
+    v, _ = f("ret_root.default", req["entity_id"])
+    if v == None:
+        return -1
+    return v
+
+
+def _events(n=2000, seed=0) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        "event_at": pd.Timestamp("2022-01-01", tz="UTC") + pd.to_timedelta(np.sort(rng.integers(0, 20 * 3600, n)),
+                                                                           unit="s"),
+        "account_id": rng.choice(list("abcdefgh"), n),
+        "n": rng.integers(0, 50, n),
+    })
+
+
+def _sizes() -> dict:
+    return local_state.feature_values().groupby("fqn").size().to_dict()
+
+
+def test_evict_stale_while_streaming():
+    df = _events()
+    with raptor.Session():
+        expected = pd.concat(ret_driver.replay_iter(df, entity_id_field="account_id", chunk_size=200))
+        assert _sizes()["ret_last.default"] == len(df)
+
+    with raptor.Session():
+        raptor.configure_retention()
+        sizes = []
+        batches = []
+        for batch in ret_driver.replay_iter(df, entity_id_field="account_id", chunk_size=200):
+            batches.append(batch)
+            sizes.append(_sizes())
+        pd.testing.assert_frame_equal(pd.concat(batches), expected)
+
+    # the count has no staleness, so only the latest values of every entity are kept (as of the latest time that was
+    # replayed), and the last values are kept for their staleness of 10 minutes
+    assert all(s["ret_count.default"] <= 2 * 8 for s in sizes)
+    assert max(s["ret_last.default"] for s in sizes) < 50
+
+
+def test_the_values_of_a_dependency_are_kept_for_its_readers():
+    df = _events(500)
+    results = []
+    for evict_stale in [False, True]:
+        with raptor.Session():
+            raptor.configure_retention(evict_stale=evict_stale)
+            ret_root.replay(df, entity_id_field="account_id")
+            assert _sizes()["ret_root.default"] == len(df)  # its reader wasn't replayed yet
+            values = ret_derived.replay(df, entity_id_field="account_id")
+            results.append((values, _sizes()["ret_root.default"]))
+
+    pd.testing.assert_frame_equal(results[0][0], results[1][0])
+    assert results[0][1] == len(df)
+    assert results[1][1] < len(df) // 10
+
+
+def test_ttl_and_max_rows():
+    df = _events()
+    with raptor.Session():
+        raptor.configure_retention(evict_stale=False, ttl={"ret_last.default": "1h"}, max_rows={"ret_count.default": 5})
+        ret_driver.replay(df, entity_id_field="account_id")
+        fv = local_state.feature_values()
+
+    assert (fv["fqn"] == "ret_count.default").sum() == 5
+    last = pd.to_datetime(fv.loc[fv["fqn"] == "ret_last.default", "timestamp"], utc=True)
+    assert last.min() >= df["event_at"].max() - pd.Timedelta("1h")
+    assert len(last) == (df["event_at"] >= df["event_at"].max() - pd.Timedelta("1h")).sum()
@@ -0,0 +1,140 @@
+"""Tests of the storage backends: the `sqlite` backend must behave the same as the `memory` one, for the same sequence
+of operations."""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import raptor
+from raptor import local_state, ragged, storage
+
+FQNS = {"a.default": "int", "b.default": "string", "c.default": "[]int"}
+
+
+@raptor.register(int, "-1", "1h")
+def parity_visits(**req):
+    incr_feature("parity_visits.default", req["entity_id"], 1)
+    v, _ = f("parity_visits.default", req["entity_id"])
+    return v
+
+
+def _value(rng, fqn):
+    if FQNS[fqn] == "int":
+        return int(rng.integers(100))
+    if FQNS[fqn] == "string":
+        return f"s{rng.integers(100)}"
+    return [int(v) for v in rng.integers(100, size=rng.integers(1, 4))]
+
+
+def _plain(v):
+    return v.tolist() if isinstance(v, ragged.ListValue) else v
+
+
+def _frame(rng, size: int) -> pd.DataFrame:
+    fqns = rng.choice(list(FQNS), size)
+    return pd.DataFrame({
+        "fqn": fqns,
+        "entity_id": [f"e{i}" for i in rng.integers(4, size=size)],
+        "value": [_value(rng, fqn) for fqn in fqns],
+        "timestamp": pd.to_datetime(rng.integers(0, 100, size) * 10 ** 9, utc=True),
+    })
+
+
+def _rows(df: pd.DataFrame) -> list:
+    """The values as sorted tuples, regardless of the order and the dtypes of the dataframe"""
+    ts = pd.to_datetime(df["timestamp"], utc=True)
+    return sorted((f, e, repr(_plain(v)), t.value) for f, e, v, t in zip(df["fqn"], df["entity_id"], df["value"], ts))
+
+
+def _assert_same(backends, rng):
+    memory, sqlite = backends
+    assert memory.count() == sqlite.count()
+    assert _rows(memory.scan()) == _rows(sqlite.scan())
+    since, until = sorted(rng.integers(0, 100, 2) * 10 ** 9)
+    assert _rows(memory.scan(["a.default", "c.default"], since, until)) == \
+        _rows(sqlite.scan(["a.default", "c.default"], since, until))
+    for fqn in FQNS:
+        for entity_id in ["e0", "e1", "e2", "e3", "e4"]:
+            ts = int(rng.integers(-5, 105)) * 10 ** 9
+            for staleness in [0, 10 * 10 ** 9]:
+                expected = memory.lookup(fqn, entity_id, ts, staleness)
+                got = sqlite.lookup(fqn, entity_id, ts, staleness)
+                assert (got is None) == (expected is None)
+                if got is not None:
+                    assert (_plain(got[0]), got[1]) == (_plain(expected[0]), expected[1])
+            expected, got = memory.latest(fqn, entity_id), sqlite.latest(fqn, entity_id)
+            assert (got is None) == (expected is None)
+            if got is not None:
+                assert (_plain(got[0]), got[1]) == (_plain(expected[0]), expected[1])
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_same_operations(tmp_path, seed):
+    rng = np.random.default_rng(seed)
+    backends = [storage.MemoryBackend(), storage.SQLiteBackend(str(tmp_path / "values.db"))]
+    for step in range(40):
+        op = rng.choice(["store", "store", "store_values", "truncate", "dedupe", "evict", "evict_max", "remove"])
+        if op == "store":
+            df = _frame(rng, int(rng.integers(1, 30)))
+            results = [b.store(df.copy()) for b in backends]
+        elif op == "store_values":
+            df = _frame(rng, int(rng.integers(1, 5)))
+            args = (df["fqn"].tolist(), df["entity_id"].tolist(), df["value"].tolist(),
+                    [t.value for t in df["timestamp"]])
+            results = [b.store_values(*args) for b in backends]
+        elif op in ("truncate", "dedupe"):
+            offset = int(rng.integers(0, backends[0].count() + 1))
+            assert _rows(backends[0].since(offset)) == _rows(backends[1].since(offset))
+            results = [getattr(b, op)(offset) for b in backends]
+        elif op == "evict":
+            fqn, before, keep_latest = rng.choice(list(FQNS)), int(rng.integers(0, 100)) * 10 ** 9, rng.random() < .5
+            results = [b.evict(fqn, before, keep_latest=bool(keep_latest)) for b in backends]
+        elif op == "evict_max":
+            fqn, max_rows = rng.choice(list(FQNS)), int(rng.integers(0, 10))
+            results = [b.evict(fqn, max_rows=max_rows) for b in backends]
+        else:
+            fqns = [rng.choice(list(FQNS))]
+            results = [_rows(b.remove(fqns)) for b in backends]
+        assert results[0] == results[1], (step, op)
+        _assert_same(backends, rng)
+
+
+def test_same_replay(tmp_path):
+    n = 200
+    df = pd.DataFrame({"event_at": pd.date_range("2022-01-01", periods=n, freq="7min", tz="UTC"),
+                       "account_id": [f"e{i % 6}" for i in range(n)]})
+    results = []
+    for backend, path in [("memory", None), ("sqlite", str(tmp_path / "values.db"))]:
+        with raptor.Session(backend, path):
+            values = parity_visits.replay(df, entity_id_field="account_id")
+            results.append((values.reset_index(drop=True), _rows(local_state.feature_values())))
+    pd.testing.assert_frame_equal(results[0][0], results[1][0], check_dtype=False)
+    assert results[0][1] == results[1][1]
+
+
+def test_keys_round_trip():
+    keys = storage._Keys()
+    values = pd.Series(["a", 1, "1", None, "a", 2.5, "b", 1], dtype=object)
+    codes = keys.encode(values)
+    assert keys.decode(codes).tolist() == values.tolist()
+    assert codes[0] == codes[4] and codes[1] == codes[7] and codes[1] != codes[2]
+    assert keys.encode(pd.Series(["b", "c", "a"], dtype=object)).tolist() == [codes[6], keys.get("c"), codes[0]]
+    assert keys.get("d") is None
+
+
+def test_entity_ids_keep_their_type():
+    backend = storage.MemoryBackend()
+    backend.store(pd.DataFrame({"fqn": ["x.default", "x.default", "y.default"], "entity_id": ["1", 1, "b"],
+                                "value": [1, 2, 3], "timestamp": pd.to_datetime([1, 2, 3], utc=True)}))
+    fork = backend.fork()
+    fork.store_values(["x.default"], ["new"], [4], [4])  # adds keys to the dictionary that the backends share
+
+    df = backend.scan()
+    assert df["fqn"].tolist() == ["x.default", "x.default", "y.default"]
+    assert df["entity_id"].tolist() == ["1", 1, "b"]
+    assert [type(e) for e in df["entity_id"]] == [str, int, str]
+    assert backend.lookup("x.default", "1", 10) == (1, 1)
+    assert backend.lookup("x.default", 1, 10) == (2, 2)
+    assert backend.lookup("x.default", "new", 10) is None
+    assert fork.lookup("x.default", "new", 10) == (4, 4)
+    assert backend.lookup("z.default", 1, 10) is None
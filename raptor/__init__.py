@@ -13,4 +13,9 @@
 # limitations under the License.
 
 from .decorators import *
+from .local_state import Session, configure_local_storage, configure_retention
+from .local_store import load_local_state, save_local_state
+from .profiler import enable_profiling, export_trace, reset_stats, stats
+from .replay_cache import configure_replay_cache, invalidate_replay_cache
+from .runtimes import configure_runtime_cache, clear_runtime_cache
 from .types import *
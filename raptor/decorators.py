@@ -17,8 +17,7 @@ import inspect
 import re
 import types as pytypes
 
-from . import types, replay, local_state, stub
-from .pyexp import pyexp
+from . import types, replay, local_state, runtimes, stub
 
 
 def aggr(funcs: [types.AggrFn]):
@@ -108,7 +107,8 @@ def register(primitive, freshness: str, staleness: str, options=None):
     :param primitive: the primitive type of the feature.
     :param freshness: the freshness of the feature.
     :param staleness: the staleness of the feature.
-    :param options: optional options for the feature.
+    :param options: optional options for the feature. For list primitives, `max_length` keeps only the last
+        `max_length` elements of the lists that are built with `append_feature`.
     :return: a registered Feature Definition
     """
     if options is None:
@@ -155,6 +155,12 @@ def register(primitive, freshness: str, staleness: str, options=None):
             raise Exception("Primitive type not supported")
         options['primitive'] = p
 
+        if "max_length" in options:
+            if not p.startswith("[]"):
+                raise Exception("`max_length` is supported only for list primitives")
+            if not isinstance(options["max_length"], int) or options["max_length"] < 1:
+                raise Exception("`max_length` must be a positive number of elements")
+
         # append annotations
         if hasattr(func, "builder"):
             options["builder"] = func.builder
@@ -181,10 +187,13 @@ def register(primitive, freshness: str, staleness: str, options=None):
         func.raptor_spec = spec
 
         # try to compile the feature
-        pyexp.New(spec["src"].code, fqn)
+        runtimes.validate(spec["src"].code, fqn)
 
         # register
         func.replay = replay.new_replay(spec)
+        func.replay_file = replay.new_replay_file(spec)
+        func.replay_file_iter = replay.new_replay_file_iter(spec)
+        func.replay_iter = replay.new_replay_iter(spec)
         func.manifest = lambda: __feature_manifest(spec)
         local_state.register_spec(spec)
 
@@ -255,6 +264,7 @@ def feature_set(register=False, options=None):
         func.raptor_spec = spec
         func.historical_get = replay.new_historical_get(spec)
         func.manifest = lambda: __feature_set_manifest(spec)
+        local_state.track_feature_set(spec)
         if register:
             local_state.register_spec(spec)
         return func
@@ -335,7 +345,7 @@ def manifests(save_to_tmp=False):
     Otherwise, it will print the manifests.
     """
     mfts = []
-    for m in local_state.spec_registry:
+    for m in local_state.registered_specs():
         if m["kind"] == "feature":
             mfts.append(__feature_manifest(m))
         elif m["kind"] == "feature_set":
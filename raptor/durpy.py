@@ -32,6 +32,9 @@ units = {
 }
 
 
+_pattern = re.compile(r'([\d\.]+)([a-zµμ]+)')
+
+
 class DurationError(ValueError):
     """duration error"""
 
@@ -49,8 +52,7 @@ def from_str(duration):
     if duration in ("0", "+0", "-0"):
         return datetime.timedelta()
 
-    pattern = re.compile(r'([\d\.]+)([a-zµμ]+)')
-    matches = pattern.findall(duration)
+    matches = _pattern.findall(duration)
     if not len(matches):
         raise DurationError("Invalid duration {}".format(duration))
 
@@ -0,0 +1,181 @@
+# Copyright (c) 2022 Raptor.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from bisect import bisect_right
+
+import numpy as np
+import pandas as pd
+
+# batches of at least this many rows become a sorted run right away, smaller ones are kept in the tail
+MERGE_MIN_ROWS = 1024
+
+
+def to_epoch_ns(timestamps) -> np.ndarray:
+    """Convert timestamps to UTC epoch nanoseconds. Naive timestamps are considered as UTC."""
+    ts = pd.DatetimeIndex(pd.to_datetime(timestamps, utc=True)).tz_localize(None)
+    return ts.values.astype("datetime64[ns]").view(np.int64)
+
+
+def _objects(values) -> np.ndarray:
+    """Convert to a 1-d array of objects, without breaking list values into another dimension"""
+    return pd.Series(values, dtype=object).to_numpy()
+
+
+class _Run:
+    """A batch of values of a feature, sorted by (entity, timestamp), with the range of every entity in it. It's never
+    modified, so it's shared by the copies of an index."""
+    __slots__ = ("entities", "ids", "ts", "values")
+
+    def __init__(self, ids: np.ndarray, ts: np.ndarray, values: np.ndarray):
+        order = np.lexsort((ts, ids))  # stable, so newer values remain after older ones
+        self.ids = ids[order]
+        self.ts = ts[order]
+        self.values = values[order]
+        starts = np.flatnonzero(np.diff(self.ids, prepend=self.ids[:1] - 1))  # where each entity's range starts
+        ends = np.append(starts[1:], len(self.ids))
+        self.entities = {entity_id: (start, end)
+                         for entity_id, start, end in zip(self.ids[starts].tolist(), starts.tolist(), ends.tolist())}
+
+    def __len__(self):
+        return len(self.ts)
+
+    def merge(self, newer: "_Run") -> "_Run":
+        return _Run(np.concatenate([self.ids, newer.ids]), np.concatenate([self.ts, newer.ts]),
+                    np.concatenate([self.values, newer.values]))
+
+    def last_timestamp(self, entity_id):
+        rng = self.entities.get(entity_id)
+        return None if rng is None else int(self.ts[rng[1] - 1])
+
+    def lookup(self, entity_id, timestamp: int):
+        """The latest (timestamp, value) of the entity as of the timestamp, or None"""
+        rng = self.entities.get(entity_id)
+        if rng is None:
+            return None
+        start, end = rng
+        i = start + int(np.searchsorted(self.ts[start:end], timestamp, side="right")) - 1
+        if i < start:
+            return None
+        return int(self.ts[i]), self.values[i]
+
+
+class FeatureIndex:
+    """The stored values of a single feature, indexed by entity and time for point-in-time lookups.
+
+    The values are kept in sorted runs: columnar arrays sorted by (entity, timestamp), with the range of every entity
+    in them. A batch of values becomes a run of its own, and the last run is merged into the one before it as long as
+    that one is no larger, so the runs grow geometrically: there are a few of them, and every value is merged only a
+    few times, regardless of the number of batches. Small batches (i.e. the values set by instructions one at a time)
+    are kept in a per-entity time-ordered tail, until it's large enough to become a run.
+    """
+
+    def __init__(self):
+        self._runs = []  # from the oldest to the newest
+        self._rows = 0
+        self._tail = {}  # entity id -> ([timestamps], [values]), in time order. It's newer than the runs.
+        self._tail_rows = 0
+
+    def __len__(self):
+        return self._rows + self._tail_rows
+
+    def copy(self) -> "FeatureIndex":
+        """A copy that shares the sorted runs with this index, as they're replaced rather than modified"""
+        idx = FeatureIndex()
+        idx._runs = list(self._runs)
+        idx._rows = self._rows
+        idx._tail = {entity_id: (list(ts), list(values)) for entity_id, (ts, values) in self._tail.items()}
+        idx._tail_rows = self._tail_rows
+        return idx
+
+    def add(self, entity_ids, timestamps, values):
+        """Add values of the feature. Values with the same entity and timestamp as existing ones are considered newer.
+
+        :param timestamps: UTC epoch nanoseconds (see :func:`to_epoch_ns`).
+        """
+        if len(timestamps) >= MERGE_MIN_ROWS:
+            self._seal_tail()  # the tail is older than the batch
+            self._push(_Run(np.asarray(entity_ids, dtype=np.int64), np.asarray(timestamps, dtype=np.int64),
+                            _objects(values)))
+            return
+
+        for entity_id, ts, value in zip(np.asarray(entity_ids).tolist(), np.asarray(timestamps).tolist(), values):
+            tail = self._tail.get(entity_id)
+            if tail is None:
+                self._tail[entity_id] = ([ts], [value])
+            elif ts >= tail[0][-1]:
+                tail[0].append(ts)
+                tail[1].append(value)
+            else:
+                pos = bisect_right(tail[0], ts)
+                tail[0].insert(pos, ts)
+                tail[1].insert(pos, value)
+        self._tail_rows += len(timestamps)
+        if self._tail_rows >= MERGE_MIN_ROWS:
+            self._seal_tail()
+
+    def _seal_tail(self):
+        """Turn the tail into a run"""
+        if self._tail_rows == 0:
+            return
+        ids, ts, vals = [], [], []
+        for entity_id, (tail_ts, tail_values) in self._tail.items():
+            ids.append(np.full(len(tail_ts), entity_id, dtype=np.int64))
+            ts.append(np.asarray(tail_ts, dtype=np.int64))
+            vals.append(_objects(tail_values))
+        self._tail = {}
+        self._tail_rows = 0
+        self._push(_Run(np.concatenate(ids), np.concatenate(ts), np.concatenate(vals)))
+
+    def _push(self, run: _Run):
+        self._runs.append(run)
+        self._rows += len(run)
+        while len(self._runs) > 1 and len(self._runs[-2]) <= len(self._runs[-1]):
+            newer = self._runs.pop()
+            self._runs[-1] = self._runs[-1].merge(newer)
+
+    def last_timestamp(self, entity_id):
+        """The latest timestamp of the entity's values, or None if it has none"""
+        last = None
+        for run in self._runs:
+            ts = run.last_timestamp(entity_id)
+            if ts is not None and (last is None or ts > last):
+                last = ts
+        tail = self._tail.get(entity_id)
+        if tail is not None and (last is None or tail[0][-1] > last):
+            last = tail[0][-1]
+        return last
+
+    def lookup(self, entity_id, timestamp: int, staleness: int = 0):
+        """Get the most recent value of an entity as of the timestamp.
+
+        :param int timestamp: UTC epoch nanoseconds.
+        :param int staleness: in nanoseconds, the maximal age of the value. A non-positive staleness means unbounded.
+        :return: a tuple of (value, timestamp), or None if there's no value
+        """
+        found_ts, found = None, None
+
+        tail = self._tail.get(entity_id)
+        if tail is not None:
+            i = bisect_right(tail[0], timestamp) - 1
+            if i >= 0:
+                found_ts, found = tail[0][i], tail[1][i]
+
+        for run in reversed(self._runs):  # of values with the same timestamp, the newer run's is the most recent
+            res = run.lookup(entity_id, timestamp)
+            if res is not None and (found_ts is None or res[0] > found_ts):
+                found_ts, found = res
+
+        if found_ts is None or (staleness > 0 and found_ts < timestamp - staleness):
+            return None
+        return found, found_ts
@@ -12,23 +12,197 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import contextlib
+import datetime
 import re
+import threading
 
 import pandas as pd
 
-from raptor import types
+from raptor import durpy, storage, types
 
-# registered features
-spec_registry = []
 
+class Session:
+    """An isolated feature store: the registered features, the locally stored feature values, and the replay progress
+    of every feature.
 
-def register_spec(spec):
-    global spec_registry
-    for idx, s in enumerate(spec_registry):
-        if s["fqn"] == spec["fqn"]:
-            spec_registry[idx] = spec
+    Raptor's functions (i.e. `replay`, `historical_get` and :func:`feature_values`) use the session that's active in
+    the current thread, which is the default session unless another one is activated by a `with` block:
+
+        with raptor.Session() as session:
+            my_feature.replay(df)
+
+    A session can be used from concurrent threads. Its changes are serialized, and a replay is a single change: it's
+    applied to a fork of the session, which replaces the session's values and progress at once when the replay is
+    done (or is dropped if it fails). Meanwhile, other threads read the values as they were before the replay, without
+    waiting for it, and their changes wait for it to be done. A `replay_iter` is done when it's exhausted or closed,
+    so it should be consumed by the thread that started it. Replays that should run concurrently need sessions of
+    their own (i.e. forks of a session, see :meth:`fork`).
+
+    The `sqlite` backend can't be forked, so a replay holds the session's lock until it's done, and the other threads
+    wait for it to read the values as well.
+
+    :param str backend: the storage backend of the feature values (see :func:`configure_local_storage`).
+    :param Optional[str] path: the SQLite database file of the `sqlite` backend.
+    """
+
+    def __init__(self, backend: str = "memory", path: str = None):
+        self._lock = threading.RLock()  # held to read or change the state of the session
+        self._write_lock = threading.RLock()  # held throughout a change, i.e. a whole replay
+        self._read_only = False
+        self._backend = _new_backend(backend, path)
+        self._specs = list(active_session()._specs) if _default is not None else []  # the registered features
+        _index_specs(self)
+        self._retention = None  # see `configure_retention`, None keeps all the values
+        self._watermarks = {}
+        self._replay_tails = {}
+
+    def __enter__(self):
+        _active.sessions.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        _active.sessions.pop()
+
+    @property
+    def read_only(self) -> bool:
+        return self._read_only
+
+    def snapshot(self) -> "Session":
+        """A read-only copy of the session, as of now. The copy is cheap: it shares the stored values with the session
+        rather than copying them, so it's a consistent view to read while the session keeps changing."""
+        return self._copy(read_only=True)
+
+    def fork(self) -> "Session":
+        """A copy of the session that can be changed independently of it, i.e. to replay a variant of a feature. The
+        stored values are shared by both sessions, and copied only when either one changes them (copy on write).
+
+        It requires the `memory` storage backend.
+        """
+        return self._copy(read_only=False)
+
+    def _copy(self, read_only: bool) -> "Session":
+        with self._lock:
+            session = Session.__new__(Session)
+            session._lock = threading.RLock()
+            session._write_lock = threading.RLock()
+            session._read_only = read_only
+            session._backend = self._backend.fork()
+            session._specs = list(self._specs)
+            session._features, session._src_names, session._resolved = self._features, self._src_names, {}
+            session._retention = self._retention
+            session._watermarks = dict(self._watermarks)
+            session._replay_tails = dict(self._replay_tails)
+            return session
+
+
+class _Active(threading.local):
+    def __init__(self):
+        self.sessions = []  # the sessions that were activated by the current thread, the innermost last
+
+
+_active = _Active()
+_default = None
+
+
+def active_session() -> Session:
+    """The session that's active in the current thread (see :class:`Session`)"""
+    sessions = _active.sessions
+    return sessions[-1] if len(sessions) > 0 else _default
+
+
+def __writable() -> Session:
+    session = active_session()
+    if session._read_only:
+        raise Exception("The session is a read-only snapshot. Please use `fork()` to get a session that can be changed")
+    return session
+
+
+@contextlib.contextmanager
+def __writing():
+    """Change the active session, after the changes of other threads (i.e. their replays) are done"""
+    session = __writable()
+    with session._write_lock, session._lock:
+        yield session
+
+
+@contextlib.contextmanager
+def __transaction():
+    """Apply the changes of the block (i.e. a replay) to the active session at once, when it's done.
+
+    The block runs with a fork of the session as the active session, and the fork replaces the stored values and the
+    replay progress of the session when the block is done, so other threads keep reading the previous ones until then.
+    If the block fails, the fork is dropped. When the backend can't be forked, the session is locked throughout the
+    block instead.
+    """
+    session = __writable()
+    with session._write_lock:
+        if not session._backend.forkable:
+            with session._lock:
+                yield session
             return
-    spec_registry.append(spec)
+
+        work = session._copy(read_only=False)
+        _active.sessions.append(work)
+        try:
+            yield work
+        finally:
+            if work in _active.sessions:
+                _active.sessions.remove(work)
+        with session._lock:
+            session._backend = work._backend
+            session._watermarks = work._watermarks
+            session._replay_tails = work._replay_tails
+
+
+# the fqns of the features of every FeatureSet that was defined, in any session (see `track_feature_set`)
+_feature_set_fqns = frozenset()
+_feature_sets_lock = threading.Lock()
+
+
+def _index_specs(session: Session):
+    """Index the registered features of the session by fqn and by src_name, and compile the specs that are new.
+
+    The indexes are replaced rather than modified, so they're read without a lock. The cache of the resolved fqns is
+    replaced last, and read first (see :func:`compiled_spec`), so it's never filled from the previous indexes.
+    """
+    previous = getattr(session, "_features", {})
+    features = {}
+    for spec in session._specs:
+        if spec["kind"] == "feature":
+            compiled = previous.get(spec["fqn"])
+            if compiled is None or compiled.spec is not spec:
+                compiled = types.FeatureSpec(spec)
+            features[spec["fqn"]] = compiled
+    session._features = features
+    src_names = {}
+    for compiled in features.values():
+        src_names.setdefault(compiled.src_name, compiled.spec)
+    session._src_names = src_names
+    session._resolved = {}  # by the fqns that were looked up, i.e. of aggregations
+
+
+def register_spec(spec):
+    with __writing() as session:
+        for idx, s in enumerate(session._specs):
+            if s["fqn"] == spec["fqn"]:
+                session._specs[idx] = spec
+                break
+        else:
+            session._specs.append(spec)
+        _index_specs(session)
+
+
+def registered_specs() -> list:
+    """The specs of the features (and feature sets) that are registered in the active session"""
+    return list(active_session()._specs)
+
+
+def restore_specs(specs: list):
+    """Replace the registered specs, i.e. with the ones that were returned by :func:`registered_specs`"""
+    with __writing() as session:
+        session._specs = list(specs)
+        _index_specs(session)
 
 
 def check_valid_fqn(spec, fqn):
@@ -48,27 +222,272 @@ def check_valid_fqn(spec, fqn):
             raise Exception(f"feature `{fqn}` is not a invalid")
 
 
+def compiled_spec(fqn: str) -> types.FeatureSpec:
+    """The compiled spec of a registered feature, by its fqn or the fqn of one of its aggregations"""
+    session = active_session()
+    resolved = session._resolved
+    compiled = resolved.get(fqn)
+    if compiled is None:
+        compiled = session._features.get(fqn.split("[")[0])
+        check_valid_fqn(None if compiled is None else compiled.spec, fqn)
+        resolved[fqn] = compiled
+    return compiled
+
+
 def spec_by_fqn(fqn: str):
-    global spec_registry
-    spec = next(filter(lambda m: m["kind"] == "feature" and m["fqn"] == fqn.split("[")[0], spec_registry), None)
-    check_valid_fqn(spec, fqn)
-    return spec
+    return compiled_spec(fqn).spec
 
 
 def spec_by_src_name(src_name: str):
-    global spec_registry
-    return next(filter(lambda m: m["kind"] == "feature" and m["src_name"] == src_name, spec_registry), None)
+    return active_session()._src_names.get(src_name)
+
+
+def _new_backend(backend: str, path: str = None) -> storage.Backend:
+    if backend == "memory":
+        return storage.MemoryBackend()
+    if backend == "sqlite":
+        if path is None:
+            raise Exception("The `sqlite` backend requires a `path` to the database file")
+        return storage.SQLiteBackend(path)
+    raise Exception(f"Unsupported storage backend `{backend}`. Please use `memory` or `sqlite`")
+
+
+_default = Session()
+
+
+def configure_local_storage(backend: str = "memory", path: str = None):
+    """Configure where the locally calculated feature values of the active session (see :class:`Session`) are stored.
+
+    The values that were stored in the previous backend are not moved to the new one.
 
+    :param str backend: `memory` (default) keeps the values in memory, as pandas dataframes. `sqlite` keeps them in an
+        SQLite database, for stores that don't fit in memory.
+    :param Optional[str] path: the SQLite database file. A database that already has values is used as is.
+    """
+    set_backend(_new_backend(backend, path))
 
-# Calculated feature values
-__feature_values = pd.DataFrame()
+
+def set_backend(backend: storage.Backend):
+    with __writing() as session:
+        session._backend = backend
 
 
 def store_feature_values(feature_values):
-    global __feature_values
-    __feature_values = pd.concat([__feature_values, feature_values])
+    with __writing() as session:
+        session._backend.store(feature_values)
+
+
+def __store_values(fqns: list, entity_ids: list, values: list, timestamps: list):
+    """Store values one by one, i.e. the values that were set by instructions.
+
+    :param timestamps: UTC epoch nanoseconds.
+    """
+    with __writing() as session:
+        session._backend.store_values(fqns, entity_ids, values, timestamps)
+
+
+def __scan(fqns: list = None, since: int = None, until: int = None) -> pd.DataFrame:
+    """The stored values of the fqns (or all of them) within a time range, in UTC epoch nanoseconds. It may be shared,
+    so it must not be modified."""
+    session = active_session()
+    with session._lock:
+        return session._backend.scan(fqns, since, until)
+
+
+def feature_values(fqns: list = None, since=None, until=None, copy=True):
+    """Get the stored feature values.
+
+    :param Optional[list] fqns: get only the values of these features.
+    :param since: get only the values since this time (inclusive).
+    :param until: get only the values until this time (inclusive).
+    :param bool copy: when False, the returned dataframe may be a read-only view of the stored values, which must not be
+        modified. It avoids copying the store when it's only read.
+    """
+    since = None if since is None else pd.Timestamp(since).value
+    until = None if until is None else pd.Timestamp(until).value
+    df = __scan(fqns, since, until)
+    return df.copy() if copy else df
+
+
+def stored_count() -> int:
+    """The sequence number of the last stored feature value. Use it as an offset for :func:`stored_since` and
+    :func:`truncate`."""
+    session = active_session()
+    with session._lock:
+        return session._backend.count()
+
+
+def stored_since(offset: int) -> pd.DataFrame:
+    """The feature values that were stored after the offset, i.e. the effects of a replay"""
+    session = active_session()
+    with session._lock:
+        return session._backend.since(offset)
+
+
+def truncate(offset: int):
+    """Drop the feature values that were stored after the offset, i.e. to roll back the effects of a failed replay"""
+    with __writing() as session:
+        session._backend.truncate(offset)
+
+
+def reset_feature_values(feature_values: pd.DataFrame = None):
+    """Replace all the stored feature values"""
+    with __writing() as session:
+        session._backend.reset(feature_values)
+
+
+def __remove(fqns: list) -> pd.DataFrame:
+    """Drop all the stored values of the features, and return them"""
+    with __writing() as session:
+        return session._backend.remove(fqns)
+
+
+def __dedupe(offset: int):
+    """Drop the values that were stored before the offset, and were stored again after it with the same key"""
+    with __writing() as session:
+        session._backend.dedupe(offset)
+
+
+def load_persisted(readers: dict, rows: int):
+    """Replace all the stored feature values with values that are read from disk on demand (see
+    :meth:`storage.Backend.load`)"""
+    with __writing() as session:
+        session._backend.load(readers, rows)
+
+
+def configure_retention(evict_stale: bool = True, ttl: dict = None, max_rows: dict = None):
+    """Evict the stored values that are no longer needed, so the memory stays flat over long replays. By default,
+    nothing is evicted.
+
+    Values are evicted at the end of every replay (and after every chunk of `replay_file` and `replay_iter`), as of the
+    latest time that was replayed. It assumes the replays progress in time order: a replay of data that is older than
+    the data that was already replayed may not find the values it depends on.
+
+    :param bool evict_stale: evict the values that `f()` can no longer read: the ones older than the staleness of
+        their feature, or all but the latest value of every entity for features without staleness. It applies only to
+        the features that registered features read with `f()`, as of the earliest time that those features were
+        replayed to (by the replay that's evicting, or by previous replays that were stored locally), so the values a
+        feature reads are kept until all of its readers were replayed past them, whatever the order of the replays.
+        The values of the other features (i.e. the ones that are only replayed, or set by instructions) are kept, and
+        so are the values of the features of every FeatureSet that was defined (registered or not), as
+        `historical_get` reads all of them.
+    :param Optional[dict] ttl: the maximal age (i.e. `1h`, or a timedelta) of the values of a feature, by fqn. It
+        applies to the features of a FeatureSet as well.
+    :param Optional[dict] max_rows: the maximal number of values of a feature, by fqn. The oldest are evicted first.
+    """
+    session = __writable()
+    ttl = {fqn: durpy.from_str(t) if isinstance(t, str) else t for fqn, t in (ttl or {}).items()}
+    if not evict_stale and len(ttl) == 0 and not max_rows:
+        session._retention = None
+        return
+    session._retention = {
+        "evict_stale": evict_stale,
+        "ttl": {fqn: int(t.total_seconds() * 1e9) for fqn, t in ttl.items()},
+        "max_rows": dict(max_rows or {}),
+    }
+
+
+def track_feature_set(spec):
+    """Keep the values of the features of a FeatureSet from being evicted as stale, whether it's registered or not"""
+    global _feature_set_fqns
+    with _feature_sets_lock:
+        _feature_set_fqns = _feature_set_fqns | set(spec["src"]) | {spec["options"]["key_feature"]}
+
+
+def __evict(replayed: str, watermark):
+    """Evict the stored values by the retention policy, as of the latest time that a replay of the feature `replayed`
+    replayed. The replay counts as the progress of the feature, whether its values are stored locally or not."""
+    retention = active_session()._retention
+    if retention is None or pd.isna(watermark):
+        return
+    now = pd.Timestamp(watermark).value
+
+    with __writing() as session:
+        if retention["evict_stale"]:
+            readers = {}
+            for reader, compiled in session._features.items():
+                for fqn in compiled.reads:
+                    readers.setdefault(fqn, []).append(reader)
+            for fqn in readers.keys() - _feature_set_fqns:
+                compiled = session._features.get(fqn.split("[")[0])
+                watermarks = [watermark if reader == replayed else session._watermarks.get(reader)
+                              for reader in readers[fqn]]
+                if compiled is None or any(w is None for w in watermarks):
+                    continue  # a reader that wasn't replayed yet may read any of the values
+                as_of = min(pd.Timestamp(w).value for w in watermarks)
+                if compiled.staleness > 0:
+                    session._backend.evict(fqn, as_of - compiled.staleness)
+                else:
+                    session._backend.evict(fqn, as_of, keep_latest=True)
+        for fqn, ttl in retention["ttl"].items():
+            session._backend.evict(fqn, now - ttl)
+        for fqn, max_rows in retention["max_rows"].items():
+            session._backend.evict(fqn, max_rows=max_rows)
+
+
+def __lookup(fqn: str, entity_id, timestamp: int, staleness: int = 0):
+    """Like :func:`lookup`, with UTC epoch nanoseconds for the timestamps and nanoseconds for the staleness"""
+    session = active_session()
+    with session._lock:
+        return session._backend.lookup(fqn, entity_id, timestamp, staleness)
+
+
+def __last_timestamp(fqn: str, entity_id):
+    """The latest timestamp (in UTC epoch nanoseconds) of the stored values of an entity, or None if it has none"""
+    session = active_session()
+    with session._lock:
+        latest = session._backend.latest(fqn, entity_id)
+    return None if latest is None else latest[1]
+
+
+def lookup(fqn: str, entity_id, timestamp, staleness: datetime.timedelta = None):
+    """Get the most recent value of a feature as of the timestamp.
+
+    :param staleness: the maximal age of the value. None, or a non-positive staleness, means unbounded.
+    :return: a tuple of (value, timestamp), or None if there's no value
+    """
+    staleness = 0 if staleness is None else int(staleness.total_seconds() * 1e9)
+    res = __lookup(fqn, entity_id, pd.Timestamp(timestamp).value, staleness)
+    if res is None:
+        return None
+    value, ts = res
+    return value, pd.Timestamp(ts, tz="UTC")
+
+
+# Replay progress of every feature (kept by the session): the latest event time that was replayed, and the replayed
+# raw values that are still within the rolling window of an aggregation (to seed the windows of the next incremental
+# replay).
+def watermark(fqn: str):
+    return active_session()._watermarks.get(fqn)
+
+
+def advance_watermark(fqn: str, ts):
+    if pd.isna(ts):
+        return
+    with __writing() as session:
+        current = session._watermarks.get(fqn)
+        if current is None or ts > current:
+            session._watermarks[fqn] = ts
+
+
+def replay_tail(fqn: str):
+    return active_session()._replay_tails.get(fqn)
+
+
+def set_replay_tail(fqn: str, tail):
+    with __writing() as session:
+        session._replay_tails[fqn] = tail
+
+
+def replay_progress():
+    """The replay progress of every feature, as a tuple of (watermarks, replay tails)"""
+    session = active_session()
+    with session._lock:
+        return dict(session._watermarks), dict(session._replay_tails)
 
 
-def feature_values():
-    global __feature_values
-    return __feature_values.copy()
+def restore_replay_progress(watermarks: dict, replay_tails: dict):
+    """Replace the replay progress of every feature, i.e. with the one that was returned by :func:`replay_progress`"""
+    with __writing() as session:
+        session._watermarks = dict(watermarks)
+        session._replay_tails = dict(replay_tails)
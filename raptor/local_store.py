@@ -0,0 +1,185 @@
+# Copyright (c) 2022 Raptor.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import pickle
+import re
+import shutil
+from functools import partial
+
+import pandas as pd
+
+from . import local_state, ragged
+
+_MANIFEST = "manifest.json"
+_PROGRESS = "progress.pkl"
+_VERSION = 1
+_extensions = {
+    "arrow": ".arrow",
+    "parquet": ".parquet",
+}
+
+
+def _pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError:
+        raise Exception("Persisting the local state requires `pyarrow`. Please install it using `pip install pyarrow`")
+    return pyarrow
+
+
+def _to_arrow(pa, values: pd.Series):
+    """Convert a column to an arrow array, and the encoding of its values.
+
+    Values that can't be represented by a single arrow type (i.e. a mix of numbers and strings) are pickled one by one.
+    """
+    if values.dtype == object:
+        values = pd.Series([v.tolist() if isinstance(v, ragged.ListValue) else v for v in values], dtype=object)
+        values = values.infer_objects()
+    try:
+        return pa.Array.from_pandas(values), "arrow"
+    except (pa.ArrowException, TypeError, ValueError):
+        return pa.array([pickle.dumps(v) for v in values], type=pa.binary()), "pickle"
+
+
+def _from_arrow(pa, column, encoding: str):
+    if encoding == "pickle":
+        return pd.Series([pickle.loads(v) for v in column.to_pylist()], dtype=object)
+    if pa.types.is_list(column.type) or pa.types.is_large_list(column.type):
+        # list values are read as slices of a single buffer, like the ones that were built by `append_feature`
+        column = column.combine_chunks()
+        flat = column.flatten()
+        if pa.types.is_timestamp(flat.type):
+            flat = flat.cast(pa.timestamp("ns", tz=flat.type.tz)).cast(pa.timestamp("ns"))
+        offsets = column.offsets.to_numpy()
+        data = flat.to_numpy(zero_copy_only=False)
+        if data.dtype.kind in "OU":
+            data = data.astype(object)
+        return pd.Series(ragged.from_offsets(data, offsets - offsets[0]), dtype=object)
+    return column.to_pandas()
+
+
+def _write(pa, path: str, fqn: str, df: pd.DataFrame, file_format: str):
+    entity_ids, entity_ids_encoding = _to_arrow(pa, df["entity_id"].reset_index(drop=True))
+    values, values_encoding = _to_arrow(pa, df["value"].reset_index(drop=True))
+    timestamps = pa.Array.from_pandas(pd.to_datetime(df["timestamp"], utc=True).reset_index(drop=True))
+    meta = {"fqn": fqn, "entity_id": entity_ids_encoding, "value": values_encoding}
+    table = pa.table({"entity_id": entity_ids, "value": values, "timestamp": timestamps},
+                     metadata={"raptor": json.dumps(meta)})
+
+    if file_format == "parquet":
+        pa.parquet.write_table(table, path)
+        return
+    with pa.OSFile(path, "wb") as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+
+
+def _read(path: str, file_format: str) -> pd.DataFrame:
+    pa = _pyarrow()
+    if file_format == "parquet":
+        table = pa.parquet.read_table(path, memory_map=True)
+    else:
+        # the file is memory-mapped, so its numeric columns are paged in by the OS rather than copied
+        table = pa.ipc.open_file(pa.memory_map(path, "r")).read_all()
+    meta = json.loads(table.schema.metadata[b"raptor"])
+    return pd.DataFrame({
+        "fqn": meta["fqn"],
+        "entity_id": _from_arrow(pa, table.column("entity_id"), meta["entity_id"]),
+        "value": _from_arrow(pa, table.column("value"), meta["value"]),
+        "timestamp": table.column("timestamp").to_pandas(),
+    })
+
+
+def save_local_state(path: str, file_format: str = "arrow"):
+    """Save the locally stored feature values, and the replay progress of every feature, to a directory.
+
+    The values are saved in a file per feature, so :func:`load_local_state` can read only the features that are used.
+    The directory is replaced as a whole, so it must be empty, or one that a previous call saved to.
+
+    :param str path: the directory to save to.
+    :param str file_format: `arrow` (Arrow IPC files, which are memory-mapped when loaded) or `parquet` (smaller, but
+        slower to load).
+    """
+    if file_format not in _extensions:
+        raise Exception(f"Unsupported file format `{file_format}`. Please use `arrow` or `parquet`")
+    pa = _pyarrow()
+    _check_replaceable(path)
+
+    df = local_state.__scan()  # reads all the values that weren't read yet, in case they were loaded from `path`
+    parent, base = os.path.split(os.path.abspath(path))
+    tmp = os.path.join(parent, f".{base}.raptor-tmp")  # a name of its own, so it's safe to replace
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    try:
+        partitions = []
+        if not df.empty:
+            for i, (fqn, part) in enumerate(df.groupby("fqn", sort=False)):
+                name = re.sub(r"[^\w.-]", "_", fqn)
+                file = f"{i:05d}-{name}{_extensions[file_format]}"
+                _write(pa, os.path.join(tmp, file), fqn, part, file_format)
+                partitions.append({"fqn": fqn, "file": file, "rows": len(part)})
+        pd.to_pickle(local_state.replay_progress(), os.path.join(tmp, _PROGRESS))
+        with open(os.path.join(tmp, _MANIFEST), "w") as f:
+            json.dump({"version": _VERSION, "format": file_format, "partitions": partitions}, f)
+    except BaseException:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp, path)
+
+
+def _check_replaceable(path: str):
+    """Make sure that saving to the path replaces nothing but an empty directory, or a saved local state"""
+    if not os.path.exists(path):
+        return
+    if not os.path.isdir(path):
+        raise Exception(f"`{path}` is not a directory")
+    if len(os.listdir(path)) == 0:
+        return
+    try:
+        with open(os.path.join(path, _MANIFEST), "r") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        manifest = None
+    if not isinstance(manifest, dict) or "version" not in manifest or "partitions" not in manifest:
+        raise Exception(f"`{path}` is not empty, and is not a saved local state. Please save to another directory")
+
+
+def load_local_state(path: str):
+    """Replace the locally stored feature values, and the replay progress, with the ones saved by
+    :func:`save_local_state`.
+
+    Loading is fast regardless of the number of values: the values of a feature are read from disk only when they are
+    used, i.e. by `historical_get`, or by a program that reads them with `f()`.
+
+    :param str path: the directory to load from.
+    """
+    try:
+        with open(os.path.join(path, _MANIFEST), "r") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        raise Exception(f"`{path}` is not a saved local state")
+    if manifest.get("version") != _VERSION:
+        raise Exception(f"`{path}` was saved by an unsupported version of Raptor")
+    _pyarrow()
+
+    readers = {p["fqn"]: partial(_read, os.path.join(path, p["file"]), manifest["format"])
+               for p in manifest["partitions"]}
+    local_state.load_persisted(readers, sum(p["rows"] for p in manifest["partitions"]))
+    local_state.restore_replay_progress(*pd.read_pickle(os.path.join(path, _PROGRESS)))
@@ -0,0 +1,197 @@
+# Copyright (c) 2022 Raptor.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+# the number of most recent timings kept per feature and stage for the percentiles
+MAX_SAMPLES = 4096
+# the number of most recent spans kept for the trace
+MAX_TRACE_EVENTS = 100000
+
+clock = time.perf_counter_ns
+
+enabled = os.environ.get("RAPTOR_PROFILING", "1") != "0"
+
+# the timings are recorded by each thread to its own stages, without locking, and are merged when they're reported
+_lock = threading.Lock()
+_local = threading.local()
+_threads = []
+_trace = collections.deque(maxlen=MAX_TRACE_EVENTS)
+
+
+def enable_profiling(enable: bool = True):
+    """Turn the replay profiler on or off. It's on by default, unless the `RAPTOR_PROFILING` env var is set to 0.
+
+    The profiler records how long each stage of the replay takes, per feature: `serialize` (preparing the requests'
+    payloads for a batch of rows), `request` (building each row's request), `exec` (executing the program, including
+    its dependencies), `dependency` (reading a feature value with `f()`, attributed to the feature that was read),
+    `instructions` (collecting the side effects, i.e. `set_feature`), `flush` (applying the side effects of a batch),
+    `aggregate` and `store`.
+    """
+    global enabled
+    enabled = enable
+
+
+def reset_stats():
+    """Drop all the recorded timings and trace events"""
+    with _lock:
+        for stages in _threads:
+            stages.clear()
+        _trace.clear()
+
+
+def _thread_stages() -> dict:
+    """The stages recorded by the current thread"""
+    stages = getattr(_local, "stages", None)
+    if stages is None:
+        stages = _local.stages = {}
+        with _lock:
+            _threads.append(stages)
+    return stages
+
+
+def _stage(stages: dict, fqn: str, stage: str):
+    s = stages.get((fqn, stage))
+    if s is None:
+        s = {"count": 0, "rows": 0, "total": 0, "max": 0, "samples": collections.deque(maxlen=MAX_SAMPLES)}
+        stages[(fqn, stage)] = s
+    return s
+
+
+def _merge(stages: dict, others: dict):
+    for key, other in others.items():
+        s = _stage(stages, *key)
+        s["count"] += other["count"]
+        s["rows"] += other["rows"]
+        s["total"] += other["total"]
+        s["max"] = max(s["max"], other["max"])
+        s["samples"].extend(other["samples"])
+
+
+def _merged() -> dict:
+    """The stages recorded by all the threads, merged. Must be called with the lock held."""
+    merged = {}
+    for stages in _threads:
+        _merge(merged, dict(stages))
+    return merged
+
+
+def record(fqn: str, stage: str, durations, rows: int = None):
+    """Record the durations (in nanoseconds) of a stage. Each duration is counted as a single row, unless `rows` is
+    given."""
+    if not enabled or len(durations) == 0:
+        return
+    s = _stage(_thread_stages(), fqn, stage)
+    s["count"] += len(durations)
+    s["rows"] += len(durations) if rows is None else rows
+    s["total"] += sum(durations)
+    s["max"] = max(s["max"], max(durations))
+    s["samples"].extend(durations)
+
+
+@contextmanager
+def span(fqn: str, stage: str, rows: int = 0, **args):
+    """Time a block as a single occurrence of a stage, and add it to the trace"""
+    if not enabled:
+        yield args
+        return
+    start = clock()
+    try:
+        yield args
+    finally:
+        duration = clock() - start
+        record(fqn, stage, [duration], rows)
+        _trace.append((stage, fqn, start, duration, os.getpid(), threading.get_ident(), args))
+
+
+def collect():
+    """Drain the recorded timings and trace events, i.e. to send them from a worker process to its parent"""
+    with _lock:
+        ret = _merged(), list(_trace)
+        for stages in _threads:
+            stages.clear()
+        _trace.clear()
+    return ret
+
+
+def merge(collected):
+    """Add timings and trace events that were collected by :func:`collect` in another process"""
+    if not enabled:
+        return
+    stages, trace = collected
+    _merge(_thread_stages(), stages)
+    _trace.extend(trace)
+
+
+def stats(fqn: str = None) -> pd.DataFrame:
+    """Get the replay profiler's statistics, per feature and stage.
+
+    The percentiles are of the most recent occurrences of each stage, and the times are in milliseconds.
+
+    :param Optional[str] fqn: get the statistics of a single feature.
+    :return: pd.DataFrame with the columns fqn, stage, count, rows, total_ms, mean_ms, p50_ms, p90_ms, p99_ms, max_ms
+    """
+    rows = []
+    with _lock:
+        stages = _merged()
+    for (f, stage), s in stages.items():
+        if fqn is not None and f != fqn:
+            continue
+        p50, p90, p99 = np.percentile(np.fromiter(s["samples"], dtype=np.int64, count=len(s["samples"])),
+                                      [50, 90, 99])
+        rows.append({
+            "fqn": f,
+            "stage": stage,
+            "count": s["count"],
+            "rows": s["rows"],
+            "total_ms": s["total"] / 1e6,
+            "mean_ms": s["total"] / s["count"] / 1e6,
+            "p50_ms": p50 / 1e6,
+            "p90_ms": p90 / 1e6,
+            "p99_ms": p99 / 1e6,
+            "max_ms": s["max"] / 1e6,
+        })
+    columns = ["fqn", "stage", "count", "rows", "total_ms", "mean_ms", "p50_ms", "p90_ms", "p99_ms", "max_ms"]
+    return pd.DataFrame(rows, columns=columns)
+
+
+def export_trace(path: str):
+    """Write the most recent profiled spans as a Chrome trace-event JSON file (open it in chrome://tracing or
+    https://ui.perfetto.dev).
+
+    Per-row stages (`request`, `exec`, `instructions` and `dependency`) are not traced one by one, their totals are
+    added to the arguments of the `batch` span they were executed in.
+    """
+    with _lock:
+        trace = list(_trace)
+    events = [{
+        "name": stage,
+        "cat": fqn,
+        "ph": "X",
+        "ts": start / 1e3,
+        "dur": duration / 1e3,
+        "pid": pid,
+        "tid": tid,
+        "args": dict(args, fqn=fqn),
+    } for stage, fqn, start, duration, pid, tid, args in trace]
+    with open(path, "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
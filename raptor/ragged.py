@@ -0,0 +1,168 @@
+# Copyright (c) 2022 Raptor.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+from collections.abc import Sequence
+
+import numpy as np
+import pandas as pd
+
+# a buffer may be extended by the values of sessions that were forked from each other, from concurrent threads
+_lock = threading.Lock()
+_dtypes = {
+    "[]int": np.int64,
+    "[]float": np.float64,
+    "[]str": object,
+    "[]timestamp": "datetime64[ns]",
+}
+
+
+class _Buffer:
+    """A growable typed array, that holds the elements of the lists an entity's values were appended to over time"""
+    __slots__ = ("data", "size")
+
+    def __init__(self, dtype, capacity: int = 8):
+        self.data = np.empty(capacity, dtype=dtype)
+        self.size = 0
+
+    def push(self, value):
+        if self.size == len(self.data):
+            data = np.empty(max(8, len(self.data) * 2), dtype=self.data.dtype)
+            data[:self.size] = self.data[:self.size]
+            self.data = data
+        self.data[self.size] = value
+        self.size += 1
+
+
+class ListValue(Sequence):
+    """The value of a list feature that was built with `append_feature`: a read-only slice of a typed buffer.
+
+    Every value appended to the same list extends the same buffer, so storing the list after every append doesn't copy
+    it over and over again. It behaves like a (read-only) list, and :meth:`tolist` converts it to a list.
+    """
+    __slots__ = ("_buf", "_start", "_end")
+
+    def __init__(self, buf: _Buffer, start: int, end: int):
+        self._buf = buf
+        self._start = start
+        self._end = end
+
+    def __len__(self):
+        return self._end - self._start
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return self.tolist()[item]
+        if item < 0:
+            item += len(self)
+        if item < 0 or item >= len(self):
+            raise IndexError("list index out of range")
+        return _to_python(self._buf.data[self._start + item])
+
+    def __iter__(self):
+        return iter(self.tolist())
+
+    def __eq__(self, other):
+        if isinstance(other, (ListValue, list, tuple)):
+            return self.tolist() == list(other)
+        return NotImplemented
+
+    def __repr__(self):
+        return repr(self.tolist())
+
+    def __reduce__(self):
+        return ListValue, (self._buf, self._start, self._end)
+
+    def array(self) -> np.ndarray:
+        """The elements as a typed array. It's a view of the buffer, so it must not be modified."""
+        return self._buf.data[self._start:self._end]
+
+    def tolist(self) -> list:
+        arr = self.array()
+        if arr.dtype.kind == "M":
+            return list(pd.to_datetime(arr, utc=True))
+        return arr.tolist()
+
+
+def _to_python(v):
+    if isinstance(v, np.datetime64):
+        return pd.Timestamp(v, tz="UTC")
+    if isinstance(v, np.generic):
+        return v.item()
+    return v
+
+
+def _element(primitive: str, value):
+    if primitive == "[]timestamp":
+        ts = pd.Timestamp(value)
+        if ts.tzinfo is not None:
+            ts = ts.tz_convert("UTC").tz_localize(None)
+        return ts.to_datetime64()
+    return value
+
+
+def append(primitive: str, recent, value, max_length: int = None) -> ListValue:
+    """Append a value to a list, and return the new list.
+
+    When `recent` is the latest list its buffer holds, the buffer is extended in place. Otherwise (i.e. it's a plain
+    list, or an older version of the list), its elements are copied to a new buffer.
+
+    :param str primitive: the list primitive of the feature, i.e. `[]int`.
+    :param recent: the list to append to, or None to start a new one.
+    :param Optional[int] max_length: keep only the last `max_length` elements of the list.
+    """
+    try:
+        value = _element(primitive, value)
+        with _lock:
+            extend = isinstance(recent, ListValue) and recent._end == recent._buf.size
+            if extend:
+                buf, start = recent._buf, recent._start
+                buf.push(value)
+        if not extend:
+            elements = [] if recent is None else [_element(primitive, v) for v in recent]
+            if max_length is not None:
+                elements = elements[max(0, len(elements) + 1 - max_length):]
+            buf, start = _Buffer(_dtypes[primitive], max(8, 2 * (len(elements) + 1))), 0
+            for v in elements + [value]:
+                buf.push(v)
+    except (TypeError, ValueError):
+        raise Exception(f"Cannot append `{value}` to a list of {primitive[2:]}")
+
+    end = buf.size
+    if max_length is not None:
+        start = max(start, end - max_length)
+    return ListValue(buf, start, end)
+
+
+def from_offsets(data: np.ndarray, offsets) -> list:
+    """Lists that share a single buffer, i.e. of a columnar list array: the i-th list is data[offsets[i]:offsets[i+1]].
+
+    The data isn't copied until a value is appended to the last list.
+    """
+    buf = _Buffer(data.dtype, 0)
+    buf.data = data
+    buf.size = len(data)
+    offsets = np.asarray(offsets).tolist()
+    return [ListValue(buf, start, end) for start, end in zip(offsets[:-1], offsets[1:])]
+
+
+def json_default(o):
+    """A `default` for `json.dumps`, to serialize list values and their elements"""
+    if isinstance(o, ListValue):
+        return o.tolist()
+    if isinstance(o, pd.Timestamp):
+        return o.isoformat()
+    if isinstance(o, np.generic):
+        return o.item()
+    raise TypeError(f"Object of type {type(o).__name__} is not JSON serializable")
@@ -12,16 +12,22 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import contextlib
 import datetime
 import json
 import types as pytypes
 
+import numpy as np
 import pandas as pd
 from pandas.tseries.frequencies import to_offset
 
-from . import durpy, local_state, replay_instructions, types
+from . import durpy, feature_index, local_state, profiler, ragged, replay_cache, replay_checkpoint, replay_files, \
+    replay_instructions, replay_parallel, runtimes, types
 from .pyexp import pyexp, go
 
+# the default number of rows that are prepared and executed together while replaying
+DEFAULT_CHUNK_SIZE = 10000
+
 
 def __detect_ts_field(df) -> str:
     if 'timestamp' in df.columns:
@@ -68,83 +74,354 @@ def __detect_entity_id(df) -> str:
         return None
 
 
-def new_replay(spec):
-    def _replay(df: pd.DataFrame, timestamp_field: str = None, headers_field: str = None, entity_id_field: str = None,
-                store_locally=True):
-
-        df = df.copy()
-        if spec["kind"] != "feature":
-            raise Exception("Not a Feature")
-
+def __detect_fields(df: pd.DataFrame, timestamp_field: str = None, headers_field: str = None,
+                    entity_id_field: str = None):
+    if timestamp_field is None:
+        timestamp_field = __detect_ts_field(df)
         if timestamp_field is None:
-            timestamp_field = __detect_ts_field(df)
-            if timestamp_field is None:
-                raise Exception("No `timestamp` field detected for the dataframe.\n"
-                                "   Please specify using the `timestamp_field` argument")
-        df[timestamp_field] = pd.to_datetime(df[timestamp_field])  # normalize
+            raise Exception("No `timestamp` field detected for the dataframe.\n"
+                            "   Please specify using the `timestamp_field` argument")
 
+    if entity_id_field is None:
+        entity_id_field = __detect_entity_id(df)
         if entity_id_field is None:
-            entity_id_field = __detect_entity_id(df)
-            if entity_id_field is None:
-                raise Exception("No `entity_id` field detected for the dataframe.\n"
-                                "   Please specify using the `entity_id_field` argument")
+            raise Exception("No `entity_id` field detected for the dataframe.\n"
+                            "   Please specify using the `entity_id_field` argument")
+
+    if headers_field is None:
+        headers_field = __detect_headers_field(df)
+
+    return timestamp_field, headers_field, entity_id_field
+
+
+def __to_feature_values(spec, df: pd.DataFrame, values, timestamp_field: str, entity_id_field: str):
+    """Flip the replayed rows and their values to a feature values dataframe, with the values typed by the primitive"""
+    feature_values = pd.DataFrame({
+        "entity_id": df[entity_id_field].array,
+        "value": types.typed_values(spec["options"]["primitive"], values),
+        "timestamp": pd.to_datetime(df[timestamp_field], utc=True).array,
+    }, index=df.index)
+    return feature_values.dropna(subset=["value"])
+
+
+def __aggregate(spec, feature_values: pd.DataFrame, warm: int = 0):
+    """Calculate the rolling aggregations of the feature values.
+
+    The first `warm` rows only take part in the rolling windows, and are left out of the result.
+    """
+    feature_values = feature_values.reset_index(drop=True)
+    win = to_offset(durpy.from_str(spec["options"]["staleness"]))
+    fields = []
+
+    val_field = "value"
+    if spec["options"]["primitive"] == "string":
+        feature_values["f_value"] = feature_values["value"].factorize()[0]
+        val_field = "f_value"
+
+    # the rolling results are ordered by entity, and are placed back by position (timestamps may repeat across entities)
+    positions = feature_values["entity_id"].sort_values(kind="stable").index.to_numpy()
+    rgb = feature_values.set_index("timestamp").groupby(["entity_id"]).rolling(win)[val_field]
+
+    for aggr in spec["options"]["aggr"]:
+        f = f'{spec["fqn"]}[{aggr.value}]'
+
+        rolled = aggr.apply(rgb).to_numpy()
+        values = np.empty(len(rolled), dtype=rolled.dtype)
+        values[positions] = rolled
+        feature_values[f] = values
+
+        fields.append(f)
+
+    if "f_value" in feature_values.columns:
+        feature_values = feature_values.drop("f_value", axis=1)
+
+    return feature_values.iloc[warm:].drop(columns=["value"]). \
+        melt(id_vars=["timestamp", "entity_id"], value_vars=fields,
+             var_name="fqn", value_name="value")
+
+
+def __aggregate_stream(spec, feature_values: pd.DataFrame, carry: pd.DataFrame = None):
+    """Calculate the rolling aggregations of a chunk of feature values, in continuation of the previous chunks.
+
+    `carry` holds the values of the previous chunks that are still within the rolling window of their entity. The values
+    of each entity are expected to arrive in time order.
+
+    :return: a tuple of (aggregated values, carry for the next chunk)
+    """
+    warm = 0
+    if carry is not None and not carry.empty:
+        warm = len(carry)
+        feature_values = pd.concat([carry, feature_values], ignore_index=True)
 
-        if headers_field is None:
-            headers_field = __detect_headers_field(df)
+    with profiler.span(spec["fqn"], "aggregate", len(feature_values) - warm):
+        aggregated = __aggregate(spec, feature_values, warm)
 
-        rt = pyexp.New(spec["src"].code, spec["fqn"])
+    staleness = durpy.from_str(spec["options"]["staleness"])
+    if staleness.total_seconds() > 0 and not feature_values.empty:
+        latest = feature_values.groupby("entity_id")["timestamp"].transform("max")
+        feature_values = feature_values.loc[feature_values["timestamp"] > latest - staleness]
+    return aggregated, feature_values
 
-        df["__raptor.ret__"] = df.apply(__replay_map(spec, rt, timestamp_field, headers_field, entity_id_field), axis=1)
-        df = df.dropna(subset=['__raptor.ret__'])
 
-        # flip dataframe to feature_value df
-        feature_values = df.filter([entity_id_field, "__raptor.ret__", timestamp_field], axis=1) \
-            .rename(columns={
-            entity_id_field: "entity_id",
-            "__raptor.ret__": "value",
-            timestamp_field: "timestamp",
-        })
+def __exec_rows(spec, rt: pyexp.Runtime, df: pd.DataFrame, timestamp_field: str, headers_field: str,
+                entity_id_field: str, chunk_size: int, errors: list = None, max_errors: int = None):
+    values = []
+    for start in range(0, len(df), chunk_size):
+        chunk = df.iloc[start:start + chunk_size]
+        values.extend(__exec_batch(spec, rt, chunk, timestamp_field, headers_field, entity_id_field, errors,
+                                   max_errors, start))
+    return values
+
+
+def __dead_letters(df: pd.DataFrame, errors: list):
+    """Build a dataframe of the rows that failed, along with their error message and line number"""
+    dead_letters = df.iloc[[pos for pos, _, _ in errors]].copy()
+    dead_letters["__raptor.error__"] = [err for _, err, _ in errors]
+    dead_letters["__raptor.lineno__"] = pd.array([lineno for _, _, lineno in errors], dtype="Int64")
+    return dead_letters
+
+
+def __replay_stream(spec, chunks, timestamp_field: str = None, headers_field: str = None, entity_id_field: str = None,
+                    store_locally=True, chunk_size: int = DEFAULT_CHUNK_SIZE, dedupe=False, evict=True):
+    """Replay a stream of dataframes, and yield the feature values of each of them as soon as they're calculated.
+
+    With `dedupe`, the values that the stream stored replace the ones that were stored before it with the same key,
+    once the stream is done. The replaced values are kept until then, so a stream that fails can be rolled back (see
+    `__replacing`), and the check runs once rather than over the whole store for every dataframe. With `evict`, the
+    stored values are evicted by the retention policy after every dataframe.
+    """
+    if spec["kind"] != "feature":
+        raise Exception("Not a Feature")
+
+    if chunk_size is None or chunk_size < 1:
+        raise Exception("`chunk_size` must be a positive number of rows")
+
+    rt = runtimes.get(spec["src"].code, spec["fqn"])
+    fields = None
+    carry = None
+    offset = local_state.stored_count()
+    for df in chunks:
+        if fields is None:
+            fields = __detect_fields(df, timestamp_field, headers_field, entity_id_field)
+        timestamp_field, headers_field, entity_id_field = fields
+
+        values = __exec_rows(spec, rt, df, timestamp_field, headers_field, entity_id_field, chunk_size)
+        feature_values = __to_feature_values(spec, df, values, timestamp_field, entity_id_field)
+        watermark = pd.to_datetime(df[timestamp_field], utc=True).max()
+        del df, values
 
         if "aggr" not in spec["options"]:
             feature_values.insert(0, "fqn", spec["fqn"])
-            if store_locally:
+        else:
+            feature_values, carry = __aggregate_stream(spec, feature_values, carry)
+
+        if store_locally:
+            with profiler.span(spec["fqn"], "store", len(feature_values)):
                 local_state.store_feature_values(feature_values)
-                fv = local_state.feature_values()
-                return fv.loc[fv["fqn"] == spec["fqn"]]
-            return feature_values
+            __advance(spec, watermark, carry)
+        if evict:
+            local_state.__evict(spec["fqn"], watermark)
+        yield feature_values
+
+    if dedupe:
+        local_state.__dedupe(offset)
+
+
+def __own_fqns(spec) -> list:
+    """The fqns of the feature, and of its aggregations"""
+    return [spec["fqn"]] + [f'{spec["fqn"]}[{aggr.value}]' for aggr in spec["options"].get("aggr", [])]
+
+
+def __own_values(spec, stored: pd.DataFrame):
+    """The values of the feature (and of its aggregations) out of the values that were stored by a replay, including the
+    effects of its instructions on the feature itself"""
+    if stored.empty:
+        return __empty_feature_values(spec)
+    own = stored.loc[stored["fqn"].isin(__own_fqns(spec)), __empty_feature_values(spec).columns]
+    if own["value"].dtype == object:
+        # the values were stored along with values of other features, so they're typed again (aggregations are floats)
+        primitive = "float" if "aggr" in spec["options"] else spec["options"]["primitive"]
+        own = own.assign(value=types.typed_values(primitive, own["value"].tolist()))
+    return own
+
+
+def __empty_feature_values(spec):
+    if "aggr" not in spec["options"]:
+        return pd.DataFrame(columns=["fqn", "entity_id", "value", "timestamp"])
+    return pd.DataFrame(columns=["timestamp", "entity_id", "fqn", "value"])
+
+
+def __advance(spec, watermark, tail: pd.DataFrame = None):
+    """Record the progress of a replay that was stored locally, for the next incremental replay to continue from"""
+    local_state.advance_watermark(spec["fqn"], watermark)
+    if tail is not None:
+        local_state.set_replay_tail(spec["fqn"], tail)
+
+
+def __progress(spec) -> tuple:
+    """The progress of the feature's replays, as a tuple of (watermark, tail), i.e. to cache along with its values"""
+    return local_state.watermark(spec["fqn"]), local_state.replay_tail(spec["fqn"])
+
+
+@contextlib.contextmanager
+def __replacing(spec, replace=True):
+    """Replace the values (and the progress) of a previous replay of the feature with the ones of this replay.
+
+    The previous values of the feature are dropped before the replay starts, so it doesn't read them (i.e. with `f()` or
+    `incr_feature` on the feature itself). Its effects on other features replace the previous ones by their keys (see
+    `local_state.__dedupe`). If the replay fails or is interrupted, the values it stored are rolled back (by their
+    sequence numbers, which remain valid when other values are evicted), and the previous ones are restored.
+
+    The replay (with or without `replace`) is a single change of the session (see `local_state.__transaction`), so other
+    threads don't see its values until it's done, and the values they store wait for it rather than being rolled back
+    along with it, or read by it.
+    """
+    with local_state.__transaction():
+        if not replace:
+            yield
+            return
+        progress = local_state.replay_progress()
+        watermarks, tails = local_state.replay_progress()
+        watermarks.pop(spec["fqn"], None)
+        tails.pop(spec["fqn"], None)
+        local_state.restore_replay_progress(watermarks, tails)
+        previous = local_state.__remove(__own_fqns(spec))
+        offset = local_state.stored_count()
+        try:
+            yield
+        except BaseException:  # i.e. a `replay_iter` that was closed before it was done
+            local_state.truncate(offset)
+            local_state.store_feature_values(previous)
+            local_state.restore_replay_progress(*progress)
+            raise
 
-        # aggregations
-        feature_values = feature_values.set_index('timestamp')
-        win = to_offset(durpy.from_str(spec["options"]["staleness"]))
-        fields = []
 
-        val_field = "value"
-        if spec["options"]["primitive"] == "string":
-            feature_values["f_value"] = feature_values["value"].factorize()[0]
-            val_field = "f_value"
+def __store_cached(stored: pd.DataFrame):
+    """Restore the effects of a cached replay on the local state, as if the replay was executed again"""
+    if not stored.empty:
+        local_state.store_feature_values(stored)
 
-        for aggr in spec["options"]["aggr"]:
-            f = f'{spec["fqn"]}[{aggr.value}]'
 
-            feature_values[f] = aggr.apply(feature_values.groupby(["entity_id"]).rolling(win)[val_field]). \
-                reset_index(0, drop=True)
+def __caller_exception(spec, e: Exception):
+    """Re-raise an exception as if it was raised by the caller of the public API"""
+    back_frame = e.__traceback__.tb_frame.f_back
+    tb = pytypes.TracebackType(tb_next=None,
+                               tb_frame=back_frame,
+                               tb_lasti=back_frame.f_lasti,
+                               tb_lineno=back_frame.f_lineno)
+    return Exception(f"{spec['src_name']}: {str(e)}").with_traceback(tb)
 
-            fields.append(f)
 
-        if "f_value" in feature_values.columns:
-            feature_values = feature_values.drop("f_value", axis=1)
+def new_replay(spec):
+    def _replay(df: pd.DataFrame, timestamp_field: str = None, headers_field: str = None, entity_id_field: str = None,
+                store_locally=True, chunk_size: int = DEFAULT_CHUNK_SIZE, workers: int = None,
+                shard_by: str = "entity", shards: int = None, split: str = "rows", cache=False, incremental=False,
+                checkpoint_dir: str = None, checkpoint_every: int = replay_checkpoint.DEFAULT_CHECKPOINT_EVERY,
+                on_error: str = "raise", max_errors: int = None):
+
+        if spec["kind"] != "feature":
+            raise Exception("Not a Feature")
+        if on_error not in ("raise", "collect"):
+            raise Exception(f"Unknown error mode `{on_error}`. Use `raise` or `collect`")
+        errors = [] if on_error == "collect" else None
+
+        timestamp_field, headers_field, entity_id_field = __detect_fields(df, timestamp_field, headers_field,
+                                                                          entity_id_field)
+
+        if chunk_size is None or chunk_size < 1:
+            raise Exception("`chunk_size` must be a positive number of rows")
+
+        watermark = None
+        if incremental:
+            watermark = local_state.watermark(spec["fqn"])
+            if watermark is not None:
+                df = df.loc[pd.to_datetime(df[timestamp_field], utc=True) > watermark]
+            if df.empty:
+                ret = __empty_feature_values(spec)
+                return (ret, __dead_letters(df, [])) if errors is not None else ret
+
+        parallel = workers is not None and workers > 1
+        if parallel and checkpoint_dir is not None:
+            raise Exception("Checkpoints are not supported for a parallel replay")
+
+        cache_key = None
+        if cache:
+            cache_key = replay_cache.fingerprint(spec, replay_cache.dataframe_digest(df),
+                                                 timestamp_field=timestamp_field, headers_field=headers_field,
+                                                 entity_id_field=entity_id_field, store_locally=store_locally,
+                                                 shard_by=shard_by if parallel else None, watermark=watermark,
+                                                 on_error=on_error, max_errors=max_errors)
+            cached = replay_cache.load(spec["fqn"], cache_key)
+            if cached is not None:
+                feature_values, stored, dead_letters, progress = cached
+                offset = local_state.stored_count()
+                __store_cached(stored)
+                if store_locally:
+                    __advance(spec, *progress)
+                if store_locally and not incremental:
+                    local_state.__dedupe(offset)
+                ret = __own_values(spec, stored) if store_locally else feature_values
+                return (ret, dead_letters) if errors is not None else ret
+        stored_offset = local_state.stored_count()
+
+        if parallel:
+            if shards is None:
+                shards = workers
+            if shard_by == "entity":
+                shards = replay_parallel.shard_by_entity(df, entity_id_field, shards)
+            elif shard_by == "time":
+                shards = replay_parallel.shard_by_time(df, timestamp_field, shards, split,
+                                                       replay_parallel.time_warmup(spec))
+            else:
+                raise Exception(f"Unknown sharding `{shard_by}`. Use `entity` or `time`")
+            values = replay_parallel.exec_shards(spec, df, shards, timestamp_field, headers_field, entity_id_field,
+                                                 chunk_size, workers, errors, max_errors)
+        elif checkpoint_dir is not None:
+            checkpoint_key = replay_cache.fingerprint(spec, replay_cache.dataframe_digest(df), dependencies=False,
+                                                      timestamp_field=timestamp_field, headers_field=headers_field,
+                                                      entity_id_field=entity_id_field, on_error=on_error)
+            if checkpoint_key is None:
+                raise Exception("The dataframe's values can't be digested to identify its checkpoints")
+            rt = runtimes.get(spec["src"].code, spec["fqn"])
+            values = replay_checkpoint.exec_rows(spec, rt, df, checkpoint_dir, checkpoint_key, timestamp_field,
+                                                 headers_field, entity_id_field, chunk_size, checkpoint_every, errors,
+                                                 max_errors)
+        else:
+            rt = runtimes.get(spec["src"].code, spec["fqn"])
+            values = __exec_rows(spec, rt, df, timestamp_field, headers_field, entity_id_field, chunk_size, errors,
+                                 max_errors)
+
+        feature_values = __to_feature_values(spec, df, values, timestamp_field, entity_id_field)
+
+        tail = None
+        if "aggr" not in spec["options"]:
+            feature_values.insert(0, "fqn", spec["fqn"])
+        else:
+            seed = local_state.replay_tail(spec["fqn"]) if incremental else None
+            feature_values, tail = __aggregate_stream(spec, feature_values, seed)
 
-        feature_values = feature_values.reset_index().drop(columns=["value"]). \
-            melt(id_vars=["timestamp", "entity_id"], value_vars=fields,
-                 var_name="fqn", value_name="value")
         if store_locally:
-            local_state.store_feature_values(feature_values)
-            fv = local_state.feature_values()
-            return fv.loc[fv["fqn"] == spec["fqn"]]
-        return feature_values
+            with profiler.span(spec["fqn"], "store", len(feature_values)):
+                local_state.store_feature_values(feature_values)
+            __advance(spec, pd.to_datetime(df[timestamp_field], utc=True).max(), tail)
+        dead_letters = __dead_letters(df, errors) if errors is not None else None
+        stored = local_state.stored_since(stored_offset)
+        if cache_key is not None:
+            replay_cache.save(spec["fqn"], cache_key, feature_values, stored, dead_letters, __progress(spec))
+        if checkpoint_dir is not None:
+            replay_checkpoint.complete(checkpoint_dir, checkpoint_key)
+        if store_locally and not incremental:
+            local_state.__dedupe(stored_offset)
+        local_state.__evict(spec["fqn"], pd.to_datetime(df[timestamp_field], utc=True).max())
+
+        ret = __own_values(spec, stored) if store_locally else feature_values
+        return (ret, dead_letters) if errors is not None else ret
 
     def replay(df: pd.DataFrame, timestamp_field: str = None, headers_field: str = None, entity_id_field: str = None,
-               store_locally=True):
+               store_locally=True, chunk_size: int = DEFAULT_CHUNK_SIZE, workers: int = None,
+               shard_by: str = "entity", shards: int = None, split: str = "rows", cache=False, incremental=False,
+               checkpoint_dir: str = None, checkpoint_every: int = replay_checkpoint.DEFAULT_CHECKPOINT_EVERY,
+               on_error: str = "raise", max_errors: int = None):
         """Replay a dataframe on the feature definition to create features values from existing data.
 
         :param pd.DataFrame df: pandas dataframe with the data to replay
@@ -153,94 +430,319 @@ def new_replay(spec):
         :param Optional[str] entity_id_field: the name of the column containing the entity id of the data.
         :param bool store_locally: Store the data locally in the feature values (this is required for working with other
             capabilities such as using the feature as a dependency or adding the data to a FeatureSet). Default is True.
-        :return: pd.DataFrame with the calculated feature values
+        :param int chunk_size: the number of rows that are prepared and executed together in a single batch.
+        :param Optional[int] workers: when set to more than 1, the dataframe is split into shards that are replayed in
+            parallel by a pool of worker processes.
+        :param str shard_by: how to split the dataframe when replaying in parallel:
+            - `entity` (default): hash-partition the rows by the entity id. Dependencies (`f()`) and the effects of
+              `set_feature`/`incr_feature`/etc. are visible only within the shard of the entity that produced them.
+            - `time`: split the rows into time ranges. Each range is warmed up with the rows of the preceding period
+              of the largest staleness of the feature and of the features it reads (`f()`) or sets, or with all the
+              preceding rows when any of them has no staleness, so the values read at the range boundaries match a
+              sequential replay. Programs that use `incr_feature` or `append_feature` can't be sharded by time.
+        :param Optional[int] shards: the number of shards to split the dataframe into. Default is the number of workers.
+        :param str split: when sharding by time, `rows` (default) splits into ranges with an equal number of rows, and
+            `time` splits into ranges of an equal time span.
+        :param bool cache: reuse the results of a previous replay of the same data, arguments and feature definition
+            from the on-disk replay cache, or cache the results of this replay for the next time. Default is False.
+            See :func:`configure_replay_cache` and :func:`invalidate_replay_cache`.
+        :param bool incremental: replay only the rows that are newer than the latest event time this feature was
+            replayed and stored locally with. The rolling windows of aggregations continue from the values of the
+            previous replay, and instructions (i.e. `incr_feature`) continue from the locally stored values.
+            Default is False.
+        :param Optional[str] checkpoint_dir: a directory to checkpoint the progress of the replay in. When a replay with
+            the same data and arguments fails (or the kernel dies), calling it again resumes from its last checkpoint.
+            The effects of a failed replay are rolled back from the local state, and are restored when it's resumed.
+        :param int checkpoint_every: the number of rows between checkpoints. Default is 100000.
+        :param str on_error: what to do when the feature program fails on a row:
+            - `raise` (default): stop the replay and raise the error.
+            - `collect`: skip the row (it gets no value) and continue. The failing rows are returned in a dead-letter
+              dataframe, along with the error message (`__raptor.error__`) and the PyExp line number
+              (`__raptor.lineno__`).
+        :param Optional[int] max_errors: when collecting errors, stop the replay and raise once there are more than
+            `max_errors` failing rows. Default is no limit.
+        :return: pd.DataFrame with the feature values calculated by this replay. When `on_error="collect"`, a tuple of
+            the feature values and the dead-letter dataframe.
         """
 
         try:
-            return _replay(df, timestamp_field, headers_field, entity_id_field, store_locally)
+            # an incremental replay continues the previous one, rather than replacing it
+            with __replacing(spec, store_locally and not incremental):
+                return _replay(df, timestamp_field, headers_field, entity_id_field, store_locally, chunk_size, workers,
+                               shard_by, shards, split, cache, incremental, checkpoint_dir, checkpoint_every, on_error,
+                               max_errors)
         except Exception as e:
-            back_frame = e.__traceback__.tb_frame.f_back
-            tb = pytypes.TracebackType(tb_next=None,
-                                       tb_frame=back_frame,
-                                       tb_lasti=back_frame.f_lasti,
-                                       tb_lineno=back_frame.f_lineno)
-            raise Exception(f"{spec['src_name']}: {str(e)}").with_traceback(tb)
+            raise __caller_exception(spec, e)
 
     return replay
 
 
+def new_replay_file(spec):
+    def _replay_file(path_or_glob: str, timestamp_field: str = None, headers_field: str = None,
+                     entity_id_field: str = None, store_locally=True, chunk_size: int = DEFAULT_CHUNK_SIZE,
+                     memory_budget=replay_files.DEFAULT_MEMORY_BUDGET, file_format: str = None, cache=False):
+        cache_key = None
+        if cache:
+            cache_key = replay_cache.fingerprint(spec, replay_cache.files_digest(path_or_glob),
+                                                 timestamp_field=timestamp_field, headers_field=headers_field,
+                                                 entity_id_field=entity_id_field, store_locally=store_locally,
+                                                 file_format=file_format)
+            cached = replay_cache.load(spec["fqn"], cache_key)
+            if cached is not None:
+                feature_values, stored, _, progress = cached
+                offset = local_state.stored_count()
+                __store_cached(stored)
+                if store_locally:
+                    __advance(spec, *progress)
+                    local_state.__dedupe(offset)
+                return feature_values
+        stored_offset = local_state.stored_count()
+
+        chunks = replay_files.read_chunks(path_or_glob, memory_budget, file_format)
+        # a cached replay keeps the values it stored until it's done, so they can be cached
+        results = list(__replay_stream(spec, chunks, timestamp_field, headers_field, entity_id_field, store_locally,
+                                       chunk_size, dedupe=store_locally, evict=cache_key is None))
+        if len(results) == 0:
+            raise Exception(f"No data found in `{path_or_glob}`")
+        feature_values = pd.concat(results, ignore_index=True)
+
+        if cache_key is not None:
+            replay_cache.save(spec["fqn"], cache_key, feature_values, local_state.stored_since(stored_offset),
+                              progress=__progress(spec))
+        return feature_values
+
+    def replay_file(path_or_glob: str, timestamp_field: str = None, headers_field: str = None,
+                    entity_id_field: str = None, store_locally=True, chunk_size: int = DEFAULT_CHUNK_SIZE,
+                    memory_budget=replay_files.DEFAULT_MEMORY_BUDGET, file_format: str = None, cache=False):
+        """Replay Parquet or CSV files on the feature definition, without loading them into memory as a whole.
+
+        The files are streamed in chunks sized to fit the memory budget (Parquet files by their row groups, CSV files
+        by blocks of rows), and the rolling windows of aggregations are carried over from one chunk to the next, so
+        the values are the same as replaying all the data at once. The files are expected to be sorted by time.
+
+        :param str path_or_glob: a path of a file, or a glob pattern matching multiple files (read in lexical order).
+        :param Optional[str] timestamp_field: the name of the column containing the timestamp of the data.
+        :param Optional[str] headers_field: the name of the column containing the headers of the data.
+        :param Optional[str] entity_id_field: the name of the column containing the entity id of the data.
+        :param bool store_locally: Store the data locally in the feature values. Default is True.
+        :param int chunk_size: the number of rows that are prepared and executed together in a single batch.
+        :param int|str memory_budget: the approximate memory to use for the input data, in bytes or as a string with
+            units (i.e. `512MB`, `2GB`). Default is 256MB.
+        :param Optional[str] file_format: `parquet` or `csv`. Detected from the file extension when not specified.
+        :param bool cache: reuse the results of a previous replay of the same files, arguments and feature definition
+            from the on-disk replay cache, or cache the results of this replay for the next time. The files are
+            identified by their path, size and modification time. Default is False.
+        :return: pd.DataFrame with the calculated feature values. It holds the values of all the files, so they must fit
+            in memory; use :func:`replay_file_iter` to consume them chunk by chunk instead.
+        """
+
+        try:
+            with __replacing(spec, store_locally):
+                return _replay_file(path_or_glob, timestamp_field, headers_field, entity_id_field, store_locally,
+                                    chunk_size, memory_budget, file_format, cache)
+        except Exception as e:
+            raise __caller_exception(spec, e)
+
+    return replay_file
+
+
+def new_replay_file_iter(spec):
+    def replay_file_iter(path_or_glob: str, timestamp_field: str = None, headers_field: str = None,
+                         entity_id_field: str = None, store_locally=False, chunk_size: int = DEFAULT_CHUNK_SIZE,
+                         memory_budget=replay_files.DEFAULT_MEMORY_BUDGET, file_format: str = None):
+        """Replay Parquet or CSV files on the feature definition, and yield the calculated feature values chunk by
+        chunk (see :func:`replay_file`), so neither the files nor the values have to fit in memory as a whole.
+
+        :param str path_or_glob: a path of a file, or a glob pattern matching multiple files (read in lexical order).
+        :param Optional[str] timestamp_field: the name of the column containing the timestamp of the data.
+        :param Optional[str] headers_field: the name of the column containing the headers of the data.
+        :param Optional[str] entity_id_field: the name of the column containing the entity id of the data.
+        :param bool store_locally: Store the yielded values locally in the feature values as well. Default is False.
+            Regardless of this option, the effects of `set_feature`/`incr_feature`/etc. are stored locally.
+        :param int chunk_size: the number of rows that are prepared and executed together in a single batch.
+        :param int|str memory_budget: the approximate memory to use for the input data, in bytes or as a string with
+            units (i.e. `512MB`, `2GB`). Default is 256MB.
+        :param Optional[str] file_format: `parquet` or `csv`. Detected from the file extension when not specified.
+        :return: a generator of pd.DataFrame chunks with the calculated feature values
+        """
+
+        try:
+            chunks = replay_files.read_chunks(path_or_glob, memory_budget, file_format)
+            empty = True
+            with __replacing(spec, store_locally):
+                for feature_values in __replay_stream(spec, chunks, timestamp_field, headers_field, entity_id_field,
+                                                      store_locally, chunk_size, dedupe=store_locally):
+                    empty = False
+                    yield feature_values
+                if empty:
+                    raise Exception(f"No data found in `{path_or_glob}`")
+        except Exception as e:
+            raise __caller_exception(spec, e)
+
+    return replay_file_iter
+
+
+def new_replay_iter(spec):
+    def replay_iter(df: pd.DataFrame, timestamp_field: str = None, headers_field: str = None,
+                    entity_id_field: str = None, store_locally=False, chunk_size: int = DEFAULT_CHUNK_SIZE):
+        """Replay a dataframe on the feature definition, and yield the calculated feature values batch by batch.
+
+        Unlike :func:`replay`, the values are not collected nor stored locally by default, so a consumer that writes
+        them elsewhere runs in constant memory. The values of aggregated features are calculated in continuation of
+        the previous batches, so the values of each entity are expected to be sorted by time.
+
+        :param pd.DataFrame df: pandas dataframe with the data to replay
+        :param Optional[str] timestamp_field: the name of the column containing the timestamp of the data.
+        :param Optional[str] headers_field: the name of the column containing the headers of the data.
+        :param Optional[str] entity_id_field: the name of the column containing the entity id of the data.
+        :param bool store_locally: Store the yielded values locally in the feature values as well. Default is False.
+            Regardless of this option, the effects of `set_feature`/`incr_feature`/etc. are stored locally.
+        :param int chunk_size: the number of rows in each batch.
+        :return: a generator of pd.DataFrame batches with the calculated feature values
+        """
+
+        try:
+            if chunk_size is None or chunk_size < 1:
+                raise Exception("`chunk_size` must be a positive number of rows")
+            chunks = (df.iloc[start:start + chunk_size] for start in range(0, len(df), chunk_size))
+            with __replacing(spec, store_locally):
+                yield from __replay_stream(spec, chunks, timestamp_field, headers_field, entity_id_field,
+                                           store_locally, chunk_size, dedupe=store_locally)
+        except Exception as e:
+            raise __caller_exception(spec, e)
+
+    return replay_iter
+
+
+# Times are UTC epoch nanoseconds all the way through, and are converted to and from PyExp times only when they cross
+# into PyExp.
+def __py_time(ts: int):
+    """The PyExp time of a timestamp in UTC epoch nanoseconds"""
+    return pyexp.PyTime(pd.Timestamp(ts, tz="UTC").isoformat("T"), "")
+
+
+def __rfc3339(timestamps: np.ndarray) -> list:
+    """Format UTC epoch nanoseconds as RFC 3339 times, for the whole array at once"""
+    return np.datetime_as_string(timestamps.astype("datetime64[ns]"), unit="ns", timezone="UTC").tolist()
+
+
 def __dependency_getter(fqn, eid, ts, val):
+    start = profiler.clock()
     try:
-        spec = local_state.spec_by_fqn(fqn)
+        spec = local_state.compiled_spec(fqn)
         if spec is None:
             raise Exception(f"feature `{fqn}` is not registered locally")
 
-        ts = pd.to_datetime(ts)
-
-        df = local_state.__feature_values
-        df = df.loc[(df["fqn"] == fqn) & (df["entity_id"] == eid) & (df["timestamp"] <= ts)]
-
-        staleness = durpy.from_str(spec["options"]["staleness"])
-        if staleness.total_seconds() > 0:
-            df = df.loc[(df["timestamp"] >= ts - staleness)]
+        ts = pd.Timestamp(ts).value
 
-        df = df.sort_values(by=["timestamp"], ascending=False).head(1)
-        if df.empty:
+        if replay_instructions.pending(fqn):
+            replay_instructions.flush()
+        res = local_state.__lookup(fqn, eid, ts, spec.staleness)
+        if res is None:
             return str.encode("")
-        res = df.iloc[0]
+        value, timestamp = res
 
         v = pyexp.PyVal(handle=val)
 
-        v.Value = json.dumps(res["value"])
-        v.Timestamp = pyexp.PyTime(res["timestamp"].isoformat("T"), "")
+        v.Value = json.dumps(value, default=ragged.json_default)
+        v.Timestamp = __py_time(timestamp)
         v.Fresh = True
 
-        freshness = durpy.from_str(spec["options"]["freshness"])
-        if freshness.total_seconds() > 0:
-            v.Fresh = res["timestamp"] >= ts - freshness
+        if spec.freshness > 0:
+            v.Fresh = timestamp >= ts - spec.freshness
 
     except Exception as e:
         """return error"""
         return str.encode(str(e))
+    finally:
+        profiler.record(fqn, "dependency", [profiler.clock() - start])
 
     return str.encode("")
 
 
-def __replay_map(spec, rt: pyexp.Runtime, timestamp_field: str, headers_field: str = None, entity_id_field: str = None):
-    def map(row: pd.Series):
-        ts = row[timestamp_field]
-        # row = row.drop(timestamp_field)
+def __exec_batch(spec, rt: pyexp.Runtime, chunk: pd.DataFrame, timestamp_field: str, headers_field: str = None,
+                 entity_id_field: str = None, errors: list = None, max_errors: int = None, offset: int = 0):
+    """Execute the feature program over a chunk of rows, and return the values in the rows order.
 
-        headers = go.nil
-        if headers_field is not None:
-            headers = row[headers_field]
-            # row = row.drop(headers_field)
+    The request arguments are prepared for the whole chunk at once (a single JSON serialization, a single pass over the
+    timestamps), so the per-row work is left to the PyExp execution itself.
 
-        entity_id = ""
-        if entity_id_field is not None:
-            entity_id = row[entity_id_field]
-            # row = row.drop(entity_id_field)
+    When `errors` is given, failing rows get a None value and are appended to it as (offset + position in the chunk,
+    error message, line number) tuples, instead of raising. Once there are more than `max_errors` of them, it raises.
+    """
+    if chunk.empty:
+        return []
 
-        if isinstance(ts, datetime.datetime):
-            ts = ts.isoformat("T")
+    fqn = spec["fqn"]
+    with profiler.span(fqn, "batch", len(chunk)) as trace_args:
+        with profiler.span(fqn, "serialize", len(chunk)):
+            if not isinstance(chunk[timestamp_field].dtype, pd.DatetimeTZDtype):
+                chunk = chunk.assign(**{timestamp_field: pd.to_datetime(chunk[timestamp_field], utc=True)})  # in UTC
 
-        req = pyexp.PyExecReq(row.to_json(), __dependency_getter)
-        req.Timestamp = pyexp.PyTime(ts, "")
-        req.EntityID = entity_id
-        req.Headers = headers
+            payloads = chunk.to_json(orient="records", lines=True).split("\n")
+            if payloads[-1] == "":
+                payloads.pop()
 
-        try:
-            res = rt.Exec(req)
-            for i in res.Instructions:
-                inst = pyexp.Instruction(handle=i)
-                replay_instructions.__exec_instruction(inst)
-            return json.loads(pyexp.JsonAny(res, "Value"))
-        except RuntimeError as e:
-            raise types.WrapException(e, spec)
-        except Exception as err:
-            raise err
+            timestamps = __rfc3339(feature_index.to_epoch_ns(chunk[timestamp_field]))
+
+            entity_ids = [""] * len(chunk)
+            if entity_id_field is not None:
+                entity_ids = chunk[entity_id_field].tolist()
+
+            headers = [go.nil] * len(chunk)
+            if headers_field is not None:
+                headers = chunk[headers_field].tolist()
 
-    return map
+        # the per-row stages are timed on every row, and recorded once for the whole batch
+        clock = profiler.clock
+        request_ns, exec_ns, instructions_ns = [], [], []
+
+        values = []
+        try:
+            for payload, ts, entity_id, header in zip(payloads, timestamps, entity_ids, headers):
+                t0 = clock()
+                req = pyexp.PyExecReq(payload, __dependency_getter)
+                req.Timestamp = pyexp.PyTime(ts, "")
+                req.EntityID = entity_id
+                req.Headers = header
+                t1 = clock()
+                request_ns.append(t1 - t0)
+
+                try:
+                    res = rt.Exec(req)
+                    t2 = clock()
+                    exec_ns.append(t2 - t1)
+                    for i in res.Instructions:
+                        inst = pyexp.Instruction(handle=i)
+                        replay_instructions.__exec_instruction(inst)
+                    instructions_ns.append(clock() - t2)
+                    values.append(json.loads(pyexp.JsonAny(res, "Value")))
+                    continue
+                except RuntimeError as e:
+                    if errors is None:
+                        raise types.WrapException(e, spec)
+                    err = e
+                except Exception as e:
+                    if errors is None:
+                        raise e
+                    err = e
+
+                values.append(None)
+                errors.append((offset + len(values) - 1,) + types.ErrorDetails(err, spec))
+                if max_errors is not None and len(errors) > max_errors:
+                    raise Exception(f"Too many errors ({len(errors)}). The last error was: {errors[-1][1]}")
+        finally:
+            # the instructions are applied even if a row failed, as the rows before it are done
+            with profiler.span(fqn, "flush"):
+                replay_instructions.flush()
+
+        profiler.record(fqn, "request", request_ns)
+        profiler.record(fqn, "exec", exec_ns)
+        profiler.record(fqn, "instructions", instructions_ns)
+        trace_args.update(request_ms=sum(request_ns) / 1e6, exec_ms=sum(exec_ns) / 1e6,
+                          instructions_ms=sum(instructions_ns) / 1e6)
+
+    return values
 
 
 def new_historical_get(spec):
@@ -267,40 +769,43 @@ def new_historical_get(spec):
         if key_feature in features:
             features.remove(key_feature)
 
-        df = local_state.feature_values()
-        if df.empty:
+        if local_state.stored_count() == 0:
             raise Exception("No data found. Have you Replayed on your data?")
 
-        df = df.loc[(df["fqn"].isin(features + [key_feature]))
-                    & (df["timestamp"] >= since)
-                    & (df["timestamp"] <= until)
-                    ]
-
-        if df.empty:
+        # the values of each feature are read on their own, so they keep the dtype of its primitive
+        frames = {f: local_state.feature_values([f], since, until, copy=False) for f in [key_feature] + features}
+        if all(f_df.empty for f_df in frames.values()):
             raise Exception("No data found")
 
-        key_df = df.loc[df["fqn"] == key_feature]
+        # the features are joined on int codes of the entity ids, and on epoch nanoseconds, which are translated back
+        # at the end. Of the values with the same key, the one that was stored last is used, like `f()` does.
+        codes, entity_ids = pd.factorize(pd.concat([f_df["entity_id"] for f_df in frames.values()], ignore_index=True))
+        offset = 0
+        for f, f_df in frames.items():
+            f_df = f_df.assign(entity_id=codes[offset:offset + len(f_df)],
+                               timestamp=feature_index.to_epoch_ns(f_df["timestamp"])).drop(columns=["fqn"])
+            offset += len(f_df)
+            frames[f] = f_df.drop_duplicates(["entity_id", "timestamp"], keep="last")
 
-        key_df = key_df.rename(columns={"value": key_feature})
-        key_df = key_df.drop(columns=["fqn"])
+        key_df = frames[key_feature].rename(columns={"value": key_feature})
 
         for f in features:
-            f_spec = local_state.spec_by_fqn(f)
-            f_staleness = durpy.from_str(f_spec["options"]["staleness"])
+            f_staleness = local_state.compiled_spec(f).staleness
 
-            f_df = df.loc[df["fqn"] == f]
-            f_df = f_df.rename(columns={"value": f})
-            f_df = f_df.drop(columns=["fqn"])
+            f_df = frames[f].rename(columns={"value": f})
             # f_df["start_ts"] = f_df["end_ts"] - f_staleness
 
-            if f_staleness.total_seconds() > 0:
+            if f_staleness > 0:
                 key_df = pd.merge_asof(key_df.sort_values("timestamp"), f_df.sort_values("timestamp"), on="timestamp",
                                        by="entity_id", direction="nearest", tolerance=f_staleness)
             else:
                 key_df = pd.merge_asof(key_df.sort_values("timestamp"), f_df.sort_values("timestamp"), on="timestamp",
                                        by="entity_id", direction="nearest")
 
-        return key_df.reset_index(drop=True)
+        key_df = key_df.reset_index(drop=True)
+        key_df["entity_id"] = entity_ids.take(key_df["entity_id"].to_numpy())
+        key_df["timestamp"] = pd.to_datetime(key_df["timestamp"], utc=True)
+        return key_df
 
     def historical_get(since: datetime.datetime, until: datetime.datetime):
         """
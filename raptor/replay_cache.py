@@ -0,0 +1,191 @@
+# Copyright (c) 2022 Raptor.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import glob
+import hashlib
+import json
+import os
+import re
+import shutil
+
+import pandas as pd
+
+from . import local_state, ragged, replay_files
+
+DEFAULT_MAX_SIZE = 2 * 1024 ** 3
+# the cache keeps its entries in a directory of its own within the cache directory, with a suffix of their own, so
+# invalidating and evicting never remove files it didn't create
+_ENTRIES_DIR = "raptor-replay-cache"
+_ENTRY_SUFFIX = ".replay.pkl"
+
+_cache_dir = os.environ.get("RAPTOR_REPLAY_CACHE_DIR",
+                            os.path.join(os.path.expanduser("~"), ".cache", "raptor", "replay"))
+_max_size = DEFAULT_MAX_SIZE
+
+
+def configure_replay_cache(cache_dir: str = _cache_dir, max_size=DEFAULT_MAX_SIZE):
+    """Configure the on-disk cache of replay results.
+
+    :param str cache_dir: the directory to keep the cached results in (in a `raptor-replay-cache` subdirectory, so it
+        may be shared with other files). Default is the `RAPTOR_REPLAY_CACHE_DIR` environment variable, or
+        `~/.cache/raptor/replay`.
+    :param int|str max_size: the maximum size of the cache, in bytes or as a string with units (i.e. `10GB`). When the
+        cache grows beyond it, the least recently used results are evicted. Default is 2GB.
+    """
+    global _cache_dir, _max_size
+    _cache_dir = cache_dir
+    _max_size = replay_files.parse_size(max_size)
+
+
+def invalidate_replay_cache(fqn: str = None):
+    """Drop cached replay results.
+
+    :param Optional[str] fqn: drop only the results of this feature. When not set, the whole cache is dropped.
+    """
+    if fqn is None:
+        shutil.rmtree(_entries_dir(), ignore_errors=True)
+    else:
+        shutil.rmtree(_fqn_dir(fqn), ignore_errors=True)
+
+
+def _entries_dir() -> str:
+    return os.path.join(_cache_dir, _ENTRIES_DIR)
+
+
+def _fqn_dir(fqn: str) -> str:
+    return os.path.join(_entries_dir(), re.sub(r"[^\w.-]", "_", fqn))
+
+
+def _entry_path(fqn: str, key: str) -> str:
+    return os.path.join(_fqn_dir(fqn), f"{key}{_ENTRY_SUFFIX}")
+
+
+def _json_default(o):
+    try:
+        return ragged.json_default(o)
+    except TypeError:
+        return repr(o)
+
+
+def _hash_values(h, df: pd.DataFrame, index: bool) -> bool:
+    """Hash the values of the dataframe. Values that pandas can't hash (i.e. dicts, such as headers, or lists) are
+    hashed by their JSON.
+
+    :return: False if the values can't be hashed, so the replay isn't cacheable
+    """
+    try:
+        hashes = pd.util.hash_pandas_object(df, index=index)
+    except TypeError:
+        try:
+            df = df.apply(lambda col: col.map(lambda v: json.dumps(v, sort_keys=True, default=_json_default))
+                          if col.dtype == object else col)
+            hashes = pd.util.hash_pandas_object(df, index=index)
+        except (TypeError, ValueError):
+            return False
+    h.update(hashes.to_numpy().tobytes())
+    return True
+
+
+def dataframe_digest(df: pd.DataFrame) -> str:
+    """Digest the dataframe by its columns and values, or None if its values can't be hashed"""
+    h = hashlib.sha256()
+    h.update(json.dumps([[str(c), str(t)] for c, t in df.dtypes.items()]).encode("utf-8"))
+    if not _hash_values(h, df, index=True):
+        return None
+    return h.hexdigest()
+
+
+def files_digest(path_or_glob: str) -> str:
+    """Digest the files by their path, size and modification time, rather than reading them whole"""
+    h = hashlib.sha256()
+    for path in sorted(glob.glob(path_or_glob)):
+        st = os.stat(path)
+        h.update(f"{os.path.abspath(path)}:{st.st_size}:{st.st_mtime_ns}\n".encode("utf-8"))
+    return h.hexdigest()
+
+
+def _dependencies_digest(spec) -> str:
+    compiled = local_state.compiled_spec(spec["fqn"])
+    deps = sorted(compiled.reads | compiled.writes)  # the features the program reads or writes
+    h = hashlib.sha256(json.dumps(deps).encode("utf-8"))
+    if len(deps) > 0 and not _hash_values(h, local_state.__scan(deps), index=False):
+        return None
+    return h.hexdigest()
+
+
+def fingerprint(spec, data_digest: str, dependencies=True, **args) -> str:
+    """Fingerprint a replay by its input data, its arguments, the feature definition and the values it depends on
+
+    :param bool dependencies: include the locally stored values of the features the program reads or writes.
+    :return: the fingerprint, or None if the replay isn't cacheable (i.e. the data couldn't be digested)
+    """
+    if data_digest is None:
+        return None
+    h = hashlib.sha256()
+    h.update(data_digest.encode("utf-8"))
+    h.update(json.dumps(args, sort_keys=True, default=str).encode("utf-8"))
+    h.update(spec["fqn"].encode("utf-8"))
+    h.update(spec["src"].code.encode("utf-8"))
+    h.update(json.dumps(spec["options"], sort_keys=True, default=str).encode("utf-8"))
+    if dependencies:
+        digest = _dependencies_digest(spec)
+        if digest is None:
+            return None
+        h.update(digest.encode("utf-8"))
+    return h.hexdigest()
+
+
+def load(fqn: str, key: str):
+    """Load cached replay results.
+
+    :return: a tuple of (feature values, rows the replay added to the local state, dead letters, replay progress), or
+        None if not cached. The replay progress is a tuple of the watermark and the replay tail of the feature.
+    """
+    if key is None:  # the replay isn't cacheable (see `fingerprint`)
+        return None
+    path = _entry_path(fqn, key)
+    try:
+        entry = pd.read_pickle(path)
+        ret = entry["values"], entry["stored"], entry.get("dead_letters"), entry["progress"]
+    except Exception:  # i.e. a missing or partial file, or an entry of another version that doesn't unpickle
+        return None
+    os.utime(path)  # mark as recently used
+    return ret
+
+
+def save(fqn: str, key: str, feature_values: pd.DataFrame, stored: pd.DataFrame, dead_letters: pd.DataFrame = None,
+         progress: tuple = (None, None)):
+    """Cache the results of a replay.
+
+    :param tuple progress: the watermark and the replay tail of the feature after the replay, to restore on a hit.
+    """
+    path = _entry_path(fqn, key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    pd.to_pickle({"values": feature_values, "stored": stored, "dead_letters": dead_letters, "progress": progress},
+                 path + ".tmp")
+    os.replace(path + ".tmp", path)
+    _evict()
+
+
+def _evict():
+    entries = [(p, os.stat(p)) for p in glob.glob(os.path.join(_entries_dir(), "*", f"*{_ENTRY_SUFFIX}"))]
+    size = sum(st.st_size for _, st in entries)
+    if size <= _max_size:
+        return
+    entries.sort(key=lambda e: e[1].st_mtime)
+    for path, st in entries:
+        if size <= _max_size:
+            break
+        os.remove(path)
+        size -= st.st_size
@@ -0,0 +1,113 @@
+# Copyright (c) 2022 Raptor.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import shutil
+
+import pandas as pd
+
+from . import local_state, replay
+
+DEFAULT_CHECKPOINT_EVERY = 100000
+
+
+def _manifest_path(path: str) -> str:
+    return os.path.join(path, "manifest.json")
+
+
+def _restore(path: str, key: str):
+    """Load the progress of a previous run, and restore its effects to the local state.
+
+    :return: a tuple of (values, errors, position, parts)
+    """
+    try:
+        with open(_manifest_path(path), "r") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return [], [], 0, []
+    if manifest.get("key") != key:
+        return [], [], 0, []
+
+    values = []
+    errors = []
+    for part in manifest["parts"]:
+        entry = pd.read_pickle(os.path.join(path, part))
+        values.extend(entry["values"])
+        errors.extend(entry.get("errors", []))
+        if not entry["effects"].empty:
+            local_state.store_feature_values(entry["effects"])
+    return values, errors, manifest["position"], manifest["parts"]
+
+
+def _save(path: str, key: str, parts, values, errors, effects: pd.DataFrame, position: int):
+    os.makedirs(path, exist_ok=True)
+    part = f"part-{len(parts):06d}.pkl"
+    pd.to_pickle({"values": values, "errors": errors, "effects": effects}, os.path.join(path, part))
+    parts.append(part)
+
+    tmp = _manifest_path(path) + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump({"key": key, "position": position, "parts": parts}, f)
+    os.replace(tmp, _manifest_path(path))
+
+
+def exec_rows(spec, rt, df: pd.DataFrame, checkpoint_dir: str, key: str, timestamp_field: str, headers_field: str,
+              entity_id_field: str, chunk_size: int, every: int = DEFAULT_CHECKPOINT_EVERY, errors: list = None,
+              max_errors: int = None):
+    """Execute the feature program over the rows, and checkpoint the progress every `every` rows.
+
+    A previous run with the same key is resumed from its last checkpoint. If the execution fails, its effects are
+    rolled back from the local state, since they're restored from the checkpoint when it is resumed.
+
+    When `errors` is given, the failing rows are collected into it (see `replay.__exec_batch`), along with the ones
+    collected by the resumed run.
+
+    :return: the values, in the order of the dataframe rows
+    """
+    path = os.path.join(checkpoint_dir, key)
+    initial_offset = local_state.stored_count()
+    try:
+        values, restored_errors, position, parts = _restore(path, key)
+        if errors is not None:
+            errors.extend(restored_errors)
+        errors_offset = len(errors) if errors is not None else 0
+        offset = local_state.stored_count()
+        next_checkpoint = position + every
+        pending = []
+        for start in range(position, len(df), chunk_size):
+            chunk = df.iloc[start:start + chunk_size]
+            pending.extend(replay.__exec_batch(spec, rt, chunk, timestamp_field, headers_field, entity_id_field, errors,
+                                               max_errors, start))
+
+            end = start + len(chunk)
+            if next_checkpoint <= end < len(df):
+                new_errors = errors[errors_offset:] if errors is not None else []
+                _save(path, key, parts, pending, new_errors, local_state.stored_since(offset), end)
+                values.extend(pending)
+                pending = []
+                offset = local_state.stored_count()
+                errors_offset += len(new_errors)
+                next_checkpoint = end + every
+    except Exception:
+        local_state.truncate(initial_offset)
+        raise
+
+    values.extend(pending)
+    return values
+
+
+def complete(checkpoint_dir: str, key: str):
+    """Drop the checkpoints of a replay that completed"""
+    shutil.rmtree(os.path.join(checkpoint_dir, key), ignore_errors=True)
@@ -0,0 +1,105 @@
+# Copyright (c) 2022 Raptor.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import glob
+import os
+import re
+
+import pandas as pd
+
+DEFAULT_MEMORY_BUDGET = 256 * 1024 * 1024
+
+# a chunk takes more memory than its raw data while it's replayed (requests, values, feature values)
+_REPLAY_OVERHEAD = 4
+_CSV_SAMPLE_ROWS = 1000
+
+_size_units = {
+    "": 1,
+    "b": 1,
+    "kb": 1024,
+    "mb": 1024 ** 2,
+    "gb": 1024 ** 3,
+    "tb": 1024 ** 4,
+}
+
+
+def parse_size(size) -> int:
+    """Parse a memory size in bytes, or as a string with units (i.e. `512MB`), to bytes"""
+    if isinstance(size, (int, float)):
+        return int(size)
+    m = re.match(r"^\s*([\d.]+)\s*([a-zA-Z]*)\s*$", str(size))
+    if m is None or m.group(2).lower() not in _size_units:
+        raise Exception(f"Invalid memory size `{size}`")
+    return int(float(m.group(1)) * _size_units[m.group(2).lower()])
+
+
+def detect_format(path: str) -> str:
+    name = path.lower()
+    if name.endswith(".gz") or name.endswith(".bz2") or name.endswith(".zip") or name.endswith(".xz"):
+        name = os.path.splitext(name)[0]
+    ext = os.path.splitext(name)[1]
+    if ext in (".parquet", ".pq"):
+        return "parquet"
+    if ext == ".csv":
+        return "csv"
+    raise Exception(f"Can't detect the format of `{path}`. Please specify using the `file_format` argument")
+
+
+def _rows_per_chunk(bytes_per_row: float, memory_budget: int) -> int:
+    return max(1, int(memory_budget / (max(bytes_per_row, 1) * _REPLAY_OVERHEAD)))
+
+
+def _read_parquet(path: str, memory_budget: int):
+    try:
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise Exception("Replaying Parquet files requires `pyarrow`. Please install it using `pip install pyarrow`")
+
+    pf = pq.ParquetFile(path)
+    meta = pf.metadata
+    if meta.num_rows == 0:
+        return
+
+    size = sum(meta.row_group(i).total_byte_size for i in range(meta.num_row_groups))
+    batch_size = _rows_per_chunk(size / meta.num_rows, memory_budget)
+    for batch in pf.iter_batches(batch_size=batch_size):
+        yield batch.to_pandas()
+
+
+def _read_csv(path: str, memory_budget: int):
+    sample = pd.read_csv(path, nrows=_CSV_SAMPLE_ROWS)
+    if sample.empty:
+        return
+
+    chunksize = _rows_per_chunk(sample.memory_usage(deep=True).sum() / len(sample), memory_budget)
+    del sample
+    for df in pd.read_csv(path, chunksize=chunksize):
+        yield df
+
+
+def read_chunks(path_or_glob: str, memory_budget=DEFAULT_MEMORY_BUDGET, file_format: str = None):
+    """Read the files matching `path_or_glob` as a stream of dataframes that fit the memory budget"""
+    paths = sorted(glob.glob(path_or_glob))
+    if len(paths) == 0:
+        raise Exception(f"No files found for `{path_or_glob}`")
+
+    memory_budget = parse_size(memory_budget)
+    for path in paths:
+        fmt = file_format if file_format is not None else detect_format(path)
+        if fmt == "parquet":
+            yield from _read_parquet(path, memory_budget)
+        elif fmt == "csv":
+            yield from _read_csv(path, memory_budget)
+        else:
+            raise Exception(f"Unsupported file format `{fmt}`")
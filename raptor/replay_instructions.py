@@ -12,107 +12,201 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import pandas
+import itertools
+import json
+import threading
+from bisect import bisect_right
+
 import pandas as pd
 
-from . import durpy, local_state
+from . import feature_index, local_state, ragged, types
 from .pyexp import pyexp
 
+# The instructions are buffered as they're executed, and applied in bulk at the end of every batch of rows, or before
+# a feature they write to is read. The buffer is columnar: the operation, fqn, entity id, timestamp and value of each.
+# Every thread has its own buffer, as replays of concurrent threads may run in different sessions.
+class _Buffer(threading.local):
+    def __init__(self):
+        self.ops = []
+        self.fqns = []
+        self.entity_ids = []
+        self.timestamps = []
+        self.values = []
+        self.pending = set()  # the fqns that have buffered instructions
+
+
+_buffer = _Buffer()
+
 
 def _inst_spec(fqn):
-    spec = local_state.spec_by_fqn(fqn)
+    spec = local_state.compiled_spec(fqn)
     if spec is None:
         raise ValueError(f"Unknown FQN {fqn}")
-    if "aggr" in spec["options"]:
+    if len(spec.aggr) > 0:
         raise Exception("Aggregation is not supported for Replay's effects at the moment")
     return spec
 
 
 def __exec_instruction(inst: pyexp.Instruction):
-    if inst.Operation == pyexp.InstructionOpSet:
-        return _exec_set(inst)
-    if inst.Operation == pyexp.InstructionOpUpdate:
-        return _exec_update(inst)
-    if inst.Operation == pyexp.InstructionOpAppend:
-        return _exec_append(inst)
-    if inst.Operation == pyexp.InstructionOpIncr:
-        return _exec_incr(inst)
-
-
-def _exec_append(inst):
-    spec = _inst_spec(inst.FQN)
-    if not spec["options"]["primitive"].startswith("[]"):
-        raise Exception("Append is not supported for scalars")
-    df = _get_recent(inst)
-
-    ts = pd.to_datetime(pyexp.PyTimeRFC3339(inst.Timestamp))
-    o = {
-        "entity_id": inst.EntityID,
-        "value": [pyexp.JsonAny(inst, "Value")],
-        "timestamp": ts,
-        "fqn": inst.FQN,
-    }
-    if df is not None:
-        o["value"] = df["value"] + o["value"]
-
-    local_state.store_feature_values(pandas.DataFrame.from_records([o]))
-
-
-def _exec_incr(inst):
-    spec = _inst_spec(inst.FQN)
-    primitive = spec["options"]["primitive"]
-    if not primitive in ["int", "float"]:
-        raise Exception("Incr is only supported for numbers")
-
-    df = _get_recent(inst)
-    ts = pd.to_datetime(pyexp.PyTimeRFC3339(inst.Timestamp))
-    o = {
-        "entity_id": inst.EntityID,
-        "value": pyexp.JsonAny(inst, "Value"),
-        "timestamp": ts,
-        "fqn": inst.FQN,
-    }
-    if df is not None:
-        if o["value"] is None:
-            o["value"] = 0
-
-        val = float(df["value"]) + float(o["value"])
-        if primitive == "int":
-            val = int(val)
-        o["value"] = val
-
-    local_state.store_feature_values(pandas.DataFrame.from_records([o]))
-
-
-def _get_recent(inst):
-    spec = _inst_spec(inst.FQN)
-    ts = pd.to_datetime(pyexp.PyTimeRFC3339(inst.Timestamp))
-
-    df = local_state.__feature_values
-    df = df.loc[(df["fqn"] == inst.FQN) & (df["entity_id"] == inst.EntityID) & (df["timestamp"] <= ts)]
-
-    staleness = durpy.from_str(spec["options"]["staleness"])
-    if staleness.total_seconds() > 0:
-        df = df.loc[(df["timestamp"] >= ts - staleness)]
-
-    df = df.sort_values(by=["timestamp"], ascending=False).head(1)
-    if df.empty:
+    op = inst.Operation
+    if op == pyexp.InstructionOpUpdate:
+        if not _inst_spec(inst.FQN).primitive.startswith("[]"):
+            return
+        op = pyexp.InstructionOpAppend
+    if op == pyexp.InstructionOpAppend:
+        if not _inst_spec(inst.FQN).primitive.startswith("[]"):
+            raise Exception("Append is not supported for scalars")
+    elif op == pyexp.InstructionOpIncr:
+        if _inst_spec(inst.FQN).primitive not in ["int", "float"]:
+            raise Exception("Incr is only supported for numbers")
+    elif op != pyexp.InstructionOpSet:
+        return
+
+    _buffer.ops.append(op)
+    _buffer.fqns.append(inst.FQN)
+    _buffer.entity_ids.append(inst.EntityID)
+    _buffer.timestamps.append(pyexp.PyTimeRFC3339(inst.Timestamp))
+    _buffer.values.append(json.loads(pyexp.JsonAny(inst, "Value")))  # the value, rather than its JSON
+    _buffer.pending.add(inst.FQN)
+
+
+def pending(fqn: str) -> bool:
+    """Whether there are buffered instructions that write to the feature"""
+    return fqn in _buffer.pending
+
+
+def flush():
+    """Apply the buffered instructions to the local state.
+
+    The instructions are grouped by (fqn, entity id). `set` stores its value as is, and a group of `incr`s in time
+    order is a cumulative sum over the most recent value. Any other group is applied one instruction at a time, with
+    each one reading the values of the ones before it, as if they were stored right away. Either way, the values are
+    then converted to the type of their feature's primitive, so they're the same as applying the instructions one by
+    one.
+    """
+    if len(_buffer.ops) == 0:
+        return
+    ops, fqns, entity_ids, values = _buffer.ops, _buffer.fqns, _buffer.entity_ids, _buffer.values
+    timestamps = feature_index.to_epoch_ns(_buffer.timestamps).tolist()
+    _buffer.__init__()
+
+    groups = {}
+    for pos, key in enumerate(zip(fqns, entity_ids)):
+        groups.setdefault(key, []).append(pos)
+
+    stored = [None] * len(ops)
+    for (fqn, entity_id), positions in groups.items():
+        group_ops = [ops[p] for p in positions]
+        group_values = [values[p] for p in positions]
+        if all(op == pyexp.InstructionOpSet for op in group_ops):
+            res = group_values
+        else:
+            group_ts = [timestamps[p] for p in positions]
+            res = _incr_cumsum(fqn, entity_id, group_ops, group_ts, group_values)
+            if res is None:
+                res = _apply_sequentially(fqn, entity_id, group_ops, group_ts, group_values)
+        for p, v in zip(positions, res):
+            stored[p] = v
+
+    by_fqn = {}
+    for pos, fqn in enumerate(fqns):
+        by_fqn.setdefault(fqn, []).append(pos)
+    for fqn, positions in by_fqn.items():
+        for p, v in zip(positions, _typed(_inst_spec(fqn).primitive, [stored[p] for p in positions])):
+            stored[p] = v
+
+    local_state.__store_values(fqns, entity_ids, stored, timestamps)
+
+
+def _typed(primitive: str, values: list) -> list:
+    """The values as plain python values of the primitive's type (see `types.typed_values`), i.e. floats of a `float`
+    feature that was set to a whole number"""
+    if primitive.startswith("[]"):
+        return values  # lists that were built by `append`
+    return [None if v is pd.NA else v for v in types.typed_values(primitive, values).tolist()]
+
+
+def _incr_cumsum(fqn, entity_id, ops, timestamps, values):
+    """Calculate a group of `incr` instructions as a cumulative sum.
+
+    It applies only when every instruction reads the value of the one before it, that is: they're in time order, each
+    one is within the staleness of the one before it, and no value was stored after the first one. Otherwise, it
+    returns None.
+    """
+    if any(op != pyexp.InstructionOpIncr for op in ops):
+        return None
+    spec = _inst_spec(fqn)
+    staleness = spec.staleness
+    for prev, ts in zip(timestamps, timestamps[1:]):
+        if ts < prev or (staleness > 0 and prev < ts - staleness):
+            return None
+    last = local_state.__last_timestamp(fqn, entity_id)
+    if last is not None and last > timestamps[0]:
         return None
-    return df.iloc[0]
-
-
-def _exec_update(inst):
-    spec = _inst_spec(inst.FQN)
-    if spec["options"]["primitive"].startswith("[]"):
-        return _exec_append(inst)
-    pass
-
 
-def _exec_set(inst: pyexp.Instruction):
-    ts = pd.to_datetime(pyexp.PyTimeRFC3339(inst.Timestamp))
-    local_state.store_feature_values(pandas.DataFrame.from_records([{
-        "entity_id": inst.EntityID,
-        "value": pyexp.JsonAny(inst, "Value"),
-        "timestamp": ts,
-        "fqn": inst.FQN,
-    }]))
+    is_int = spec.primitive == "int"
+    try:
+        deltas = [float(v) for v in values]
+        recent = local_state.__lookup(fqn, entity_id, timestamps[0], staleness)
+        base = float(recent[0]) if recent is not None else None
+    except (TypeError, ValueError):
+        return None
+    if is_int and not all(d.is_integer() for d in deltas + ([base] if base is not None else [])):
+        return None  # the sum is truncated to an int on every step
+
+    if base is None:
+        # the first value is stored as is, and the next ones add up to it
+        sums = itertools.accumulate(deltas)
+        next(sums)
+        res = [values[0]]
+    else:
+        sums = itertools.accumulate([base] + deltas)
+        next(sums)
+        res = []
+    res.extend(int(s) if is_int else s for s in sums)
+    return res
+
+
+def _apply_sequentially(fqn, entity_id, ops, timestamps, values):
+    # the timestamps and values of the group's instructions that were applied, in time order
+    done_ts, done_values = [], []
+    res = []
+    for op, ts, value in zip(ops, timestamps, values):
+        if op == pyexp.InstructionOpIncr:
+            value = _exec_incr(fqn, value, _get_recent(fqn, entity_id, ts, done_ts, done_values))
+        elif op == pyexp.InstructionOpAppend:
+            value = _exec_append(fqn, value, _get_recent(fqn, entity_id, ts, done_ts, done_values))
+        pos = bisect_right(done_ts, ts)
+        done_ts.insert(pos, ts)
+        done_values.insert(pos, value)
+        res.append(value)
+    return res
+
+
+def _get_recent(fqn, entity_id, ts: int, done_ts, done_values):
+    """Get the most recent value as of the timestamp, from the local state and the group's applied instructions"""
+    staleness = _inst_spec(fqn).staleness
+    recent = local_state.__lookup(fqn, entity_id, ts, staleness)
+
+    i = bisect_right(done_ts, ts) - 1
+    if i >= 0 and (staleness <= 0 or done_ts[i] >= ts - staleness):
+        if recent is None or done_ts[i] >= recent[1]:  # the applied instructions are newer than the local state
+            return done_values[i]
+    return recent[0] if recent is not None else None
+
+
+def _exec_append(fqn, value, recent):
+    spec = _inst_spec(fqn)
+    return ragged.append(spec.primitive, recent, value, spec.max_length)
+
+
+def _exec_incr(fqn, value, recent):
+    if recent is None:
+        return value
+    if value is None:
+        value = 0
+
+    val = float(recent) + float(value)
+    if _inst_spec(fqn).primitive == "int":
+        val = int(val)
+    return val
@@ -0,0 +1,164 @@
+# Copyright (c) 2022 Raptor.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from . import local_state, profiler, replay, runtimes, types
+
+# the number of feature values a worker process was started with
+_base_count = 0
+
+
+def _init_worker(specs, feature_values, profiling):
+    global _base_count
+    local_state.restore_specs(specs)
+    local_state.reset_feature_values(feature_values)
+    _base_count = local_state.stored_count()
+    profiler.enable_profiling(profiling)
+
+
+def _exec_shard(fqn, shard: pd.DataFrame, warmup: int, timestamp_field: str, headers_field: str, entity_id_field: str,
+                chunk_size: int, collect_errors: bool = False, max_errors: int = None):
+    spec = local_state.spec_by_fqn(fqn)
+    rt = runtimes.get(spec["src"].code, fqn)
+
+    # every shard starts from the same state, regardless of the shards this worker has executed before
+    local_state.truncate(_base_count)
+
+    # the warm-up rows only rebuild the state that precedes the shard, their values and effects belong to another shard
+    replay.__exec_rows(spec, rt, shard.iloc[:warmup], timestamp_field, headers_field, entity_id_field, chunk_size,
+                       [] if collect_errors else None)
+    offset = local_state.stored_count()
+
+    errors = [] if collect_errors else None
+    values = replay.__exec_rows(spec, rt, shard.iloc[warmup:], timestamp_field, headers_field, entity_id_field,
+                                chunk_size, errors, max_errors)
+    return values, errors, local_state.stored_since(offset), profiler.collect()
+
+
+def shard_by_entity(df: pd.DataFrame, entity_id_field: str, shards: int):
+    """Hash-partition the rows of the dataframe by their entity id.
+
+    :return: a list of (positions, warmup) tuples, one for each non-empty shard
+    """
+    buckets = pd.util.hash_pandas_object(df[entity_id_field], index=False).to_numpy() % shards
+    return [(positions, 0) for positions in (np.flatnonzero(buckets == i) for i in range(shards)) if len(positions) > 0]
+
+
+def time_warmup(spec) -> datetime.timedelta:
+    """The warm-up period of the time ranges of a feature (see :func:`shard_by_time`): the largest staleness of the
+    feature and of the features its program reads with `f()` or sets with instructions, as the values within it are
+    the state a range depends on. It's non-positive (unbounded) when any of them has no staleness.
+
+    Programs that use `incr_feature` or `append_feature` can't be split by time, as the values they set depend on all
+    the values that were set before them.
+    """
+    compiled = local_state.compiled_spec(spec["fqn"])
+    if compiled.accumulates:
+        raise Exception(f"`{spec['fqn']}` uses `incr_feature` or `append_feature`, so it can't be sharded by time. "
+                        "Please use `shard_by=\"entity\"`")
+    warmup = 0
+    for fqn in {compiled.fqn} | compiled.reads | compiled.writes:
+        staleness = local_state.compiled_spec(fqn).staleness
+        if staleness <= 0:
+            return datetime.timedelta(0)
+        warmup = max(warmup, staleness)
+    return pd.Timedelta(warmup, unit="ns").to_pytimedelta()
+
+
+def shard_by_time(df: pd.DataFrame, timestamp_field: str, shards: int, split: str, warmup: datetime.timedelta):
+    """Split the rows of the dataframe into consecutive time ranges.
+
+    Every range is prefixed with the rows of the `warmup` period that precedes it (see :func:`time_warmup`), so the
+    state it depends on (i.e. values set by instructions and read by `f()`) is rebuilt before the range's own rows are
+    executed. A non-positive `warmup` means the state is unbounded, so every range is prefixed with all the rows that
+    precede it.
+
+    :param str split: `rows` to split into ranges with an equal number of rows, or `time` to split into ranges of an
+        equal time span.
+    :return: a list of (positions, warmup) tuples in time order, where the first `warmup` positions are the warm-up rows
+    """
+    idx = pd.DatetimeIndex(df[timestamp_field])
+    order = np.argsort(idx.asi8, kind="stable")
+    idx = idx[order]
+
+    if split == "rows":
+        bounds = [len(idx) * i // shards for i in range(shards + 1)]
+    elif split == "time":
+        edges = pd.date_range(idx[0], idx[-1], periods=shards + 1)
+        bounds = [0] + list(idx.searchsorted(edges[1:-1], side="left")) + [len(idx)]
+    else:
+        raise Exception(f"Unknown split strategy `{split}`. Use `rows` or `time`")
+
+    ret = []
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        if start == end:
+            continue
+        warmup_start = 0
+        if warmup.total_seconds() > 0:
+            warmup_start = idx.searchsorted(idx[start] - warmup, side="left")
+        ret.append((order[warmup_start:end], start - warmup_start))
+    return ret
+
+
+def exec_shards(spec, df: pd.DataFrame, shards, timestamp_field: str, headers_field: str, entity_id_field: str,
+                chunk_size: int, workers: int, errors: list = None, max_errors: int = None):
+    """Execute the feature program over the shards in a pool of processes.
+
+    Each worker starts with a copy of the registered specs and the locally stored feature values, and compiles its own
+    runtime. The instructions' side effects of each shard are collected and stored in the shards order once all of them
+    are done, so the merged result doesn't depend on the order the workers complete in.
+
+    :param shards: a list of (positions, warmup) tuples, as returned by :func:`shard_by_entity` or
+        :func:`shard_by_time`.
+    :param errors: when given, the failing rows are collected into it (see `replay.__exec_batch`) with their position
+        in the dataframe. The `max_errors` threshold applies to each shard, and to all of them together.
+    :return: the values, in the order of the dataframe rows
+    """
+    ctx = multiprocessing.get_context("spawn")  # forking a process that already runs the Go runtime is not safe
+    initargs = (local_state.registered_specs(), local_state.feature_values(copy=False), profiler.enabled)
+    with ProcessPoolExecutor(max_workers=min(workers, len(shards)), mp_context=ctx, initializer=_init_worker,
+                             initargs=initargs) as pool:
+        futures = [pool.submit(_exec_shard, spec["fqn"], df.iloc[positions], warmup, timestamp_field, headers_field,
+                               entity_id_field, chunk_size, errors is not None, max_errors)
+                   for positions, warmup in shards]
+
+        values = [None] * len(df)
+        effects = []
+        for (positions, warmup), future in zip(shards, futures):
+            try:
+                shard_values, shard_errors, shard_effects, shard_profile = future.result()
+            except RuntimeError as e:
+                raise types.WrapException(e, spec)
+            for pos, val in zip(positions[warmup:], shard_values):
+                values[pos] = val
+            effects.append(shard_effects)
+            profiler.merge(shard_profile)
+            if errors is not None:
+                errors.extend((int(positions[warmup + i]), err, lineno) for i, err, lineno in shard_errors)
+                if max_errors is not None and len(errors) > max_errors:
+                    raise Exception(f"Too many errors ({len(errors)}). The last error was: {errors[-1][1]}")
+
+    if errors is not None:
+        errors.sort(key=lambda e: e[0])
+
+    effects = [e for e in effects if not e.empty]
+    if len(effects) > 0:
+        local_state.store_feature_values(pd.concat(effects).sort_values(by=["timestamp"], kind="stable"))
+    return values
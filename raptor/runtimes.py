@@ -0,0 +1,143 @@
+# Copyright (c) 2022 Raptor.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+from .pyexp import pyexp
+
+DEFAULT_MAX_ENTRIES = 512
+# the on-disk entries are named by a prefix of their own, so the directory may be shared with other files
+_DISK_PREFIX = "raptor-runtime-"
+_unchanged = object()
+
+# compiled runtimes by (fqn, code digest), in least-recently-used order
+_runtimes = OrderedDict()
+_lock = threading.Lock()
+_max_entries = DEFAULT_MAX_ENTRIES
+_disk_dir = os.environ.get("RAPTOR_RUNTIME_CACHE_DIR")
+
+
+def configure_runtime_cache(max_entries: int = DEFAULT_MAX_ENTRIES, disk_dir: str = _unchanged):
+    """Configure the cache of compiled PyExp programs.
+
+    Compiled runtimes are kept in memory and reused by every replay of the same program. Optionally, programs that were
+    already validated are recorded in a directory on disk, so registering them again (i.e. after restarting the kernel)
+    doesn't require compiling them until they're replayed.
+
+    :param int max_entries: the maximum number of programs to keep, in memory and on disk.
+    :param Optional[str] disk_dir: a directory for the on-disk cache, or None to disable it. When not set, the
+        directory remains the one that was configured before, which is initially the `RAPTOR_RUNTIME_CACHE_DIR`
+        environment variable.
+    """
+    global _max_entries, _disk_dir
+    if max_entries < 1:
+        raise Exception("`max_entries` must be a positive number")
+    with _lock:
+        _max_entries = max_entries
+        if disk_dir is not _unchanged:
+            _disk_dir = disk_dir
+        while len(_runtimes) > _max_entries:
+            _runtimes.popitem(last=False)
+
+
+def clear_runtime_cache():
+    """Drop all the cached runtimes, in memory and on disk"""
+    with _lock:
+        _runtimes.clear()
+        for path in _disk_entries():
+            os.remove(path)
+
+
+def _digest(code: str) -> str:
+    return hashlib.sha256(code.encode("utf-8")).hexdigest()
+
+
+def _pyexp_version() -> str:
+    # validations are bound to the build of the PyExp extension that performed them
+    st = os.stat(pyexp.__file__)
+    return f"{st.st_size}-{st.st_mtime_ns}"
+
+
+def _disk_path(fqn: str, digest: str) -> str:
+    return os.path.join(_disk_dir, f"{_DISK_PREFIX}{_digest(fqn)[:16]}-{digest}.json")
+
+
+def _disk_entries():
+    if _disk_dir is None or not os.path.isdir(_disk_dir):
+        return []
+    return [os.path.join(_disk_dir, f) for f in os.listdir(_disk_dir)
+            if f.startswith(_DISK_PREFIX) and f.endswith(".json")]
+
+
+def _disk_validated(fqn: str, digest: str) -> bool:
+    path = _disk_path(fqn, digest)
+    try:
+        with open(path, "r") as f:
+            entry = json.load(f)
+    except (OSError, ValueError):
+        return False
+    if entry.get("fqn") != fqn or entry.get("pyexp") != _pyexp_version():
+        return False
+    os.utime(path)
+    return True
+
+
+def _disk_store(fqn: str, digest: str):
+    os.makedirs(_disk_dir, exist_ok=True)
+    tmp = _disk_path(fqn, digest) + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump({"fqn": fqn, "digest": digest, "pyexp": _pyexp_version()}, f)
+    os.replace(tmp, _disk_path(fqn, digest))
+
+    entries = _disk_entries()
+    if len(entries) > _max_entries:
+        entries.sort(key=os.path.getmtime)
+        for path in entries[:len(entries) - _max_entries]:
+            os.remove(path)
+
+
+def get(code: str, fqn: str) -> pyexp.Runtime:
+    """Get a compiled runtime for the program, compiling it only if it's not cached already"""
+    key = (fqn, _digest(code))
+    with _lock:
+        rt = _runtimes.get(key)
+        if rt is not None:
+            _runtimes.move_to_end(key)
+            return rt
+
+    rt = pyexp.New(code, fqn)
+    with _lock:
+        _runtimes[key] = rt
+        while len(_runtimes) > _max_entries:
+            _runtimes.popitem(last=False)
+    return rt
+
+
+def validate(code: str, fqn: str):
+    """Make sure the program compiles. Programs that were validated before are not compiled again."""
+    digest = _digest(code)
+    with _lock:
+        if (fqn, digest) in _runtimes:
+            return
+        if _disk_dir is not None and _disk_validated(fqn, digest):
+            return
+
+    get(code, fqn)
+    if _disk_dir is not None:
+        with _lock:
+            _disk_store(fqn, digest)
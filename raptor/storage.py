@@ -0,0 +1,775 @@
+# Copyright (c) 2022 Raptor.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pickle
+import sqlite3
+import threading
+
+import numpy as np
+import pandas as pd
+
+from raptor import feature_index, ragged
+
+_MAX_TIMESTAMP = np.iinfo(np.int64).max
+
+
+def _empty_frame() -> pd.DataFrame:
+    return pd.DataFrame(columns=["fqn", "entity_id", "value", "timestamp"])
+
+
+class Backend:
+    """The storage of the locally calculated feature values.
+
+    Values are kept in the order they were stored, and every value gets a sequence number in that order. A sequence
+    number (see :meth:`count`) is used as an offset to tell the values that a replay stored, and to roll them back. It
+    remains valid when other values are dropped (i.e. evicted). Timestamps are UTC epoch nanoseconds, unless they're in
+    a dataframe.
+    """
+
+    # whether the backend supports :meth:`fork`
+    forkable = False
+
+    def store(self, feature_values: pd.DataFrame):
+        """Store a dataframe of feature values, with the columns fqn, entity_id, value and timestamp"""
+        raise NotImplementedError
+
+    def store_values(self, fqns: list, entity_ids: list, values: list, timestamps: list):
+        """Store values one by one (i.e. the values that were set by instructions)"""
+        raise NotImplementedError
+
+    def lookup(self, fqn: str, entity_id, timestamp: int, staleness: int = 0):
+        """Get the most recent value of an entity as of the timestamp. Of values with the same timestamp, the one that
+        was stored last is the most recent.
+
+        :param int staleness: in nanoseconds, the maximal age of the value. A non-positive staleness means unbounded.
+        :return: a tuple of (value, timestamp), or None if there's no value
+        """
+        raise NotImplementedError
+
+    def latest(self, fqn: str, entity_id):
+        """Get the latest value of an entity.
+
+        :return: a tuple of (value, timestamp), or None if there's no value
+        """
+        return self.lookup(fqn, entity_id, _MAX_TIMESTAMP)
+
+    def scan(self, fqns: list = None, since: int = None, until: int = None) -> pd.DataFrame:
+        """Get the stored values of the features within a time range (inclusive), in the order they were stored.
+
+        The returned dataframe may be shared, so it must not be modified.
+
+        :param Optional[list] fqns: the features to get the values of, or None for all of them.
+        """
+        raise NotImplementedError
+
+    def count(self) -> int:
+        """The sequence number of the last stored value, which is the number of stored values unless some were
+        dropped"""
+        raise NotImplementedError
+
+    def since(self, offset: int) -> pd.DataFrame:
+        """The values that were stored after the offset. It may be shared, so it must not be modified."""
+        raise NotImplementedError
+
+    def truncate(self, offset: int):
+        """Drop the values that were stored after the offset"""
+        raise NotImplementedError
+
+    def reset(self, feature_values: pd.DataFrame = None):
+        """Replace all the stored values"""
+        raise NotImplementedError
+
+    def remove(self, fqns: list) -> pd.DataFrame:
+        """Drop all the values of the features, i.e. the values of a previous replay that is replayed again.
+
+        :return: the dropped values, so they can be stored again.
+        """
+        raise NotImplementedError
+
+    def dedupe(self, offset: int) -> int:
+        """Drop the values that were stored before the offset, and have the same key (fqn, entity_id and timestamp) as
+        a value that was stored after it, i.e. the effects of a previous replay that was replayed again.
+
+        :return: the number of values that were dropped
+        """
+        raise NotImplementedError
+
+    def evict(self, fqn: str, before: int = None, keep_latest: bool = False, max_rows: int = None) -> int:
+        """Drop the values of a feature that are no longer needed.
+
+        :param Optional[int] before: drop the values that are older than this timestamp.
+        :param bool keep_latest: keep the latest of the values of every entity that are older than `before`.
+        :param Optional[int] max_rows: then, drop the oldest values beyond this number of values.
+        :return: the number of values that were dropped
+        """
+        raise NotImplementedError
+
+    def fork(self) -> "Backend":
+        """A copy of the stored values, that shares them with this backend until either one changes them (copy on
+        write), so a fork is cheap regardless of the number of values"""
+        raise NotImplementedError
+
+    def load(self, readers: dict, rows: int):
+        """Replace all the stored values with values that are read from disk.
+
+        :param dict readers: a function per fqn, that reads its values as a dataframe.
+        :param int rows: the total number of values.
+        """
+        self.reset()
+        for read in readers.values():
+            self.store(read())
+
+
+def _concat(frames: list) -> pd.DataFrame:
+    """Concatenate dataframes of feature values. Values of different types are kept as objects, rather than being cast
+    to a common type (i.e. bools to floats)."""
+    if len(frames) == 1:
+        return frames[0]
+    if len(set(str(df["value"].dtype) for df in frames)) > 1:
+        frames = [df.astype({"value": object}) for df in frames]
+    return pd.concat(frames)
+
+
+def _evicted(entity_ids: np.ndarray, timestamps: np.ndarray, before: int = None, keep_latest: bool = False,
+             max_rows: int = None) -> np.ndarray:
+    """A mask of the values of a feature (in the order they were stored) that are evicted (see :meth:`Backend.evict`)"""
+    evicted = np.zeros(len(timestamps), dtype=bool)
+    if before is not None:
+        evicted = timestamps < before
+        if keep_latest and evicted.any():
+            old = np.flatnonzero(evicted)
+            old = old[np.lexsort((timestamps[old], entity_ids[old]))]  # stable, so the last stored is the latest
+            last = np.append(entity_ids[old][1:] != entity_ids[old][:-1], True)
+            evicted[old[last]] = False
+    if max_rows is not None:
+        kept = np.flatnonzero(~evicted)
+        if len(kept) > max_rows:
+            kept = kept[np.argsort(timestamps[kept], kind="stable")]
+            evicted[kept[:len(kept) - max_rows]] = True
+    return evicted
+
+
+def _seq_array(seqs, rows: int) -> np.ndarray:
+    """The sequence numbers of the rows of a stored dataframe (see `MemoryBackend._stored_seqs`)"""
+    return np.arange(seqs, seqs + rows, dtype=np.int64) if isinstance(seqs, int) else seqs
+
+
+def _seq_split(seqs, rows: int, offset: int) -> int:
+    """The position of the first row of a stored dataframe whose sequence number is after the offset"""
+    if isinstance(seqs, int):
+        return min(max(offset + 1 - seqs, 0), rows)
+    return int(np.searchsorted(seqs, offset, side="right"))
+
+
+def _seq_concat(parts: list):
+    """The sequence numbers of concatenated stored dataframes, by a list of (sequence numbers, rows) of each"""
+    first = parts[0][0]
+    if isinstance(first, int) and all(isinstance(seqs, int) for seqs, _ in parts):
+        end = first
+        for seqs, n in parts:
+            if seqs != end:
+                break
+            end += n
+        else:
+            return first
+    return np.concatenate([_seq_array(seqs, n) for seqs, n in parts])
+
+
+def _keys(df: pd.DataFrame) -> pd.MultiIndex:
+    """The keys of the values: (fqn, entity_id, timestamp)"""
+    return pd.MultiIndex.from_arrays([df["fqn"].to_numpy(), df["entity_id"].to_numpy(),
+                                      feature_index.to_epoch_ns(df["timestamp"])])
+
+
+def _filter_time(df: pd.DataFrame, since: int = None, until: int = None) -> pd.DataFrame:
+    if since is None and until is None or df.empty:
+        return df
+    ts = feature_index.to_epoch_ns(df["timestamp"])
+    mask = np.ones(len(ts), dtype=bool)
+    if since is not None:
+        mask &= ts >= since
+    if until is not None:
+        mask &= ts <= until
+    return df.loc[mask]
+
+
+class _Keys:
+    """A dictionary of keys (i.e. entity ids) to int codes, which only grows, so it's shared by forked backends"""
+
+    def __init__(self):
+        self._codes = {}
+        self._keys = []
+        self._array = None  # the keys as an array, to decode codes in bulk
+        self._lock = threading.Lock()
+
+    def code(self, key) -> int:
+        code = self._codes.get(key)
+        if code is None:
+            with self._lock:
+                code = self._codes.get(key)
+                if code is None:
+                    code = len(self._keys)
+                    self._keys.append(key)
+                    self._codes[key] = code
+        return code
+
+    def get(self, key):
+        """The code of the key, or None if it wasn't encoded"""
+        return self._codes.get(key)
+
+    def key(self, code: int):
+        return self._keys[code]
+
+    def encode(self, keys) -> np.ndarray:
+        codes, uniques = pd.factorize(keys)
+        mapping = np.fromiter((self.code(k) for k in uniques.tolist()), dtype=np.int64, count=len(uniques))
+        if (codes < 0).any():  # missing keys
+            mapping = np.append(mapping, self.code(None))
+            codes = np.where(codes < 0, len(uniques), codes)
+        return mapping[codes]
+
+    def decode(self, codes) -> np.ndarray:
+        array = self._array
+        if array is None or len(array) != len(self._keys):
+            array = feature_index._objects(self._keys)
+            self._array = array
+        return array[np.asarray(codes, dtype=np.int64)]
+
+
+class MemoryBackend(Backend):
+    """Keeps the values in memory, as pandas dataframes, with an index of the values by fqn.
+
+    The fqns and entity ids are kept as int codes (of a dictionary that's shared by all the stored values), rather than
+    as a string on every row. They're translated back only when the values are read as a dataframe.
+
+    The stored dataframes are never modified in place, so a fork shares them. The index of a feature is shared as well,
+    until either backend adds values to it.
+    """
+
+    forkable = True
+
+    def __init__(self):
+        self._fqns = _Keys()
+        self._entities = _Keys()
+        self._stored = []  # the stored dataframes in the order they were stored
+        self._stored_fqns = []  # the fqn codes of each of the stored dataframes
+        # the sequence numbers of the rows of each of the stored dataframes: the first one when they're consecutive
+        # (as they are until values are dropped), or an array
+        self._stored_seqs = []
+        self._seq = 0  # of the last stored value
+        self._index = {}  # by fqn code
+        self._shared = set()  # the fqn codes whose index is shared with a fork, and is copied before it's changed
+        # values that were stored one by one and are indexed, but are not in a dataframe yet
+        self._pending = {"fqn": [], "entity_id": [], "value": [], "timestamp": []}
+        # values that were loaded from disk, by fqn. They're considered as stored before any other value, but each fqn
+        # is read only when it's used: until then it's a function that reads it. Their sequence numbers are up to
+        # `_persisted_rows`, and are given in the order of the fqns once they're all read.
+        self._persisted = {}
+        self._persisted_rows = 0
+
+    def _encoded(self, feature_values: pd.DataFrame) -> pd.DataFrame:
+        """A copy of the feature values, with the codes of their fqns and entity ids"""
+        encoded = {
+            "fqn": self._fqns.encode(feature_values["fqn"]).astype(np.int32),
+            "entity_id": self._entities.encode(feature_values["entity_id"]),
+        }
+        return pd.DataFrame({c: encoded[c] if c in encoded else feature_values[c].copy()
+                             for c in feature_values.columns}, index=feature_values.index)
+
+    def _decoded(self, df: pd.DataFrame) -> pd.DataFrame:
+        if df.empty:
+            return _empty_frame()
+        decoded = {
+            "fqn": self._fqns.decode(df["fqn"].to_numpy()),
+            "entity_id": self._entities.decode(df["entity_id"].to_numpy()),
+        }
+        return pd.DataFrame({c: decoded[c] if c in decoded else df[c] for c in df.columns}, index=df.index)
+
+    def _persisted_frame(self, fqn: str) -> pd.DataFrame:
+        df = self._persisted[fqn]
+        if callable(df):
+            df = self._encoded(df())
+            self._persisted[fqn] = df
+        return df
+
+    def _index_persisted(self, fqn: str):
+        """Index the values of the fqn that were loaded from disk, if it wasn't indexed yet"""
+        if fqn not in self._persisted or self._fqns.code(fqn) in self._index:
+            return
+        df = self._persisted_frame(fqn)
+        idx = feature_index.FeatureIndex()
+        self._index[self._fqns.code(fqn)] = idx
+        idx.add(df["entity_id"].to_numpy(), feature_index.to_epoch_ns(df["timestamp"]),
+                feature_index._objects(df["value"].tolist()))
+
+    def _add_to_index(self, fqns: np.ndarray, entity_ids: np.ndarray, timestamps: np.ndarray, values: np.ndarray):
+        codes = np.unique(fqns).tolist()
+        for code in codes:
+            self._index_persisted(self._fqns.key(code))  # the values from disk are older
+            idx = self._index.get(code)
+            if idx is None:
+                idx = feature_index.FeatureIndex()
+                self._index[code] = idx
+            elif code in self._shared:
+                idx = idx.copy()
+                self._index[code] = idx
+            self._shared.discard(code)
+            if len(codes) == 1:
+                idx.add(entity_ids, timestamps, values)
+            else:
+                mask = fqns == code
+                idx.add(entity_ids[mask], timestamps[mask], values[mask])
+
+    def store(self, feature_values: pd.DataFrame):
+        if len(feature_values) == 0:
+            return
+        self._store_encoded(self._encoded(feature_values))
+
+    def _store_encoded(self, df: pd.DataFrame):
+        if len(df) == 0:
+            return
+        self._flush_pending()
+        self._stored.append(df)
+        self._stored_fqns.append(set(np.unique(df["fqn"].to_numpy()).tolist()))
+        self._stored_seqs.append(self._seq + 1)
+        self._seq += len(df)
+        # plain python values, as they are passed on to f() and instructions as is
+        self._add_to_index(df["fqn"].to_numpy(), df["entity_id"].to_numpy(),
+                           feature_index.to_epoch_ns(df["timestamp"]), feature_index._objects(df["value"].tolist()))
+
+    def store_values(self, fqns: list, entity_ids: list, values: list, timestamps: list):
+        # the values are kept in columns, until the stored values are read as a dataframe
+        if len(fqns) == 0:
+            return
+        fqns = [self._fqns.code(fqn) for fqn in fqns]
+        entity_ids = [self._entities.code(entity_id) for entity_id in entity_ids]
+        self._pending["fqn"].extend(fqns)
+        self._pending["entity_id"].extend(entity_ids)
+        self._pending["value"].extend(values)
+        self._pending["timestamp"].extend(timestamps)
+        self._seq += len(fqns)
+        self._add_to_index(np.asarray(fqns, dtype=np.int32), np.asarray(entity_ids, dtype=np.int64),
+                           np.asarray(timestamps, dtype=np.int64), feature_index._objects(values))
+
+    def _flush_pending(self):
+        if len(self._pending["fqn"]) == 0:
+            return
+        self._stored.append(pd.DataFrame({
+            "entity_id": np.asarray(self._pending["entity_id"], dtype=np.int64),
+            "value": pd.Series(self._pending["value"], dtype=object).infer_objects(),
+            "timestamp": pd.to_datetime(self._pending["timestamp"], utc=True),
+            "fqn": np.asarray(self._pending["fqn"], dtype=np.int32),
+        }))
+        self._stored_fqns.append(set(self._pending["fqn"]))
+        self._stored_seqs.append(self._seq + 1 - len(self._pending["fqn"]))  # nothing was stored since
+        self._pending = {"fqn": [], "entity_id": [], "value": [], "timestamp": []}
+
+    def _compact(self):
+        """Concatenate the adjacent stored dataframes whose values are of the same dtype.
+
+        Dataframes of different dtypes are kept apart, so the values of every feature remain in a typed column rather
+        than being mixed into a column of objects.
+        """
+        self._flush_pending()
+        stored, stored_fqns, stored_seqs = [], [], []
+        for df, fqns, seqs in zip(self._stored, self._stored_fqns, self._stored_seqs):
+            if len(stored) > 0 and stored[-1][-1]["value"].dtype == df["value"].dtype:
+                stored[-1].append(df)
+                stored_fqns[-1] = stored_fqns[-1] | fqns
+                stored_seqs[-1].append((seqs, len(df)))
+            else:
+                stored.append([df])
+                stored_fqns.append(fqns)
+                stored_seqs.append([(seqs, len(df))])
+        self._stored = [frames[0] if len(frames) == 1 else pd.concat(frames) for frames in stored]
+        self._stored_fqns = stored_fqns
+        self._stored_seqs = [_seq_concat(parts) for parts in stored_seqs]
+
+    def _recent(self) -> pd.DataFrame:
+        """The values that were stored after the persisted ones were loaded, as a single (encoded) dataframe"""
+        self._compact()
+        return _concat(self._stored) if len(self._stored) > 0 else pd.DataFrame()
+
+    def _frame(self) -> pd.DataFrame:
+        """All the stored values, as a single (encoded) dataframe"""
+        if len(self._persisted) > 0:
+            for fqn in self._persisted:
+                self._index_persisted(fqn)
+            self._flush_pending()
+            frames = [self._persisted_frame(fqn) for fqn in self._persisted]
+            self._stored[:0] = frames
+            self._stored_fqns[:0] = [{self._fqns.code(fqn)} for fqn in self._persisted]
+            self._stored_seqs[:0] = (np.cumsum([0] + [len(df) for df in frames[:-1]]) + 1).tolist()
+            self._persisted = {}
+            self._persisted_rows = 0
+        return self._recent()
+
+    def lookup(self, fqn: str, entity_id, timestamp: int, staleness: int = 0):
+        self._index_persisted(fqn)
+        idx = self._index.get(self._fqns.get(fqn))
+        entity_id = self._entities.get(entity_id)
+        if idx is None or entity_id is None:
+            return None
+        return idx.lookup(entity_id, timestamp, staleness)
+
+    def latest(self, fqn: str, entity_id):
+        self._index_persisted(fqn)
+        idx = self._index.get(self._fqns.get(fqn))
+        entity_id = self._entities.get(entity_id)
+        if idx is None or entity_id is None:
+            return None
+        ts = idx.last_timestamp(entity_id)
+        return None if ts is None else idx.lookup(entity_id, ts)
+
+    def scan(self, fqns: list = None, since: int = None, until: int = None) -> pd.DataFrame:
+        if fqns is None:
+            return self._decoded(_filter_time(self._frame(), since, until))
+
+        # only the persisted values of these fqns are read, and only the stored dataframes that have values of these
+        # fqns are filtered, rather than concatenating all of them first
+        frames = [self._persisted_frame(fqn) for fqn in self._persisted if fqn in set(fqns)]
+        codes = {self._fqns.get(fqn) for fqn in fqns} - {None}
+        self._flush_pending()
+        for df, df_fqns in zip(self._stored, self._stored_fqns):
+            if df_fqns <= codes:
+                frames.append(df)
+            elif not df_fqns.isdisjoint(codes):
+                frames.append(df.loc[df["fqn"].isin(codes)])
+        if len(frames) == 0:
+            return _empty_frame()
+        return self._decoded(_filter_time(_concat(frames), since, until))
+
+    def count(self) -> int:
+        return self._seq
+
+    def since(self, offset: int) -> pd.DataFrame:
+        if offset < self._persisted_rows:
+            self._frame()  # the persisted values are read like the stored ones
+
+        # only the last stored dataframes are concatenated
+        self._flush_pending()
+        frames = []
+        for df, seqs in zip(reversed(self._stored), reversed(self._stored_seqs)):
+            split = _seq_split(seqs, len(df), offset)
+            if split < len(df):
+                frames.append(df.iloc[split:] if split > 0 else df)
+            if split > 0:
+                break
+        if len(frames) == 0:
+            return _empty_frame()
+        return self._decoded(_concat(frames[::-1]))
+
+    def truncate(self, offset: int):
+        if offset >= self.count():
+            return
+        if offset < self._persisted_rows:
+            self._frame()  # the persisted values are truncated like the stored ones
+
+        # the dataframes are truncated one by one, so each keeps the dtype of its values
+        self._flush_pending()
+        stored, stored_fqns, stored_seqs = [], [], []
+        for df, fqns, seqs in zip(self._stored, self._stored_fqns, self._stored_seqs):
+            split = _seq_split(seqs, len(df), offset)
+            if split == 0:
+                break
+            if split < len(df):
+                df = df.iloc[:split]
+                fqns = set(np.unique(df["fqn"].to_numpy()).tolist())
+                seqs = seqs if isinstance(seqs, int) else seqs[:split]
+            stored.append(df)
+            stored_fqns.append(fqns)
+            stored_seqs.append(seqs)
+        self._stored, self._stored_fqns, self._stored_seqs = stored, stored_fqns, stored_seqs
+        self._seq = offset
+        self._index = {}  # the persisted values are indexed again on demand
+        self._shared = set()
+        self._reindex()
+
+    def remove(self, fqns: list) -> pd.DataFrame:
+        removed = self.scan(fqns)
+        for fqn in fqns:
+            self._persisted.pop(fqn, None)
+
+        codes = {self._fqns.get(fqn) for fqn in fqns} - {None}
+        stored, stored_fqns, stored_seqs = [], [], []
+        for df, df_fqns, seqs in zip(self._stored, self._stored_fqns, self._stored_seqs):
+            if not df_fqns.isdisjoint(codes):
+                kept = ~df["fqn"].isin(codes).to_numpy()
+                df, df_fqns, seqs = df.iloc[kept], df_fqns - codes, _seq_array(seqs, len(df))[kept]
+            if len(df) > 0:
+                stored.append(df)
+                stored_fqns.append(df_fqns)
+                stored_seqs.append(seqs)
+        self._stored, self._stored_fqns, self._stored_seqs = stored, stored_fqns, stored_seqs
+        for code in codes:
+            self._index.pop(code, None)
+        return removed
+
+    def evict(self, fqn: str, before: int = None, keep_latest: bool = False, max_rows: int = None) -> int:
+        # values that were loaded from disk are evicted only once they're read, as until then they're not in memory
+        code = self._fqns.get(fqn)
+        if code is None:
+            return 0
+        self._flush_pending()
+        parts = [(i, np.flatnonzero(df["fqn"].to_numpy() == code))
+                 for i, (df, fqns) in enumerate(zip(self._stored, self._stored_fqns)) if code in fqns]
+        if len(parts) == 0:
+            return 0
+        evicted = _evicted(np.concatenate([self._stored[i]["entity_id"].to_numpy()[pos] for i, pos in parts]),
+                           np.concatenate([feature_index.to_epoch_ns(self._stored[i]["timestamp"].iloc[pos])
+                                           for i, pos in parts]),
+                           before, keep_latest, max_rows)
+        if not evicted.any():
+            return 0
+        drops = {}
+        start = 0
+        for i, pos in parts:
+            drops[i] = pos[evicted[start:start + len(pos)]]
+            start += len(pos)
+        self._drop(drops)
+        return int(evicted.sum())
+
+    def dedupe(self, offset: int) -> int:
+        if offset < self._persisted_rows:
+            self._frame()
+        self._flush_pending()
+        # the stored dataframes are split at the offset, to the values before it and the ones after it
+        old, new = [], []
+        for i, (df, seqs) in enumerate(zip(self._stored, self._stored_seqs)):
+            split = _seq_split(seqs, len(df), offset)
+            if split > 0:
+                old.append((i, split))
+            if split < len(df):
+                new.append(df.iloc[split:])
+        if len(old) == 0 or len(new) == 0:
+            return 0
+
+        new = _concat(new)
+        new_keys = _keys(new)
+        new_fqns = set(np.unique(new["fqn"].to_numpy()).tolist())
+        drops = {}
+        for i, split in old:
+            if self._stored_fqns[i].isdisjoint(new_fqns):
+                continue
+            pos = np.flatnonzero(self._stored[i]["fqn"].iloc[:split].isin(new_fqns).to_numpy())
+            dup = _keys(self._stored[i].iloc[pos]).isin(new_keys)
+            if dup.any():
+                drops[i] = pos[dup]
+        return self._drop(drops)
+
+    def _drop(self, drops: dict) -> int:
+        """Drop values of the stored dataframes, by the positions in each of them, and index their features again"""
+        codes = set()
+        dropped = 0
+        for i, pos in drops.items():
+            if len(pos) == 0:
+                continue
+            df = self._stored[i]
+            codes.update(np.unique(df["fqn"].to_numpy()[pos]).tolist())
+            keep = np.ones(len(df), dtype=bool)
+            keep[pos] = False
+            self._stored[i] = df.iloc[keep]
+            self._stored_fqns[i] = set(np.unique(self._stored[i]["fqn"].to_numpy()).tolist())
+            self._stored_seqs[i] = _seq_array(self._stored_seqs[i], len(df))[keep]
+            dropped += len(pos)
+        if dropped == 0:
+            return 0
+        kept = [i for i, df in enumerate(self._stored) if len(df) > 0]
+        self._stored = [self._stored[i] for i in kept]
+        self._stored_fqns = [self._stored_fqns[i] for i in kept]
+        self._stored_seqs = [self._stored_seqs[i] for i in kept]
+
+        # the indexes of the features are built again out of the values that are left
+        for code in codes:
+            self._index.pop(code, None)
+        self._reindex(codes)
+        return dropped
+
+    def _reindex(self, codes: set = None):
+        """Index the stored values of the fqn codes (or of all of them)"""
+        for df, fqns in zip(self._stored, self._stored_fqns):
+            if codes is None or fqns <= codes:
+                self._add_to_index(df["fqn"].to_numpy(), df["entity_id"].to_numpy(),
+                                   feature_index.to_epoch_ns(df["timestamp"]),
+                                   feature_index._objects(df["value"].tolist()))
+            elif not fqns.isdisjoint(codes):
+                df = df.loc[df["fqn"].isin(codes)]
+                self._add_to_index(df["fqn"].to_numpy(), df["entity_id"].to_numpy(),
+                                   feature_index.to_epoch_ns(df["timestamp"]),
+                                   feature_index._objects(df["value"].tolist()))
+
+    def reset(self, feature_values: pd.DataFrame = None):
+        self.__init__()
+        if feature_values is not None:
+            self.store(feature_values)
+
+    def fork(self) -> "MemoryBackend":
+        self._flush_pending()
+        fork = MemoryBackend()
+        fork._fqns = self._fqns
+        fork._entities = self._entities
+        fork._stored = list(self._stored)
+        fork._stored_fqns = list(self._stored_fqns)
+        fork._stored_seqs = list(self._stored_seqs)
+        fork._seq = self._seq
+        fork._index = dict(self._index)
+        fork._persisted = dict(self._persisted)
+        fork._persisted_rows = self._persisted_rows
+        # the indexes are copied by whichever backend adds values to them first
+        self._shared = set(self._index)
+        fork._shared = set(self._index)
+        return fork
+
+    def load(self, readers: dict, rows: int):
+        self.reset()
+        self._persisted = dict(readers)
+        self._persisted_rows = rows
+        self._seq = rows
+
+
+class SQLiteBackend(Backend):
+    """Keeps the values in an SQLite database, for stores that don't fit in memory.
+
+    The values are indexed by (fqn, entity_id, timestamp) for lookups, and by (fqn, timestamp) for scans. They're
+    pickled, so values of any type can be stored. A database that already has values is used as is.
+    """
+
+    def __init__(self, path: str):
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        if path != ":memory:":
+            self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        # the sequence is the position of the value in the order the values were stored
+        self._db.execute("CREATE TABLE IF NOT EXISTS feature_values (seq INTEGER PRIMARY KEY, fqn TEXT NOT NULL, "
+                         "entity_id, value BLOB, timestamp INTEGER NOT NULL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS feature_values_entity "
+                         "ON feature_values (fqn, entity_id, timestamp)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS feature_values_time ON feature_values (fqn, timestamp)")
+        self._db.commit()
+        self._count = self._db.execute("SELECT COALESCE(MAX(seq), 0) FROM feature_values").fetchone()[0]
+
+    @staticmethod
+    def _encode(value) -> bytes:
+        if isinstance(value, ragged.ListValue):
+            value = value.tolist()  # rather than its whole buffer
+        return pickle.dumps(value)
+
+    def store(self, feature_values: pd.DataFrame):
+        if len(feature_values) == 0:
+            return
+        self.store_values(feature_values["fqn"].tolist(), feature_values["entity_id"].tolist(),
+                          feature_values["value"].tolist(),
+                          feature_index.to_epoch_ns(feature_values["timestamp"]).tolist())
+
+    def store_values(self, fqns: list, entity_ids: list, values: list, timestamps: list):
+        if len(fqns) == 0:
+            return
+        rows = zip(range(self._count + 1, self._count + len(fqns) + 1), fqns, entity_ids,
+                   map(self._encode, values), timestamps)
+        with self._db:
+            self._db.executemany("INSERT INTO feature_values VALUES (?, ?, ?, ?, ?)", rows)
+        self._count += len(fqns)
+
+    def lookup(self, fqn: str, entity_id, timestamp: int, staleness: int = 0):
+        row = self._db.execute("SELECT value, timestamp FROM feature_values "
+                               "WHERE fqn = ? AND entity_id = ? AND timestamp <= ? AND timestamp >= ? "
+                               "ORDER BY timestamp DESC, seq DESC LIMIT 1",
+                               (fqn, entity_id, int(timestamp),
+                                int(timestamp - staleness) if staleness > 0 else np.iinfo(np.int64).min)).fetchone()
+        if row is None:
+            return None
+        return pickle.loads(row[0]), row[1]
+
+    def _query(self, where: str = "", params=()) -> pd.DataFrame:
+        rows = self._db.execute(f"SELECT fqn, entity_id, value, timestamp FROM feature_values {where} ORDER BY seq",
+                                params).fetchall()
+        if len(rows) == 0:
+            return _empty_frame()
+        fqns, entity_ids, values, timestamps = zip(*rows)
+        return pd.DataFrame({
+            "fqn": fqns,
+            "entity_id": entity_ids,
+            "value": pd.Series([pickle.loads(v) for v in values], dtype=object).infer_objects(),
+            "timestamp": pd.to_datetime(timestamps, utc=True),
+        })
+
+    def scan(self, fqns: list = None, since: int = None, until: int = None) -> pd.DataFrame:
+        conditions, params = [], []
+        if fqns is not None:
+            fqns = list(fqns)
+            conditions.append(f"fqn IN ({', '.join('?' * len(fqns))})")
+            params.extend(fqns)
+        if since is not None:
+            conditions.append("timestamp >= ?")
+            params.append(int(since))
+        if until is not None:
+            conditions.append("timestamp <= ?")
+            params.append(int(until))
+        return self._query("WHERE " + " AND ".join(conditions) if len(conditions) > 0 else "", params)
+
+    def count(self) -> int:
+        return self._count
+
+    def since(self, offset: int) -> pd.DataFrame:
+        return self._query("WHERE seq > ?", (offset,))
+
+    def truncate(self, offset: int):
+        if offset >= self._count:
+            return
+        with self._db:
+            self._db.execute("DELETE FROM feature_values WHERE seq > ?", (offset,))
+        self._count = offset
+
+    def remove(self, fqns: list) -> pd.DataFrame:
+        fqns = list(fqns)
+        where = f"WHERE fqn IN ({', '.join('?' * len(fqns))})"
+        removed = self._query(where, fqns)
+        with self._db:
+            self._db.execute(f"DELETE FROM feature_values {where}", fqns)
+        return removed
+
+    def dedupe(self, offset: int) -> int:
+        with self._db:
+            return self._db.execute(
+                "DELETE FROM feature_values WHERE seq IN (SELECT o.seq FROM feature_values n JOIN feature_values o "
+                "ON o.fqn = n.fqn AND o.entity_id = n.entity_id AND o.timestamp = n.timestamp AND o.seq <= ? "
+                "WHERE n.seq > ?)", (offset, offset)).rowcount
+
+    def evict(self, fqn: str, before: int = None, keep_latest: bool = False, max_rows: int = None) -> int:
+        # the positions are sequence numbers, so they remain valid
+        dropped = 0
+        with self._db:
+            if before is not None and keep_latest:
+                dropped += self._db.execute(
+                    "DELETE FROM feature_values WHERE seq IN (SELECT seq FROM (SELECT seq, ROW_NUMBER() OVER "
+                    "(PARTITION BY entity_id ORDER BY timestamp DESC, seq DESC) AS n FROM feature_values "
+                    "WHERE fqn = ? AND timestamp < ?) WHERE n > 1)", (fqn, int(before))).rowcount
+            elif before is not None:
+                dropped += self._db.execute("DELETE FROM feature_values WHERE fqn = ? AND timestamp < ?",
+                                            (fqn, int(before))).rowcount
+            if max_rows is not None:
+                dropped += self._db.execute(
+                    "DELETE FROM feature_values WHERE seq IN (SELECT seq FROM feature_values WHERE fqn = ? "
+                    "ORDER BY timestamp DESC, seq DESC LIMIT -1 OFFSET ?)", (fqn, int(max_rows))).rowcount
+        return dropped
+
+    def reset(self, feature_values: pd.DataFrame = None):
+        with self._db:
+            self._db.execute("DELETE FROM feature_values")
+        self._count = 0
+        if feature_values is not None:
+            self.store(feature_values)
+
+    def fork(self) -> "SQLiteBackend":
+        raise Exception("Forking is not supported by the `sqlite` storage backend. Please use the `memory` backend")
@@ -20,6 +20,8 @@ from enum import Enum
 import astunparse as astunparse
 import pandas as pd
 
+from . import durpy
+
 
 class AggrFn(Enum):
     Unknown = 'unknown'
@@ -53,18 +55,109 @@ class AggrFn(Enum):
         raise Exception(f"Unknown AggrFn {self}")
 
 
-def WrapException(e: Exception, spec, *args, **kwargs):
+# the features a program reads with `f()` (or `get_feature`), by fqn
+_reads_pattern = re.compile(r"\b(?:f|get_feature)\(\s*[\"']([^\"']+)[\"']")
+# the features a program changes with instructions, by instruction and fqn
+_writes_pattern = re.compile(r"\b(set_feature|update_feature|append_feature|incr_feature)\(\s*[\"']([^\"']+)[\"']")
+
+
+class FeatureSpec:
+    """The spec of a registered feature, compiled once for the lookups of its values: its fqn is parsed, and its
+    durations are in nanoseconds. It's immutable, and the spec it was compiled from is kept as is in `spec`."""
+    __slots__ = ("spec", "fqn", "name", "namespace", "src_name", "primitive", "aggr", "staleness", "freshness",
+                 "max_length", "reads", "writes", "accumulates")
+
+    def __init__(self, spec: dict):
+        options = spec["options"]
+        name, namespace = spec["fqn"].split(".", 1)
+        writes = _writes_pattern.findall(spec["src"].code)
+        compiled = {
+            "spec": spec,
+            "fqn": spec["fqn"],
+            "name": name,
+            "namespace": namespace,
+            "src_name": spec["src_name"],
+            "primitive": options["primitive"],
+            "aggr": frozenset(options.get("aggr", [])),
+            "staleness": int(durpy.from_str(options["staleness"]).total_seconds() * 1e9),
+            "freshness": int(durpy.from_str(options["freshness"]).total_seconds() * 1e9),
+            "max_length": options.get("max_length"),
+            "reads": frozenset(_reads_pattern.findall(spec["src"].code)),
+            "writes": frozenset(fqn for _, fqn in writes),
+            # the instructions that build on the previous value, so the values they set depend on the whole history
+            "accumulates": any(op in ("incr_feature", "append_feature") for op, _ in writes),
+        }
+        for attr, value in compiled.items():
+            object.__setattr__(self, attr, value)
+
+    def __setattr__(self, attr, value):
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def __repr__(self):
+        return f"FeatureSpec({self.fqn})"
+
+
+# the (nullable) dtype of the values of each primitive, and the kinds of values (by `infer_dtype`) it holds as is
+_value_dtypes = {
+    "int": ("Int64", ("integer", "empty")),
+    "float": ("Float64", ("floating", "integer", "mixed-integer-float", "empty")),
+    "string": ("string", ("string", "empty")),
+    "timestamp": ("datetime64[ns, UTC]", ("string", "datetime", "datetime64", "empty")),
+}
+
+
+def typed_values(primitive: str, values):
+    """Convert the values of a feature to an array of the dtype of its primitive, with missing values as NA.
+
+    Lists, and values that aren't of the primitive's type (i.e. a bool of an `int` feature), are kept as objects.
+    """
+    if primitive not in _value_dtypes:
+        return pd.array(values, dtype=object)
+    dtype, kinds = _value_dtypes[primitive]
+    if pd.api.types.infer_dtype(values, skipna=True) not in kinds:
+        return pd.array(values, dtype=object)
+    try:
+        if primitive == "timestamp":
+            return pd.to_datetime(pd.Series(values, dtype=object), utc=True).astype(dtype).array
+        return pd.array(values, dtype=dtype)
+    except (TypeError, ValueError):
+        return pd.array(values, dtype=object)
+
+
+def _parse_pyexp_error(e: Exception):
+    """Parse a PyExp runtime error to a tuple of (error message, PyExp line number), or None if it isn't one"""
     frame_str = re.match(r".*<pyexp>:([0-9]+):([0-9]+)?: (.*)", str(e).replace("\n", ""), flags=re.MULTILINE)
-    if frame_str is None or not isinstance(spec["src"], PyExpProgram):
+    if frame_str is None:
+        return None
+    err_str = re.match(r"in (.*)Error in ([aA0-zZ09_]+): (.*)", frame_str.group(3))
+    if err_str is None:
+        err_str = frame_str.group(3).strip()
+    else:
+        err_str = f"Error in {err_str.group(2)}: {err_str.group(3).strip()}"
+    return err_str, int(frame_str.group(1))
+
+
+def ErrorDetails(e: Exception, spec):
+    """Get the details of an error raised while executing a program.
+
+    :return: a tuple of (error message, line number in the program's source file). The line number is None if the error
+        didn't originate in the PyExp program.
+    """
+    parsed = _parse_pyexp_error(e)
+    if parsed is None or not isinstance(spec["src"], PyExpProgram):
+        return str(e), None
+    err_str, lineno = parsed
+    return err_str, spec["src"].f_lineno + lineno - 1
+
+
+def WrapException(e: Exception, spec, *args, **kwargs):
+    parsed = _parse_pyexp_error(e)
+    if parsed is None or not isinstance(spec["src"], PyExpProgram) or spec["src"].frame is None:
         return e
     else:
-        err_str = re.match(r"in (.*)Error in ([aA0-zZ09_]+): (.*)", frame_str.group(3))
-        if err_str is None:
-            err_str = frame_str.group(3).strip()
-        else:
-            err_str = f"Error in {err_str.group(2)}: {err_str.group(3).strip()}"
+        err_str, lineno = parsed
         frame = spec["src"].frame
-        loc = spec["src"].f_lineno + int(frame_str.group(1)) - 1
+        loc = spec["src"].f_lineno + lineno - 1
         tb = types.TracebackType(tb_next=None,
                                  tb_frame=frame,
                                  tb_lasti=e.__traceback__.tb_lasti,
@@ -107,3 +200,9 @@ class PyExpProgram:
 
         self.code = astunparse.unparse(node).strip()
         self.name = func.__name__
+
+    def __getstate__(self):
+        # frames can't be pickled, so a program that is sent to another process leaves its frame behind
+        state = self.__dict__.copy()
+        state["frame"] = None
+        return state